@@ -0,0 +1,104 @@
+"""
+Turn persistence benchmark: turns/second for the old per-statement commits
+on a default SQLite engine versus the one-transaction turn on the tuned
+engine from server/storage/db.py.
+
+    python -m qa.bench.db_bench
+    python -m qa.bench.db_bench --sessions 20 --turns 10 --threads 8
+
+Each turn reads history + state, then writes the user and assistant
+messages; every fifth turn also writes a SOAP summary and three citations.
+"""
+import argparse, json, os, sys, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
+
+STATE = {"intent": "resp_upper", "slots": {"main_symptoms": ["ไอ", "เจ็บคอ"], "duration": "3 วัน"},
+         "asked_slots": ["main_symptoms", "duration"], "pending_slot": "fever_measured"}
+CITES = [{"doc_id": f"doc{i}", "snippet_ids": [f"doc{i}::{j}" for j in range(3)]} for i in range(3)]
+
+def turn_state(i: int):
+    st = dict(STATE)
+    if i % 5 == 4:
+        st.update(soap_ready=True, soap_json={"S": "ไอ 3 วัน"}, citations=CITES)
+    return st
+
+def legacy_turn(SessionLocal, models, sid: str, i: int) -> None:
+    """The pre-change write path: one commit per step, citations row by row."""
+    from sqlalchemy import select
+    Message, SessionRec, SoapSummary, Citation = models
+    now = lambda: "%.6f" % time.time()
+    with SessionLocal() as db:
+        if not db.query(SessionRec).filter(SessionRec.id == sid).first():
+            db.add(SessionRec(id=sid, created_at=now(), age_bucket="unknown", consent_flags="{}"))
+            db.commit()
+        db.add(Message(session_id=sid, role="user", text=f"ข้อความ {i}", state_json="{}", created_at=now()))
+        db.commit()
+        db.execute(select(Message).where(Message.session_id == sid)
+                   .order_by(Message.created_at.desc()).limit(4)).all()
+        db.execute(select(Message).where(Message.session_id == sid, Message.role == "assistant")
+                   .order_by(Message.created_at.desc()).limit(1)).first()
+    st = turn_state(i)
+    with SessionLocal() as db:
+        msg = Message(session_id=sid, role="assistant", text="คำถามถัดไป",
+                      state_json=json.dumps(st, ensure_ascii=False), created_at=now())
+        db.add(msg)
+        db.commit()
+        if st.get("soap_ready"):
+            db.add(SoapSummary(session_id=sid, soap_json=json.dumps(st["soap_json"]), created_at=now()))
+            db.commit()
+        if st.get("citations"):
+            for c in st["citations"]:
+                db.add(Citation(session_id=sid, turn_id=msg.id, doc_id=c["doc_id"],
+                                snippet_ids=",".join(c["snippet_ids"])))
+            db.commit()
+
+def run(fn, sessions: int, turns: int, threads: int) -> float:
+    # sessions run concurrently, each session's turns in order (as the API serves them)
+    def session(s):
+        for i in range(turns):
+            fn(f"bench_{s}", i)
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(session, range(sessions)))
+    return sessions * turns / (time.perf_counter() - t0)
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--sessions", type=int, default=20)
+    ap.add_argument("--turns", type=int, default=10)
+    ap.add_argument("--threads", type=int, default=8)
+    args = ap.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # the tuned engine is built at import time from DB_URL
+        os.environ["DB_URL"] = f"sqlite:///{os.path.join(tmp, 'after.db')}"
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+        from server.storage.db import Base, init_db
+        from server.storage import models
+        from server.storage.turns import load_turn, persist_turn
+
+        legacy_engine = create_engine(f"sqlite:///{os.path.join(tmp, 'before.db')}",
+                                      connect_args={"check_same_thread": False})
+        Base.metadata.create_all(legacy_engine)
+        LegacySession = sessionmaker(bind=legacy_engine, expire_on_commit=False)
+        legacy_models = (models.Message, models.SessionRec, models.SoapSummary, models.Citation)
+
+        init_db()
+
+        def current_turn(sid, i):
+            load_turn(sid, f"ข้อความ {i}")
+            persist_turn(sid, f"ข้อความ {i}", "คำถามถัดไป", turn_state(i))
+
+        before = run(lambda sid, i: legacy_turn(LegacySession, legacy_models, sid, i),
+                     args.sessions, args.turns, args.threads)
+        after = run(current_turn, args.sessions, args.turns, args.threads)
+        legacy_engine.dispose()
+
+    print(f"before: {before:8.1f} turns/s  (per-step commits, default SQLite engine)")
+    print(f"after:  {after:8.1f} turns/s  (one transaction per turn, WAL + synchronous=NORMAL)")
+    print(f"speedup: x{after / before:.2f}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,278 @@
+"""
+Micro-benchmarks for the CPU-bound code every chat turn runs, with a stored
+baseline and a regression gate:
+
+    redflags.*   RedFlagChecker.detect (short, flagged, 4 KB, backtracking-prone)
+    slots.*      merge_states / compute_missing / enforce_state
+    parse.*      parse_llm_output (clean, fenced, brace fallback, long view)
+    prompt.*     build_prompt (typical, over budget with trimming)
+    ingest.*     chunk_markdown / split_len (per document, not per turn)
+    rag.bm25.*   ThaiTokenizer and BM25Index.query (hybrid / lexical retrieval)
+    rag.mmr.*    mmr_select, the work of _mmr_rank, over 15 / 200 candidates
+
+    python -m qa.bench.hotpath_bench                     # table + comparison with the baseline
+    python -m qa.bench.hotpath_bench --check             # exit 1 if a case is slower than tolerated
+    python -m qa.bench.hotpath_bench --update-baseline   # re-record qa/bench/hotpath_baseline.json
+    python -m qa.bench.hotpath_bench -k redflags --check
+
+Each case runs --repeat timed rounds (about --min-time seconds each), each
+right after a round of a fixed pure-Python calibration loop. The table shows
+the best µs per call; the gate compares the median case/calibration ratio
+with the baseline's, so a baseline recorded on one machine holds on another
+(--raw compares plain µs). A case fails when it is more than `tolerance` (a
+fraction, per case in the baseline file or --tolerance) slower than its
+baseline; failing cases are re-timed once before the verdict.
+
+"turn CPU" sums the cases one ordinary LLM turn runs once each.
+"""
+import argparse, gc, glob, json, os, platform, sys, time
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(os.path.dirname(HERE))
+BASELINE = os.path.join(HERE, "hotpath_baseline.json")
+DEFAULT_TOLERANCE = 0.30
+
+# cases one ordinary (non fast-path) LLM turn runs once each
+TURN_CASES = ["redflags.detect.short", "slots.enforce_state.mid", "parse.clean",
+              "prompt.build.typical", "rag.mmr.15"]
+
+MESSAGES = [
+    "มีไข้ ไอ เจ็บคอ มา 3 วัน กินยาแล้วยังไม่ดีขึ้น น้ำมูกไหล",
+    "ลูกอายุ 2 ขวบ ผื่นขึ้นที่แขนกับขา คันมาก ไม่มีไข้",
+    "ปวดหัวข้างเดียว ตาพร่า คลื่นไส้ เป็นมาตั้งแต่เมื่อวาน",
+    "ท้องเสีย ถ่ายเหลว 5 ครั้ง อ่อนเพลีย ดื่มน้ำได้",
+]
+FLAGGED = "เมื่อคืนแน่นหน้าอกมาก หายใจไม่ออก เหงื่อแตก ตอนนี้ยังเจ็บอยู่"
+
+LLM_STATE = {"intent": "resp_upper",
+             "slots": {"main_symptoms": ["ไอ", "เจ็บคอ"], "duration": "3 วัน", "fever_measured": True,
+                       "fever_max_c": 38.5, "severity": "ปานกลาง"},
+             "asked_slots": ["main_symptoms", "duration"]}
+VIEW = "เข้าใจค่ะ อาการไอและเจ็บคอมา 3 วัน มีไข้ 38.5 องศา ขอถามเพิ่มเติมว่ามีน้ำมูกหรือหายใจลำบากไหมคะ"
+
+def _calibrate() -> None:
+    # fixed pure-Python work (dict/str/sort) that tracks interpreter speed
+    d = {}
+    for i in range(2000):
+        d["k%d" % i] = ("ไข้" * (i % 7)).strip()
+    sorted(d.items(), key=lambda kv: (len(kv[1]), kv[0]))
+
+def _loops(fn: Callable[[], object], min_time: float) -> int:
+    """Calls of fn that take about min_time seconds."""
+    n = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(n):
+            fn()
+        dt = time.perf_counter() - t0
+        if dt >= min_time / 4:
+            return max(1, int(n * min_time / max(dt, 1e-9)))
+        n *= 4
+
+def _round(fn: Callable[[], object], n: int) -> float:
+    gc.collect()
+    gc.disable()        # as timeit does: collector pauses land on whichever case triggers them
+    try:
+        t0 = time.perf_counter()
+        for _ in range(n):
+            fn()
+        return (time.perf_counter() - t0) / n
+    finally:
+        gc.enable()
+
+def measure(fn: Callable[[], object], calib_n: int, repeat: int, min_time: float) -> Tuple[float, float]:
+    """
+    -> (best µs per call, median cost relative to the calibration loop).
+    Every round of the case follows a round of the calibration loop, so the
+    ratio cancels machine speed and drift (frequency scaling, busy neighbours).
+    """
+    n = _loops(fn, min_time)
+    us, rel = [], []
+    for _ in range(repeat):
+        c = _round(_calibrate, calib_n)
+        t = _round(fn, n)
+        us.append(t * 1e6)
+        rel.append(t / c)
+    return min(us), sorted(rel)[len(rel) // 2]
+
+def build_cases() -> Dict[str, Callable[[], object]]:
+    from server.config_loader import config_snapshot
+    from server.orchestrator.output_parser import parse_llm_output
+    from server.orchestrator.prompt_builder import build_prompt
+    from server.orchestrator.slot_enforcer import compute_missing, enforce_state, merge_states
+    from server.rag.ingest import RAG_DIR, chunk_markdown, split_len
+    from server.rag.search import mmr_select
+    from server.redflags.check import RedFlagChecker
+
+    cfg = config_snapshot()
+    checker = RedFlagChecker()
+    cases: Dict[str, Callable[[], object]] = {}
+
+    # red flags: every literal-prefixed regex rule ("แน่นหน้าอก.*หายใจ") is confirmed
+    # with rx.match at each prefix hit; text full of prefixes without the rest of
+    # the pattern makes those matches scan to the end of the message
+    long_msg = " ".join(MESSAGES * 40)[:4000]
+    stems = [rx.pattern.split(".*")[0] for r in checker.rules for rx in r["patterns"] if ".*" in rx.pattern]
+    patho = (" ".join(s.split("(")[0] + " เป็นๆ หายๆ" for s in stems) + " ") * 8
+    cases["redflags.detect.short"] = lambda: [checker.detect(m) for m in MESSAGES]
+    cases["redflags.detect.flagged"] = lambda: checker.detect(FLAGGED)
+    cases["redflags.detect.long_4k"] = lambda: checker.detect(long_msg)
+    cases["redflags.detect.backtrack"] = lambda: checker.detect(patho)
+
+    # slots
+    policy, questions = cfg.policy, cfg.slot_questions
+    prev = {"intent": "resp_upper", "slots": {"main_symptoms": ["ไอ", "เจ็บคอ"]},
+            "asked_slots": ["main_symptoms"], "pending_slot": "duration"}
+    switch = {"intent": "derm_rash", "slots": {"rash_location": "แขน"}}
+    cases["slots.merge_states"] = lambda: merge_states(prev, LLM_STATE, policy)
+    cases["slots.merge_states.intent_change"] = lambda: merge_states(prev, switch, policy)
+    cases["slots.compute_missing"] = lambda: compute_missing("resp_upper", LLM_STATE["slots"], policy)
+    cases["slots.enforce_state.first"] = lambda: enforce_state({}, {"intent": "resp_upper", "slots": {}},
+                                                               policy, questions, VIEW, MESSAGES[0])
+    cases["slots.enforce_state.mid"] = lambda: enforce_state(prev, LLM_STATE, policy, questions, VIEW,
+                                                             "ไข้ 38.5 วัดปรอททางปาก เป็นมา 3 วัน")
+    cases["slots.enforce_state.long_text"] = lambda: enforce_state(prev, LLM_STATE, policy, questions, VIEW,
+                                                                   long_msg)
+
+    # LLM output parsing
+    state_json = json.dumps(LLM_STATE, ensure_ascii=False)
+    clean = f"[USER_VIEW]\n{VIEW}\n[STATE_JSON]\n{state_json}"
+    fenced = f"[USER_VIEW]\n{VIEW}\n[STATE_JSON]\n```json\n{state_json}\n```"
+    chatter = f"[USER_VIEW]\n{VIEW}\n[STATE_JSON]\nนี่คือสถานะค่ะ: {state_json} หวังว่าจะช่วยได้"
+    long_view = f"[USER_VIEW]\n{VIEW * 30}\n[STATE_JSON]\n{state_json}"
+    cases["parse.clean"] = lambda: parse_llm_output(clean)
+    cases["parse.fenced"] = lambda: parse_llm_output(fenced)
+    cases["parse.brace_fallback"] = lambda: parse_llm_output(chatter)
+    cases["parse.long_view"] = lambda: parse_llm_output(long_view)
+
+    # prompt assembly over real chunks
+    docs = sorted(glob.glob(os.path.join(RAG_DIR, "docs", "**", "*.md"), recursive=True))
+    texts = [open(p, encoding="utf-8").read() for p in docs]
+    snippets = []
+    for d, text in enumerate(texts):
+        for i, ch in enumerate(chunk_markdown(text), start=1):
+            sn = {"doc_id": f"doc{d}", "title": os.path.basename(docs[d]), "version": "1.0",
+                  "snippet_id": f"s{i}", "text": ch, "score": 0.8}
+            snippets.append(sn)
+    history = [{"role": "user" if i % 2 == 0 else "assistant", "text": MESSAGES[i % len(MESSAGES)]}
+               for i in range(4)]
+    long_history = [{"role": h["role"], "text": h["text"] * 20} for h in history]
+    prompt_cfg = cfg.llm_settings.get("prompt")
+    tight = {**(prompt_cfg or {}), "budget_tokens": 3000}
+
+    def prompt(sn, hist, pc):
+        return lambda: build_prompt(cfg.system_prompt, cfg.safety, cfg.slot_policy, sn, hist,
+                                    MESSAGES[0], prompt_cfg=pc)
+    cases["prompt.build.typical"] = prompt(snippets[:5], history, prompt_cfg)
+    cases["prompt.build.over_budget"] = prompt(snippets[:20], long_history, tight)
+
+    # ingest chunking
+    largest = max(texts, key=len)
+    corpus = "\n\n".join(texts * 3)
+    cases["ingest.chunk_markdown.doc"] = lambda: chunk_markdown(largest)
+    cases["ingest.chunk_markdown.corpus_x3"] = lambda: chunk_markdown(corpus)
+    cases["ingest.split_len.50k"] = lambda: split_len(corpus[:50000], 900, 120)
+
+    # BM25 over the same chunks (hybrid / lexical-only retrieval)
+    from server.rag.bm25 import BM25Index, ThaiTokenizer, build_arrays
+    tok = ThaiTokenizer((2, 3))
+    ids, metas, *arrays = build_arrays(((f"{sn['doc_id']}:{sn['snippet_id']}", sn) for sn in snippets), tok)
+    bm25 = BM25Index({"ids": ids, "metadatas": metas, "ngram": [2, 3], "k1": 1.2, "b": 0.75}, *arrays)
+    cases["rag.bm25.tokenize"] = lambda: tok(MESSAGES[0])
+    cases["rag.bm25.query"] = lambda: bm25.query(MESSAGES[0], 10, 0.25)
+    cases["rag.bm25.query.long"] = lambda: bm25.query(long_msg, 10, 0.25)
+
+    # MMR re-ranking: search asks the index for 3 x top_k candidates with values
+    rng = np.random.default_rng(7)
+    dim = int(cfg.rag_settings["embeddings"].get("dimension", 1536))
+    q = rng.standard_normal(dim).astype(np.float32)
+    for n in (15, 200):
+        vecs = rng.standard_normal((n, dim)).astype(np.float32)
+        cases[f"rag.mmr.{n}"] = (lambda v: lambda: mmr_select(q, v, 5))(vecs)
+    return cases
+
+def load_baseline(path: str) -> Dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("-k", dest="filter", default="", help="only cases whose name contains this")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--min-time", type=float, default=0.2, help="seconds per timed round")
+    ap.add_argument("--baseline", default=BASELINE)
+    ap.add_argument("--tolerance", type=float, help="override every case's tolerance (fraction)")
+    ap.add_argument("--raw", action="store_true", help="compare µs, not calibration-relative cost")
+    ap.add_argument("--check", action="store_true", help="exit 1 when a case regressed beyond tolerance")
+    ap.add_argument("--update-baseline", action="store_true")
+    args = ap.parse_args(argv)
+
+    cases = {k: fn for k, fn in build_cases().items() if args.filter in k}
+    calib_n = _loops(_calibrate, args.min_time / 4)
+    print(f"calibration loop {_round(_calibrate, calib_n) * 1e6:.0f} µs")
+    results = {name: measure(fn, calib_n, args.repeat, args.min_time) for name, fn in cases.items()}
+
+    base = load_baseline(args.baseline)
+    base_cases = base.get("cases", {})
+    key = "us" if args.raw else "rel"
+
+    def tolerance(name: str) -> float:
+        if args.tolerance is not None:
+            return args.tolerance
+        return base_cases.get(name, {}).get("tolerance", base.get("tolerance", DEFAULT_TOLERANCE))
+
+    def verdict(name: str) -> Tuple[float, bool]:
+        ref = base_cases.get(name, {}).get(key)
+        if not ref:
+            return float("nan"), True
+        ratio = results[name][0 if args.raw else 1] / ref
+        return ratio, ratio <= 1 + tolerance(name)
+
+    print(f"{'case':<36} {'µs/call':>10} {'base µs':>10} {'ratio':>7} {'tol':>5}")
+    failed: List[str] = []
+    for name in results:
+        ratio, ok = verdict(name)
+        if not ok and args.check:
+            # one re-time before calling it a regression
+            again = measure(cases[name], calib_n, args.repeat, args.min_time)
+            results[name] = (min(results[name][0], again[0]), min(results[name][1], again[1]))
+            ratio, ok = verdict(name)
+        ref_us = base_cases.get(name, {}).get("us", float("nan"))
+        print(f"{name:<36} {results[name][0]:>10.1f} {ref_us:>10.1f} {ratio:>7.2f} "
+              f"{tolerance(name):>5.2f}" + ("" if ok else "  SLOWER"))
+        if not ok:
+            failed.append(name)
+    turn = [results[n][0] for n in TURN_CASES if n in results]
+    if len(turn) == len(TURN_CASES):
+        print(f"\nturn CPU (one ordinary LLM turn): {sum(turn):.0f} µs -> "
+              f"{1e6 / sum(turn):.0f} turns/s per core, before I/O, JSON and the framework")
+
+    if args.update_baseline:
+        cases_out = dict(base_cases)
+        for name, (us, rel) in results.items():
+            entry = {"us": round(us, 2), "rel": round(rel, 6)}
+            if "tolerance" in base_cases.get(name, {}):
+                entry["tolerance"] = base_cases[name]["tolerance"]
+            cases_out[name] = entry
+        out = {"tolerance": base.get("tolerance", DEFAULT_TOLERANCE),
+               "recorded": {"python": platform.python_version(), "machine": platform.machine(),
+                            "time": time.strftime("%Y-%m-%d")},
+               "cases": dict(sorted(cases_out.items()))}
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(out, f, ensure_ascii=False, indent=1)
+            f.write("\n")
+        print("baseline written:", args.baseline)
+        return 0
+
+    if args.check and failed:
+        print(f"FAIL: {len(failed)} case(s) slower than tolerated: {', '.join(failed)}", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+"""
+Red-flag matcher scaling benchmark.
+
+Builds synthetic rule files of growing size (the real rules plus generated
+phrasing variants), then times the old first-match regex loop against the
+compiled RedFlagChecker on the same messages, and checks that both flag the
+same messages with the same label (messages built from every rule's patterns).
+
+    python -m qa.bench.redflags_bench
+    python -m qa.bench.redflags_bench --sizes 100,1000,5000 --check
+"""
+import argparse, os, random, re, sys, tempfile, time
+import yaml
+
+from server.redflags.check import RedFlagChecker, RULE_PATH
+
+SYLLABLES = ["ปวด", "เจ็บ", "บวม", "แดง", "คัน", "ชา", "ร้อน", "เย็น", "หัว", "ท้อง",
+             "ขา", "แขน", "ตา", "หู", "คอ", "หลัง", "มาก", "นิด", "ตลอด", "บ่อย"]
+
+MESSAGES = [
+    "มีไข้ ไอ เจ็บคอ มา 3 วัน กินยาแล้วยังไม่ดีขึ้น น้ำมูกไหล",
+    "ลูกอายุ 2 ขวบ ผื่นขึ้นที่แขนกับขา คันมาก ไม่มีไข้",
+    "ปวดหัวข้างเดียว ตาพร่า คลื่นไส้ เป็นมาตั้งแต่เมื่อวาน",
+    "เมื่อคืนแน่นหน้าอก หายใจไม่ค่อยออก ตอนนี้ดีขึ้นแล้ว",
+    "ท้องเสีย ถ่ายเหลว 5 ครั้ง อ่อนเพลีย ดื่มน้ำได้",
+]
+
+class NaiveChecker:
+    """The pre-automaton detect(): every rule, every regex, stop at first match."""
+    def __init__(self, rule_path: str):
+        with open(rule_path, "r", encoding="utf-8") as f:
+            data = yaml.safe_load(f)
+        self.rules = [
+            {"label": r["label"], "patterns": [re.compile(p, flags=re.IGNORECASE) for p in r["patterns"]]}
+            for r in data["rules"].values()
+        ]
+
+    def detect(self, text: str):
+        t = (text or "").strip()
+        for r in self.rules:
+            for rx in r["patterns"]:
+                if rx.search(t):
+                    return {"is_emergency": True, "label": r["label"], "trigger": rx.pattern}
+        return {"is_emergency": False, "label": None}
+
+def synth_rules(n_patterns: int, seed: int = 7) -> dict:
+    with open(RULE_PATH, "r", encoding="utf-8") as f:
+        data = yaml.safe_load(f)
+    rng = random.Random(seed)
+    rules = dict(data["rules"])
+    base = sum(len(r["patterns"]) for r in rules.values())
+    extra = max(0, n_patterns - base)
+    seen = set()
+    i = 0
+    while extra > 0:
+        key = f"synthetic_{i // 50}"
+        rule = rules.setdefault(key, {"label": key, "patterns": []})
+        words = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(3, 5)))
+        if words in seen:
+            continue
+        seen.add(words)
+        # roughly one in five variants carries regex syntax, like the real file,
+        # some with an escape before a top-level alternation
+        if i % 5 == 0:
+            words = words[:6] + ".*" + words[6:]
+        elif i % 7 == 0:
+            words = words[:6] + r"\s*" + words[6:] + "|" + "".join(rng.choice(SYLLABLES) for _ in range(3))
+        rule["patterns"].append(words)
+        extra -= 1
+        i += 1
+    return {"version": data.get("version", 1), "rules": rules}
+
+def probes(rules: dict) -> list:
+    """Messages that hit each pattern (every alternative of it), alone and inside a sentence."""
+    out = list(MESSAGES)
+    for rule in rules["rules"].values():
+        for pat in rule["patterns"]:
+            text = re.sub(r"\(([^|)]*)[^)]*\)\??", r"\1", pat)     # first alternative of a group
+            for branch in re.sub(r"\.\*|\\s\*", " ", text).split("|"):
+                out += [branch, f"ลูก{branch}มาตั้งแต่เช้า"]
+    return out
+
+def mismatches(naive: "NaiveChecker", compiled: RedFlagChecker, texts) -> list:
+    """Texts where the compiled checker's (is_emergency, label) differs from the regex loop's."""
+    bad = []
+    for t in texts:
+        a, b = naive.detect(t), compiled.detect(t)
+        if (a["is_emergency"], a["label"]) != (b["is_emergency"], b["label"]):
+            bad.append(t)
+    return bad
+
+def per_call_us(fn, texts, repeat: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for t in texts:
+            fn(t)
+    return (time.perf_counter() - t0) / (repeat * len(texts)) * 1e6
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--sizes", default="30,100,500,1000,2000,5000")
+    ap.add_argument("--repeat", type=int, default=200)
+    ap.add_argument("--check", action="store_true",
+                    help="fail unless compiled cost grows far slower than rule count")
+    args = ap.parse_args(argv)
+    sizes = [int(s) for s in args.sizes.split(",")]
+
+    rows, wrong = [], 0
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            rules = synth_rules(n)
+            path = os.path.join(tmp, f"rules_{n}.yaml")
+            with open(path, "w", encoding="utf-8") as f:
+                yaml.safe_dump(rules, f, allow_unicode=True)
+            naive, compiled = NaiveChecker(path), RedFlagChecker(path)
+            texts = probes(rules)
+            bad = mismatches(naive, compiled, texts)
+            if bad:
+                wrong += len(bad)
+                print(f"{n} rules: {len(bad)}/{len(texts)} messages flagged differently, e.g. {bad[:3]}",
+                      file=sys.stderr)
+            n_pats = sum(len(r["patterns"]) for r in compiled.rules)
+            rows.append((n_pats,
+                         per_call_us(naive.detect, MESSAGES, args.repeat),
+                         per_call_us(compiled.detect, MESSAGES, args.repeat)))
+
+    print(f"{'patterns':>9} {'naive_us':>10} {'compiled_us':>12}")
+    for n_pats, naive_us, comp_us in rows:
+        print(f"{n_pats:>9} {naive_us:>10.1f} {comp_us:>12.1f}")
+    if wrong:
+        print("FAIL: compiled matcher disagrees with the per-rule regex loop", file=sys.stderr)
+        return 1
+
+    if args.check and len(rows) > 1:
+        (n0, _, c0), (n1, _, c1) = rows[0], rows[-1]
+        growth, scale = c1 / c0, n1 / n0
+        print(f"rules x{scale:.0f}, compiled cost x{growth:.2f}")
+        # sub-linear: cost must grow at most with the square root of rule count
+        if growth > scale ** 0.5:
+            print("FAIL: compiled matcher does not scale sub-linearly", file=sys.stderr)
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+"""
+Provider resilience against the fake OpenAI server (qa/fakes/openai_server.py),
+started in-process on a free port. Each scenario sets faults, then makes
+sequential calls through a ResilientCaller and reports success rate and
+latency percentiles:
+
+    healthy      no faults
+    errors       30% HTTP 503 -> retries with jittered backoff
+    slow_tail    4% of calls +1.5s -> hedged embeddings cut the tail
+    outage       every call fails -> the breaker opens and rejects fast
+
+    python -m qa.bench.resilience_bench
+    python -m qa.bench.resilience_bench --calls 400 --check
+
+--check exits non-zero unless retries keep the error scenario above 93%
+success (three attempts: ~97% expected), hedging lowers p99 in the slow-tail scenario, and the breaker
+rejects during the outage.
+"""
+import argparse, asyncio, socket, sys, threading, time
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_fake(port: int):
+    import uvicorn
+    from qa.fakes import openai_server
+    server = uvicorn.Server(uvicorn.Config(openai_server.app, host="127.0.0.1", port=port, log_level="error"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.02)
+    return server, openai_server
+
+def pct(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else float("nan")
+
+async def scenario(caller, make_call, base_url: str, calls: int, warmup: int):
+    from openai import AsyncOpenAI
+    from server.llm.resilience import ProviderUnavailable
+    # one client per event loop; pooled connections do not survive asyncio.run()
+    client = AsyncOpenAI(api_key="x", base_url=base_url, max_retries=0)
+    # warm-up calls fill the latency window the hedge delay is taken from
+    for _ in range(warmup):
+        try:
+            await caller.call(lambda timeout: make_call(client, timeout))
+        except ProviderUnavailable:
+            pass
+    ok, rejected, lat = 0, 0, []
+    for _ in range(calls):
+        t0 = time.perf_counter()
+        try:
+            await caller.call(lambda timeout: make_call(client, timeout))
+            ok += 1
+        except ProviderUnavailable as e:
+            rejected += e.reason == "circuit_open"
+        lat.append(time.perf_counter() - t0)
+    await client.close()
+    return {"ok": ok / calls, "rejected": rejected, "p50": pct(lat, 0.5), "p99": pct(lat, 0.99)}
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--calls", type=int, default=200)
+    ap.add_argument("--check", action="store_true")
+    args = ap.parse_args(argv)
+
+    from server.llm.resilience import ResilientCaller
+
+    port = _free_port()
+    server, fake = start_fake(port)
+    base_url = f"http://127.0.0.1:{port}/v1"
+
+    def chat(client, timeout):
+        return client.chat.completions.create(model="fake", messages=[{"role": "user", "content": "ไอ"}],
+                                              timeout=timeout)
+
+    def embed(client, timeout):
+        return client.embeddings.create(model="fake", input=["ไอ เจ็บคอ"], timeout=timeout)
+
+    def make(api, **own):
+        c = ResilientCaller(api)
+        c.configure({api: {"attempt_timeout_s": 3, "max_attempts": 3, **own},
+                     "retry": {"base_s": 0.02, "cap_s": 0.2},
+                     "hedge": {"quantile": 0.95, "min_delay_s": 0.05, "min_samples": 10},
+                     "breaker": {"failure_threshold": 3, "open_s": 60}})
+        return c
+
+    base = {"latency_ms": 20, "jitter_ms": 10, "error_rate": 0.0, "slow_rate": 0.0, "slow_ms": 0}
+    runs = [
+        ("healthy", base, "chat", {}, chat),
+        ("errors", {**base, "error_rate": 0.3}, "chat", {}, chat),
+        ("slow_tail", {**base, "slow_rate": 0.04, "slow_ms": 1500}, "embeddings", {"hedge": False}, embed),
+        ("slow_tail+hedge", {**base, "slow_rate": 0.04, "slow_ms": 1500}, "embeddings", {"hedge": True}, embed),
+        ("outage", {**base, "error_rate": 1.0}, "chat", {"max_attempts": 2}, chat),
+    ]
+    results = {}
+    print(f"{'scenario':<16} {'success':>8} {'rejected':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for name, faults, api, own, fn in runs:
+        fake.FAULTS.update(faults)
+        warmup = 0 if name == "outage" else 20
+        r = asyncio.run(scenario(make(api, **own), fn, base_url, args.calls, warmup))
+        results[name] = r
+        print(f"{name:<16} {r['ok']:>8.1%} {r['rejected']:>9d} {r['p50'] * 1000:>8.1f} {r['p99'] * 1000:>8.1f}")
+    server.should_exit = True
+
+    if args.check:
+        failed = []
+        if results["errors"]["ok"] < 0.93:
+            failed.append("retries did not mask 30% errors")
+        if not results["slow_tail+hedge"]["p99"] < results["slow_tail"]["p99"] / 2:
+            failed.append("hedging did not cut the p99")
+        if results["outage"]["rejected"] < args.calls // 2:
+            failed.append("breaker did not open during the outage")
+        for f in failed:
+            print("FAIL:", f)
+        return 1 if failed else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
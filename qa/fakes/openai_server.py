@@ -0,0 +1,168 @@
+"""
+Local stand-in for the OpenAI API with injectable latency and errors, for
+exercising timeouts, retries, hedging and the circuit breaker without a key
+or network.
+
+    python -m qa.fakes.openai_server --port 8100 --latency-ms 300 --jitter-ms 200 \\
+        --error-rate 0.1 --slow-rate 0.05 --slow-ms 8000
+    python -m qa.fakes.openai_server --latency-ms 800 --latency-sigma 0.5   # lognormal, median 800 ms
+    OPENAI_BASE_URL=http://127.0.0.1:8100/v1 OPENAI_API_KEY=x uvicorn server.app:app
+
+    POST /v1/chat/completions   canned [USER_VIEW]/[STATE_JSON] reply (resp_upper or derm_rash by
+                                keyword; a finalize prompt gets soap_json), streamed if asked
+    POST /v1/embeddings         deterministic vectors from hashed character bigrams
+    POST /_faults               change fault settings at runtime (JSON, same names as the flags)
+    GET  /_stats                requests served / failed / slowed, per endpoint
+
+Faults apply per request: with probability error_rate the reply is an HTTP
+error (error_status), with probability slow_rate slow_ms is added to the
+latency. The latency is latency_ms (times a lognormal factor with median 1
+when latency_sigma > 0) plus uniform(0, jitter_ms). A streamed reply waits the latency before its first chunk and
+chunk_ms between chunks.
+"""
+import argparse, asyncio, base64, hashlib, json, random, time
+from typing import Any, Dict, List
+
+import numpy as np
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+REPLY = ('[USER_VIEW]\nมีไข้ร่วมด้วยไหมคะ\n[STATE_JSON]\n'
+         '{"intent":"resp_upper","slots":{"main_symptoms":["ไอ","เจ็บคอ"]}}')
+DERM_REPLY = ('[USER_VIEW]\nผื่นมีลักษณะอย่างไรคะ\n[STATE_JSON]\n'
+              '{"intent":"derm_rash","slots":{}}')
+FINAL_REPLY = ('[USER_VIEW]\nสรุปอาการและคำแนะนำเบื้องต้น: พักผ่อน ดื่มน้ำมาก ๆ หากอาการแย่ลงให้พบแพทย์\n[STATE_JSON]\n'
+               '{"intent":"%s","soap_ready":true,"soap_json":{"S":"ผู้ป่วยเล่าอาการ","O":"-",'
+               '"A":"อาการไม่รุนแรง","P":"ดูแลตนเอง ติดตามอาการ"}}')
+
+FAULTS: Dict[str, Any] = {"latency_ms": 0.0, "latency_sigma": 0.0, "jitter_ms": 0.0,
+                          "error_rate": 0.0, "error_status": 503,
+                          "slow_rate": 0.0, "slow_ms": 0.0, "chunk_ms": 5.0, "embed_latency_ms": None}
+STATS: Dict[str, Dict[str, int]] = {}
+
+app = FastAPI(title="fake openai")
+
+def _count(endpoint: str, key: str) -> None:
+    STATS.setdefault(endpoint, {"requests": 0, "errors": 0, "slow": 0})[key] += 1
+
+async def _delay(endpoint: str, base_ms: float) -> None:
+    if FAULTS["latency_sigma"] > 0:
+        base_ms *= random.lognormvariate(0.0, FAULTS["latency_sigma"])
+    ms = base_ms + random.uniform(0, FAULTS["jitter_ms"])
+    if random.random() < FAULTS["slow_rate"]:
+        _count(endpoint, "slow")
+        ms += FAULTS["slow_ms"]
+    if ms > 0:
+        await asyncio.sleep(ms / 1000)
+
+def _fault(endpoint: str):
+    _count(endpoint, "requests")
+    if random.random() < FAULTS["error_rate"]:
+        _count(endpoint, "errors")
+        status = int(FAULTS["error_status"])
+        return JSONResponse({"error": {"message": "injected fault", "type": "server_error"}}, status_code=status)
+    return None
+
+def reply_for(messages: List[Dict[str, Any]]) -> str:
+    text = "\n".join(m.get("content") or "" for m in messages if m.get("role") == "user")
+    intent = "derm_rash" if ("ผื่น" in text or "คัน" in text) else "resp_upper"
+    if "STRICT MODE FINALIZE" in text:
+        return FINAL_REPLY % intent
+    return DERM_REPLY if intent == "derm_rash" else REPLY
+
+def fake_vector(text: str, dim: int) -> np.ndarray:
+    v = np.zeros(dim, dtype=np.float32)
+    for i in range(max(1, len(text) - 1)):
+        h = int(hashlib.md5(text[i:i + 2].encode("utf-8")).hexdigest()[:8], 16)
+        v[h % dim] += 1.0
+    return v / (np.linalg.norm(v) + 1e-9)
+
+def _usage(prompt: int, completion: int = 0) -> Dict[str, Any]:
+    return {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion,
+            "prompt_tokens_details": {"cached_tokens": 0}}
+
+@app.post("/v1/chat/completions")
+async def chat(request: Request):
+    body = await request.json()
+    err = _fault("chat")
+    prompt_tokens = sum(len(m.get("content") or "") for m in body.get("messages", [])) // 2
+    reply = reply_for(body.get("messages", []))
+    base = {"id": f"chatcmpl-{random.getrandbits(48):x}", "created": int(time.time()), "model": body.get("model", "fake")}
+    if not body.get("stream"):
+        await _delay("chat", FAULTS["latency_ms"])
+        if err is not None:
+            return err
+        return {**base, "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+                "usage": _usage(prompt_tokens, len(reply) // 2)}
+
+    await _delay("chat", FAULTS["latency_ms"])
+    if err is not None:
+        return err
+
+    async def chunks():
+        for i in range(0, len(reply), 12):
+            delta = {"content": reply[i:i + 12]}
+            yield "data: " + json.dumps({**base, "object": "chat.completion.chunk",
+                                         "choices": [{"index": 0, "delta": delta, "finish_reason": None}]},
+                                        ensure_ascii=False) + "\n\n"
+            await asyncio.sleep(FAULTS["chunk_ms"] / 1000)
+        yield "data: " + json.dumps({**base, "object": "chat.completion.chunk",
+                                     "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}) + "\n\n"
+        if (body.get("stream_options") or {}).get("include_usage"):
+            yield "data: " + json.dumps({**base, "object": "chat.completion.chunk", "choices": [],
+                                         "usage": _usage(prompt_tokens, len(reply) // 2)}) + "\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(chunks(), media_type="text/event-stream")
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    body = await request.json()
+    err = _fault("embeddings")
+    await _delay("embeddings", FAULTS["latency_ms"] if FAULTS["embed_latency_ms"] is None
+                 else FAULTS["embed_latency_ms"])
+    if err is not None:
+        return err
+    inputs: List[str] = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    dim = int(body.get("dimensions") or ARGS_DIM)
+    data = []
+    for i, text in enumerate(inputs):
+        vec = fake_vector(str(text), dim)
+        emb = (base64.b64encode(vec.tobytes()).decode() if body.get("encoding_format") == "base64"
+               else vec.tolist())
+        data.append({"object": "embedding", "index": i, "embedding": emb})
+    tokens = sum(len(str(t)) for t in inputs) // 2
+    return {"object": "list", "data": data, "model": body.get("model", "fake"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+@app.post("/_faults")
+async def set_faults(request: Request):
+    body = await request.json()
+    FAULTS.update({k: v for k, v in body.items() if k in FAULTS})
+    return FAULTS
+
+@app.get("/_stats")
+async def stats():
+    return STATS
+
+ARGS_DIM = 1536
+
+def main(argv=None) -> int:
+    global ARGS_DIM
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8100)
+    ap.add_argument("--dim", type=int, default=1536, help="embedding dimension (rag_settings.yaml)")
+    for name, value in FAULTS.items():
+        ap.add_argument("--" + name.replace("_", "-"), type=float, default=value)
+    args = ap.parse_args(argv)
+    ARGS_DIM = args.dim
+    for name in FAULTS:
+        FAULTS[name] = getattr(args, name)
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
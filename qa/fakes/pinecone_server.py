@@ -0,0 +1,161 @@
+"""
+Local stand-in for a Pinecone index data plane (cosine metric), in memory,
+with injectable latency and errors, for running the API with
+`backend: pinecone` without a key or network.
+
+    python -m qa.fakes.pinecone_server --port 8200 --latency-ms 40 --latency-sigma 0.4
+    # rag_settings.yaml: pinecone.host: http://127.0.0.1:8200
+
+    POST /query                   {namespace, vector, topK, includeMetadata, includeValues}
+    POST /vectors/upsert          {namespace, vectors: [{id, values, metadata}]}
+    POST /vectors/delete          {namespace, ids | deleteAll}
+    POST /describe_index_stats
+    POST /_faults                 change fault settings at runtime (same names as the flags)
+    GET  /_stats                  requests served / failed / slowed, per endpoint
+
+Latency and errors work as in qa/fakes/openai_server.py.
+"""
+import argparse, asyncio, random, threading
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+FAULTS: Dict[str, Any] = {"latency_ms": 0.0, "latency_sigma": 0.0, "jitter_ms": 0.0, "error_rate": 0.0,
+                          "error_status": 503, "slow_rate": 0.0, "slow_ms": 0.0}
+STATS: Dict[str, Dict[str, int]] = {}
+
+app = FastAPI(title="fake pinecone")
+
+class Namespace:
+    """id -> (unit vector, metadata); the query matrix is rebuilt after writes."""
+    def __init__(self):
+        self.items: Dict[str, Tuple[np.ndarray, Dict[str, Any]]] = {}
+        self._ids: List[str] = []
+        self._matrix = None
+        self._lock = threading.Lock()
+
+    def upsert(self, vectors: List[Dict[str, Any]]) -> int:
+        with self._lock:
+            for v in vectors:
+                vec = np.asarray(v["values"], dtype=np.float32)
+                self.items[v["id"]] = (vec / (np.linalg.norm(vec) + 1e-9), v.get("metadata") or {})
+            self._matrix = None
+        return len(vectors)
+
+    def delete(self, ids: List[str]) -> None:
+        with self._lock:
+            for i in ids:
+                self.items.pop(i, None)
+            self._matrix = None
+
+    def query(self, vector: List[float], top_k: int, with_meta: bool, with_values: bool):
+        with self._lock:
+            if self._matrix is None:
+                self._ids = list(self.items)
+                self._matrix = (np.stack([self.items[i][0] for i in self._ids]) if self._ids
+                                else np.zeros((0, len(vector)), dtype=np.float32))
+            ids, matrix = self._ids, self._matrix
+        if not ids or top_k <= 0:
+            return []
+        q = np.asarray(vector, dtype=np.float32)
+        scores = matrix @ (q / (np.linalg.norm(q) + 1e-9))
+        k = min(top_k, len(ids))
+        top = np.argpartition(-scores, k - 1)[:k] if k < len(ids) else np.arange(len(ids))
+        out = []
+        for i in top[np.argsort(-scores[top])]:
+            m = {"id": ids[i], "score": float(scores[i])}
+            if with_meta:
+                m["metadata"] = self.items[ids[i]][1]
+            if with_values:
+                m["values"] = self.items[ids[i]][0].tolist()
+            out.append(m)
+        return out
+
+NAMESPACES: Dict[str, Namespace] = {}
+
+def _ns(name: str) -> Namespace:
+    return NAMESPACES.setdefault(name or "", Namespace())
+
+def _count(endpoint: str, key: str) -> None:
+    STATS.setdefault(endpoint, {"requests": 0, "errors": 0, "slow": 0})[key] += 1
+
+async def _fault(endpoint: str):
+    _count(endpoint, "requests")
+    ms = FAULTS["latency_ms"]
+    if FAULTS["latency_sigma"] > 0:
+        ms *= random.lognormvariate(0.0, FAULTS["latency_sigma"])
+    ms += random.uniform(0, FAULTS["jitter_ms"])
+    if random.random() < FAULTS["slow_rate"]:
+        _count(endpoint, "slow")
+        ms += FAULTS["slow_ms"]
+    if ms > 0:
+        await asyncio.sleep(ms / 1000)
+    if random.random() < FAULTS["error_rate"]:
+        _count(endpoint, "errors")
+        return JSONResponse({"code": 14, "message": "injected fault"}, status_code=int(FAULTS["error_status"]))
+    return None
+
+@app.post("/query")
+async def query(request: Request):
+    body = await request.json()
+    err = await _fault("query")
+    if err is not None:
+        return err
+    matches = _ns(body.get("namespace", "")).query(
+        body["vector"], int(body.get("topK", 10)),
+        bool(body.get("includeMetadata", False)), bool(body.get("includeValues", False)),
+    )
+    return {"matches": matches, "namespace": body.get("namespace", ""), "usage": {"readUnits": 5}}
+
+@app.post("/vectors/upsert")
+async def upsert(request: Request):
+    body = await request.json()
+    err = await _fault("upsert")
+    if err is not None:
+        return err
+    return {"upsertedCount": _ns(body.get("namespace", "")).upsert(body.get("vectors") or [])}
+
+@app.post("/vectors/delete")
+async def delete(request: Request):
+    body = await request.json()
+    err = await _fault("delete")
+    if err is not None:
+        return err
+    ns = _ns(body.get("namespace", ""))
+    ns.delete(list(ns.items) if body.get("deleteAll") else body.get("ids") or [])
+    return {}
+
+@app.post("/describe_index_stats")
+async def describe_index_stats():
+    counts = {name: {"vectorCount": len(ns.items)} for name, ns in NAMESPACES.items()}
+    dims = [next(iter(ns.items.values()))[0].shape[0] for ns in NAMESPACES.values() if ns.items]
+    return {"namespaces": counts, "dimension": dims[0] if dims else 0,
+            "indexFullness": 0.0, "totalVectorCount": sum(c["vectorCount"] for c in counts.values())}
+
+@app.post("/_faults")
+async def set_faults(request: Request):
+    body = await request.json()
+    FAULTS.update({k: v for k, v in body.items() if k in FAULTS})
+    return FAULTS
+
+@app.get("/_stats")
+async def stats():
+    return STATS
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8200)
+    for name, value in FAULTS.items():
+        ap.add_argument("--" + name.replace("_", "-"), type=float, default=value)
+    args = ap.parse_args(argv)
+    for name in FAULTS:
+        FAULTS[name] = getattr(args, name)
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,387 @@
+"""
+End-to-end load test of server.app:app on one machine, no network and no
+keys: the API runs under uvicorn against the local fakes in qa/fakes
+(OpenAI chat + embeddings, Pinecone data plane) and concurrent users replay
+the Thai triage conversations in qa/loadtest/conversations.yaml.
+
+    python -m qa.loadtest.run
+    python -m qa.loadtest.run --users 32 --duration 60 --chat-latency-ms 800 --chat-latency-sigma 0.5
+    python -m qa.loadtest.run --set llm_settings.scheduler.chat.max_in_flight=4 --out /tmp/mif4.json
+    python -m qa.loadtest.run --compare qa/loadtest/results/before.json qa/loadtest/results/after.json
+
+Steps: start the fakes -> copy server/config into a temp dir with
+backend: pinecone pointed at the fake and every path (DB, manifest,
+embedding cache) inside the temp dir -> ingest rag/docs into the fake index
+-> start the API (TRACE_JSON_LOGS=1) -> one warm-up pass over every
+conversation -> `--users` users replay conversations for `--duration`
+seconds, each on a fresh session_id.
+
+Reported (and saved as JSON under qa/loadtest/results/ unless --out):
+client latency p50/p95/p99 per endpoint, turns/s, HTTP statuses,
+server-side p50/p95/p99 per stage (from the trace log spans), counter
+deltas from /metrics, and DB growth (bytes and rows per turn).
+
+The response cache is off unless --response-cache: the scripts repeat, so
+with it on most LLM calls would be cache hits.
+"""
+import argparse, asyncio, json, os, random, shutil, socket, sqlite3, subprocess, sys, tempfile, time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+import httpx
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def pct(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def summary(values: List[float]) -> Dict[str, Any]:
+    ms = [v * 1000 for v in values]
+    return {"count": len(ms), "mean_ms": round(sum(ms) / len(ms), 2) if ms else None,
+            **{f"p{int(q * 100)}_ms": (round(pct(ms, q), 2) if ms else None) for q in (0.5, 0.95, 0.99)}}
+
+# ---------- processes ----------
+def start(args: List[str], env: Dict[str, str], log_path: str) -> subprocess.Popen:
+    log = open(log_path, "wb")
+    return subprocess.Popen([sys.executable, "-m", *args], cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+def wait_ready(url: str, proc: subprocess.Popen, timeout_s: float = 60.0) -> None:
+    t_end = time.monotonic() + timeout_s
+    while time.monotonic() < t_end:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{' '.join(proc.args)} exited with {proc.returncode}")
+        try:
+            if httpx.get(url, timeout=1.0).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} not ready after {timeout_s}s")
+
+def set_path(cfg: Dict[str, Any], dotted: str, value: Any) -> None:
+    keys = dotted.split(".")
+    for k in keys[:-1]:
+        cfg = cfg.setdefault(k, {})
+    cfg[keys[-1]] = value
+
+def write_config(work: str, pinecone_url: str, overrides: List[str], response_cache: bool) -> str:
+    src = os.path.join(ROOT, "server", "config")
+    dst = os.path.join(work, "config")
+    shutil.copytree(src, dst)
+    docs = {}
+    for name in ("rag_settings", "llm_settings"):
+        with open(os.path.join(dst, name + ".yaml"), encoding="utf-8") as f:
+            docs[name] = yaml.safe_load(f)
+    rag = docs["rag_settings"]
+    rag["backend"] = "pinecone"
+    rag["pinecone"]["host"] = pinecone_url
+    rag["manifest_path"] = os.path.join(work, "manifest.json")
+    rag["local"]["path"] = os.path.join(work, "local")
+    if rag.get("lexical"):
+        rag["lexical"]["path"] = os.path.join(work, "bm25.npz")
+    rag["embeddings"]["cache"]["path"] = os.path.join(work, "embed_cache.sqlite")
+    set_path(docs["llm_settings"], "response_cache.enabled", response_cache)
+    for item in overrides:
+        key, _, raw = item.partition("=")
+        name, _, dotted = key.partition(".")
+        if name not in docs or not dotted:
+            raise SystemExit(f"--set {item}: expected rag_settings.<path>=<value> or llm_settings.<path>=<value>")
+        set_path(docs[name], dotted, yaml.safe_load(raw))
+    for name, doc in docs.items():
+        with open(os.path.join(dst, name + ".yaml"), "w", encoding="utf-8") as f:
+            yaml.safe_dump(doc, f, allow_unicode=True, sort_keys=False)
+    return dst
+
+# ---------- /metrics ----------
+def scrape(base: str) -> Dict[str, float]:
+    """Counter and gauge samples (histogram series left out) from the API's /metrics."""
+    out = {}
+    for line in httpx.get(base + "/metrics", timeout=10).text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        name, _, value = line.rpartition(" ")
+        if "_bucket{" in name or name.split("{")[0].endswith(("_sum", "_count", "_bucket")):
+            continue
+        out[name] = float(value)
+    return out
+
+def counter_deltas(before: Dict[str, float], after: Dict[str, float]) -> Dict[str, float]:
+    return {k: round(v - before.get(k, 0.0), 3) for k, v in sorted(after.items())
+            if k.split("{")[0].endswith("_total") and v != before.get(k, 0.0)}
+
+# ---------- DB ----------
+def db_stats(path: str) -> Dict[str, Any]:
+    size = sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+    rows = {}
+    if os.path.exists(path):
+        con = sqlite3.connect(path)
+        try:
+            for (table,) in con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'"):
+                rows[table] = con.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+        finally:
+            con.close()
+    return {"bytes": size, "rows": rows}
+
+# ---------- trace log ----------
+def stage_latencies(log_path: str, since: float) -> Dict[str, List[float]]:
+    stages = defaultdict(list)
+    with open(log_path, "rb") as f:
+        for raw in f:
+            if not raw.startswith(b"{"):
+                continue
+            try:
+                rec = json.loads(raw)
+            except ValueError:
+                continue
+            if rec.get("ts", 0) >= since and "span" in rec:
+                stages[rec["span"]].append(rec["ms"] / 1000)
+    return stages
+
+# ---------- users ----------
+class Recorder:
+    def __init__(self):
+        self.latency = defaultdict(list)       # endpoint -> seconds
+        self.first_event = []                  # stream: seconds to the first SSE event
+        self.status = defaultdict(int)
+        self.turns = 0
+        self.conversations = 0
+
+async def run_turn(client: httpx.AsyncClient, rec: Recorder, sid: str, text: str, stream: bool) -> bool:
+    body = {"session_id": sid, "user_text": text}
+    t0 = time.perf_counter()
+    try:
+        if stream:
+            async with client.stream("POST", "/chat/turn/stream", json=body) as r:
+                first = None
+                ok = r.status_code == 200
+                async for chunk in r.aiter_text():
+                    if first is None:
+                        first = time.perf_counter() - t0
+                    if "event: error" in chunk:
+                        ok = False
+                status = str(r.status_code) if ok or r.status_code != 200 else "200_sse_error"
+                if first is not None:
+                    rec.first_event.append(first)
+            endpoint = "turn_stream"
+        else:
+            r = await client.post("/chat/turn", json=body)
+            status, ok, endpoint = str(r.status_code), r.status_code == 200, "turn"
+    except httpx.HTTPError as e:
+        status, ok, endpoint = type(e).__name__, False, "turn_stream" if stream else "turn"
+    rec.status[status] += 1
+    if ok:
+        rec.latency[endpoint].append(time.perf_counter() - t0)
+        rec.turns += 1
+    return ok
+
+async def user(uid: int, client, rec: Recorder, convs, weights, t_end: float, stream_ratio: float,
+               think_s: float, rng: random.Random) -> None:
+    n = 0
+    while time.monotonic() < t_end:
+        name, conv = rng.choices(convs, weights)[0]
+        sid = f"lt_{uid}_{n}_{name}"
+        n += 1
+        stream = rng.random() < stream_ratio
+        for text in conv["turns"]:
+            if time.monotonic() >= t_end:
+                return
+            if not await run_turn(client, rec, sid, text, stream):
+                break           # a refused/failed turn ends the conversation, as a user would retry later
+            if think_s:
+                await asyncio.sleep(rng.uniform(0, 2 * think_s))
+        else:
+            rec.conversations += 1
+
+async def drive(base: str, convs, args) -> Dict[str, Any]:
+    weights = [c["weight"] for _, c in convs]
+    limits = httpx.Limits(max_connections=args.users + 4, max_keepalive_connections=args.users + 4)
+    async with httpx.AsyncClient(base_url=base, limits=limits, timeout=120) as client:
+        warm = Recorder()
+        for i, (name, conv) in enumerate(convs):
+            for text in conv["turns"]:
+                await run_turn(client, warm, f"warm_{i}_{name}", text, False)
+        rec = Recorder()
+        t_start = time.monotonic()
+        rng = random.Random(args.seed)
+        await asyncio.gather(*(
+            user(u, client, rec, convs, weights, t_start + args.duration, args.stream_ratio,
+                 args.think_ms / 1000, random.Random(rng.random()))
+            for u in range(args.users)
+        ))
+        elapsed = time.monotonic() - t_start
+    return {"rec": rec, "elapsed": elapsed}
+
+# ---------- report ----------
+def report(res: Dict[str, Any]) -> None:
+    print(f"\n{res['throughput']['turns']} turns in {res['throughput']['seconds']}s: "
+          f"{res['throughput']['turns_per_s']} turns/s, {res['throughput']['conversations_per_s']} conversations/s")
+    print("status:", res["status"])
+    print(f"\n{'client':<24} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, s in res["client"].items():
+        print(f"{name:<24} {s['count']:>7} {s['p50_ms'] or 0:>9.1f} {s['p95_ms'] or 0:>9.1f} {s['p99_ms'] or 0:>9.1f}")
+    print(f"\n{'stage':<24} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, s in res["stages"].items():
+        print(f"{name:<24} {s['count']:>7} {s['p50_ms']:>9.2f} {s['p95_ms']:>9.2f} {s['p99_ms']:>9.2f}")
+    db = res["db"]
+    print(f"\nDB: +{db['bytes_added']} bytes ({db['bytes_per_turn']} per turn), rows added {db['rows_added']}")
+
+def compare(a_path: str, b_path: str) -> int:
+    with open(a_path, encoding="utf-8") as f:
+        a = json.load(f)
+    with open(b_path, encoding="utf-8") as f:
+        b = json.load(f)
+
+    def row(label, x, y):
+        if x is None or y is None:
+            return
+        change = f"{(y - x) / x * 100:+.1f}%" if x else ""
+        print(f"{label:<36} {x:>12.2f} {y:>12.2f} {change:>9}")
+
+    print(f"{'':<36} {'A':>12} {'B':>12}")
+    row("turns/s", a["throughput"]["turns_per_s"], b["throughput"]["turns_per_s"])
+    for name in a["client"]:
+        if name in b["client"]:
+            for q in ("p50_ms", "p95_ms", "p99_ms"):
+                row(f"client {name} {q}", a["client"][name][q], b["client"][name][q])
+    for name in a["stages"]:
+        if name in b["stages"]:
+            row(f"stage {name} p95_ms", a["stages"][name]["p95_ms"], b["stages"][name]["p95_ms"])
+    row("db bytes/turn", a["db"]["bytes_per_turn"], b["db"]["bytes_per_turn"])
+    return 0
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--users", type=int, default=16, help="concurrent users")
+    ap.add_argument("--duration", type=float, default=30.0, help="seconds of load after warm-up")
+    ap.add_argument("--think-ms", type=float, default=0.0, help="mean pause between a user's turns")
+    ap.add_argument("--stream-ratio", type=float, default=0.5, help="share of conversations on /chat/turn/stream")
+    ap.add_argument("--conversations", default=os.path.join(HERE, "conversations.yaml"))
+    ap.add_argument("--chat-latency-ms", type=float, default=600.0)
+    ap.add_argument("--chat-latency-sigma", type=float, default=0.4, help="lognormal spread; 0 = fixed")
+    ap.add_argument("--chunk-ms", type=float, default=10.0, help="delay between streamed chunks")
+    ap.add_argument("--embed-latency-ms", type=float, default=60.0)
+    ap.add_argument("--index-latency-ms", type=float, default=40.0)
+    ap.add_argument("--index-latency-sigma", type=float, default=0.3)
+    ap.add_argument("--error-rate", type=float, default=0.0, help="provider (chat + embeddings) error rate")
+    ap.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    ap.add_argument("--response-cache", action="store_true")
+    ap.add_argument("--set", action="append", default=[], metavar="FILE.PATH=VALUE",
+                    help="override a setting in the temp config, e.g. llm_settings.scheduler.chat.max_in_flight=8")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", help="result JSON path (default qa/loadtest/results/<time>.json)")
+    ap.add_argument("--keep", action="store_true", help="keep the temp dir (DB, logs, config)")
+    ap.add_argument("--compare", nargs=2, metavar=("A.json", "B.json"), help="print two saved results side by side")
+    args = ap.parse_args(argv)
+    if args.compare:
+        return compare(*args.compare)
+
+    with open(args.conversations, encoding="utf-8") as f:
+        convs = list((yaml.safe_load(f) or {})["conversations"].items())
+
+    work = tempfile.mkdtemp(prefix="aidgent-loadtest-")
+    ports = {"openai": _free_port(), "pinecone": _free_port(), "api": _free_port()}
+    env = {**os.environ, "PYTHONPATH": ROOT + os.pathsep + os.environ.get("PYTHONPATH", "")}
+    procs: List[subprocess.Popen] = []
+    try:
+        with open(os.path.join(ROOT, "server", "config", "rag_settings.yaml"), encoding="utf-8") as f:
+            dim = yaml.safe_load(f)["embeddings"]["dimension"]
+        oa = start(["qa.fakes.openai_server", "--port", str(ports["openai"]), "--dim", str(dim),
+                    "--latency-ms", str(args.chat_latency_ms), "--latency-sigma", str(args.chat_latency_sigma),
+                    "--embed-latency-ms", str(args.embed_latency_ms), "--chunk-ms", str(args.chunk_ms),
+                    "--error-rate", str(args.error_rate)], env, os.path.join(work, "openai.log"))
+        pc = start(["qa.fakes.pinecone_server", "--port", str(ports["pinecone"]),
+                    "--latency-ms", str(args.index_latency_ms), "--latency-sigma", str(args.index_latency_sigma)],
+                   env, os.path.join(work, "pinecone.log"))
+        procs += [oa, pc]
+        wait_ready(f"http://127.0.0.1:{ports['openai']}/_stats", oa)
+        wait_ready(f"http://127.0.0.1:{ports['pinecone']}/_stats", pc)
+
+        cfg_dir = write_config(work, f"http://127.0.0.1:{ports['pinecone']}", args.set, args.response_cache)
+        db_path = os.path.join(work, "loadtest.db")
+        env.update({
+            "CONFIG_DIR": cfg_dir,
+            "DB_URL": f"sqlite:///{db_path}",
+            "OPENAI_BASE_URL": f"http://127.0.0.1:{ports['openai']}/v1",
+            "OPENAI_API_KEY": "fake",
+            "PINECONE_API_KEY": "fake",
+            "TRACE_JSON_LOGS": "1",
+        })
+        print("ingesting rag/docs into the fake index ...")
+        with open(os.path.join(work, "ingest.log"), "wb") as log:
+            subprocess.run([sys.executable, "-m", "server.rag.ingest", "--force"], cwd=ROOT, env=env, check=True,
+                           stdout=log, stderr=subprocess.STDOUT)
+
+        app_log = os.path.join(work, "api.log")
+        api = start(["uvicorn", "server.app:app", "--host", "127.0.0.1", "--port", str(ports["api"]),
+                     "--workers", str(args.workers), "--log-level", "warning"], env, app_log)
+        procs.append(api)
+        base = f"http://127.0.0.1:{ports['api']}"
+        wait_ready(base + "/metrics", api)
+
+        db_before = db_stats(db_path)
+        m_before = scrape(base)
+        t_wall = time.time()
+        print(f"{args.users} users for {args.duration:g}s ...")
+        # the warm-up pass runs inside drive(); its spans are older than t_load
+        out = asyncio.run(drive(base, convs, args))
+        rec, elapsed = out["rec"], out["elapsed"]
+        t_load = t_wall + (time.time() - t_wall - elapsed)
+        m_after = scrape(base)
+        db_after = db_stats(db_path)
+        stages = stage_latencies(app_log, t_load)
+    finally:
+        for p in reversed(procs):
+            p.terminate()
+        for p in procs:
+            try:
+                p.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                p.kill()
+        if not args.keep:
+            shutil.rmtree(work, ignore_errors=True)
+
+    client = {name: summary(v) for name, v in sorted(rec.latency.items())}
+    client["turn_stream_first_event"] = summary(rec.first_event)
+    turns = rec.turns
+    rows_added = {t: n - db_before["rows"].get(t, 0) for t, n in db_after["rows"].items()
+                  if n != db_before["rows"].get(t, 0)}
+    res = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "git": subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                  text=True).stdout.strip(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("compare", "out", "keep")},
+            "work_dir": work if args.keep else None,
+        },
+        "throughput": {"seconds": round(elapsed, 2), "turns": turns, "turns_per_s": round(turns / elapsed, 2),
+                       "conversations": rec.conversations,
+                       "conversations_per_s": round(rec.conversations / elapsed, 3)},
+        "status": dict(rec.status),
+        "client": client,
+        "stages": {name: summary(v) for name, v in sorted(stages.items())},
+        "db": {"bytes_before": db_before["bytes"], "bytes_after": db_after["bytes"],
+               "bytes_added": db_after["bytes"] - db_before["bytes"],
+               "bytes_per_turn": round((db_after["bytes"] - db_before["bytes"]) / turns, 1) if turns else None,
+               "rows_added": rows_added},
+        "counters": counter_deltas(m_before, m_after),
+    }
+    report(res)
+    path = args.out or os.path.join(HERE, "results", time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(res, f, ensure_ascii=False, indent=1)
+    print("saved", path)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,25 +1,38 @@
-import os
 import json
+import asyncio
+import logging
+import time
 import uuid
-from datetime import datetime, timezone
-from typing import Optional, Dict, Any, List
+from datetime import datetime
+from typing import Optional, Dict, Any
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
 from pydantic import BaseModel
+from sqlalchemy import func
 
 from dotenv import load_dotenv
 load_dotenv()
 
-from server.config_loader import load_system_prompt, load_slot_policy, load_safety, load_rag_settings
-from server.config_loader import load_slot_questions
-from server.orchestrator.slot_enforcer import enforce_state
+from server.config_loader import config_snapshot, ConfigSnapshot
+from server.orchestrator.slot_enforcer import enforce_state, merge_states, fast_path_turn
+from server.orchestrator.grounding import grounding, slot_query
 from server.redflags.check import RedFlagChecker
-from server.rag.search import RagSearcher
-from server.llm.openai_client import HostedModel
+from server.rag.search import RagSearcher, aembed_query
+from server.rag.memo import get_snippet_memo
+from server.llm.openai_client import HostedModel, aclose_async_openai
+from server.llm.response_cache import get_response_cache, prompt_key
+from server.llm.resilience import ProviderUnavailable, start_budget
+from server.llm.scheduler import Overloaded, get_scheduler, get_session_queue
 from server.orchestrator.prompt_builder import build_prompt, build_finalize_prompt
+from server.orchestrator.output_parser import parse_llm_output, StreamingOutputParser
 from server.storage.db import init_db, SessionLocal
-from server.storage.models import Message, SessionRec, SoapSummary, Citation
+from server.storage.models import Message, SessionRec, SoapSummary, Citation, SessionState
+from server.storage.turns import load_turn, persist_turn, persist_user_message, now_iso
+from server.metrics import counter, render_prometheus
+from server.tracing import RequestTracing, annotate, request_id, span
+from server.text.thai_analyzer import analyze
 
 app = FastAPI(title="Aid-gent Prototype API", version="0.1")
 
@@ -27,20 +40,37 @@ app = FastAPI(title="Aid-gent Prototype API", version="0.1")
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"], allow_credentials=True,
-    allow_methods=["*"], allow_headers=["*"]
+    allow_methods=["*"], allow_headers=["*"],
+    expose_headers=["ETag", "X-Request-ID"],
 )
+app.add_middleware(RequestTracing)
 
-# --- load configs ---
-SYSTEM_PROMPT = load_system_prompt()
-SLOTS = load_slot_policy()
-SAFETY = load_safety()
-RAGCFG = load_rag_settings()
-QUESTIONS = load_slot_questions()
+log = logging.getLogger("aidgent.turn")
 
 # --- init services ---
-checker = RedFlagChecker()          # deterministic rules from YAML (bundled)
-searcher = RagSearcher(RAGCFG)      # Pinecone + OpenAI embeddings (or fallback)
-hosted = HostedModel()              # GPT-4o client
+# configs come from the registry per turn (config_snapshot()), so edits apply without a restart;
+# the retrieval backend is chosen once from the settings at startup
+checker = RedFlagChecker()                      # deterministic rules from YAML (bundled)
+searcher = RagSearcher(config_snapshot().rag_settings)   # Pinecone + OpenAI embeddings (or fallback)
+hosted = HostedModel()                          # GPT-4o client
+
+# --- metrics ---
+FAST_PATH_ATTEMPTS = counter("aidgent_fast_path_attempts_total", "Turns answering a pending slot question", ["slot"])
+FAST_PATH_HITS = counter("aidgent_fast_path_hits_total", "Pending slot filled by deterministic extraction", ["slot"])
+FINALIZE_PREDICTION = counter("aidgent_finalize_prediction_total",
+                              "Finalize-turn prediction outcome (hit | false_positive | false_negative)", ["outcome"])
+FAST_PATH_ANSWERED = counter("aidgent_fast_path_answered_total", "Turns answered without retrieval or LLM", ["slot"])
+PROMPTS = counter("aidgent_prompts_total", "Prompts built (turn | finalize)", ["kind"])
+PROMPT_TOKENS = counter("aidgent_prompt_tokens_total", "Estimated prompt tokens sent (turn | finalize)", ["kind"])
+DEGRADED = counter("aidgent_degraded_replies_total",
+                   "Turns answered deterministically because the provider was unavailable", ["reason"])
+RESPONSE_CACHE = counter("aidgent_response_cache_total",
+                         "LLM completion cache lookups (exact_hit | semantic_hit | miss)", ["result"])
+RETRIEVAL = counter("aidgent_retrieval_total",
+                    "Turn retrieval decisions (eager | finalize | follow_up | open | second_pass | skipped)",
+                    ["decision"])
+SNIPPET_MEMO = counter("aidgent_snippet_memo_total", "Per-session snippet memo lookups (hit | miss)", ["result"])
+PROMPT_DROPPED = counter("aidgent_prompt_dropped_total", "Parts dropped to fit the prompt budget (snippet | history)", ["part"])
 
 # --- init DB ---
 init_db()
@@ -61,256 +91,647 @@ class CreateSessionReq(BaseModel):
 class CreateSessionResp(BaseModel):
     session_id: str
     intent: Optional[str] = None
-# ---------- Helpers ----------
-def now_iso():
-    return datetime.now(timezone.utc).isoformat()
-
-def get_recent_history(db, session_id: str, max_turns: int = 2) -> List[Dict[str, str]]:
-    msgs = (
-        db.query(Message)
-        .filter(Message.session_id == session_id)
-        .order_by(Message.created_at.desc())
-        .limit(max_turns * 2)
-        .all()
-    )
-    history = []
-    for m in reversed(msgs):
-        history.append({"role": m.role, "text": m.text})
-    return history
-
-def get_last_state(db, session_id: str) -> Dict[str, Any]:
-    m = (
-        db.query(Message)
-        .filter(Message.session_id == session_id, Message.role == "assistant")
-        .order_by(Message.created_at.desc())
-        .first()
-    )
-    if not m or not m.state_json:
-        return {}
+# ---------- Turn pipeline ----------
+def emergency_state(rf: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "intent": "emergency",
+        "required_slots_filled": False,
+        "missing_slots": [],
+        "slots": {},
+        "red_flag_detected": True,
+        "red_flag_label": rf["label"],
+        "citations": [],
+        "soap_ready": False,
+    }
+
+async def emergency_turn(sid: str, user_text: str, rf: Dict[str, Any]):
+    # no LLM and no earlier state involved: answered at once, never queued or shed
+    cfg = begin_turn(sid)
+    assistant_text = cfg.safety["emergency_main"]
+    state = emergency_state(rf)
+    await asyncio.to_thread(persist_turn, sid, user_text, assistant_text, state)
+    return assistant_text, state
+
+async def keep_user_message(sid: str, user_text: str) -> None:
+    """A turn that fails before its reply is saved still records what the patient wrote."""
     try:
-        return json.loads(m.state_json)
+        await asyncio.to_thread(persist_user_message, sid, user_text)
     except Exception:
-        return {}
+        log.exception("could not save the user message session=%s", sid)
 
-def parse_llm_output(raw_text: str) -> (str, Dict[str, Any]):
+def red_flags(user_text: str) -> Dict[str, Any]:
+    with span("red_flags") as sp:
+        rf = checker.detect(user_text)
+        sp.set(emergency=rf["is_emergency"])
+    return rf
+
+def begin_turn(sid: str) -> ConfigSnapshot:
+    """The config every step of this turn reads from; its version is logged with the turn."""
+    cfg = config_snapshot()
+    log.info("turn session=%s request=%s config_version=%s", sid, request_id(), cfg.version)
+    start_budget((cfg.llm_settings.get("resilience") or {}).get("request_budget_s", 0))
+    return cfg
+
+def run_fast_path(cfg: ConfigSnapshot, prev_state: Dict[str, Any], user_text: str):
+    with span("fast_path") as sp:
+        fp = fast_path_turn(prev_state, user_text, cfg.policy, cfg.slot_questions)
+        sp.set(slot=fp["slot"], hit=fp["hit"], answered=fp["state"] is not None)
+    if fp["slot"]:
+        FAST_PATH_ATTEMPTS.inc(slot=fp["slot"])
+        if fp["hit"]:
+            FAST_PATH_HITS.inc(slot=fp["slot"])
+        if fp["state"] is not None:
+            FAST_PATH_ANSWERED.inc(slot=fp["slot"])
+    return fp
+
+def report_prompt(sid: str, kind: str, prompt: Dict[str, Any]) -> Dict[str, Any]:
+    PROMPTS.inc(kind=kind)
+    PROMPT_TOKENS.inc(prompt["tokens"], kind=kind)
+    if prompt["dropped_snippets"]:
+        PROMPT_DROPPED.inc(prompt["dropped_snippets"], part="snippet")
+    if prompt["dropped_history"]:
+        PROMPT_DROPPED.inc(prompt["dropped_history"], part="history")
+    log.info("prompt session=%s kind=%s tokens=%d snippets=%d dropped_snippets=%d dropped_history=%d",
+             sid, kind, prompt["tokens"], prompt["snippets_kept"],
+             prompt["dropped_snippets"], prompt["dropped_history"])
+    return prompt
+
+async def retrieve(cfg: ConfigSnapshot, user_text: str):
     """
-    Split the model output into [USER_VIEW] and [STATE_JSON]
+    -> (snippets, query embedding or None). In hybrid mode the searcher falls
+    back to BM25 itself; otherwise, without embeddings the turn goes on ungrounded.
     """
-    user_view = ""
-    state_json: Dict[str, Any] = {}
-    text = raw_text
-
-    # Find markers
-    uv_start = text.find("[USER_VIEW]")
-    sj_start = text.find("[STATE_JSON]")
-
-    if uv_start != -1 and sj_start != -1:
-        user_view = text[uv_start + len("[USER_VIEW]"):sj_start].strip()
-        state_str = text[sj_start + len("[STATE_JSON]"):].strip()
-        # trim code fences if any
-        if state_str.startswith("```"):
-            state_str = state_str.split("```", 2)[1] if "```" in state_str[3:] else state_str[3:]
-        # attempt json parse
+    search = cfg.rag_settings["search"]
+    with span("retrieve") as sp:
         try:
-            state_json = json.loads(state_str)
-        except Exception:
-            # try to extract first {...}
-            first_brace = state_str.find("{")
-            last_brace = state_str.rfind("}")
-            if first_brace != -1 and last_brace != -1 and last_brace > first_brace:
-                try:
-                    state_json = json.loads(state_str[first_brace:last_brace + 1])
-                except Exception:
-                    state_json = {}
+            qvec, snippets = await searcher.asearch_vec(
+                user_text,
+                top_k=search["k"],
+                min_score=search["min_score"],
+                mmr=search["mmr"],
+            )
+        except ProviderUnavailable as e:
+            log.warning("retrieval skipped: %s", e)
+            sp.set(skipped=e.reason)
+            return [], None
+        sp.set(snippets=len(snippets))
+    return snippets, qvec
+
+async def grounded_snippets(cfg: ConfigSnapshot, sid: str, state: Dict[str, Any], user_text: str):
+    """
+    Lazy retrieval: -> (snippets, query embedding or None) for the slot state's
+    query (see grounding.slot_query), reused from the session memo while the
+    query and the config/corpus versions stay the same.
+    """
+    memo = get_snippet_memo(cfg.rag_settings)
+    query = slot_query(cfg.policy, state, user_text)
+    ns = cache_namespace(cfg)
+    hit = memo.get(sid, ns, query) if memo is not None else None
+    if hit is not None:
+        SNIPPET_MEMO.inc(result="hit")
+        annotate(snippet_memo="hit")
+        return hit
+    snippets, qvec = await retrieve(cfg, query)
+    if memo is not None:
+        SNIPPET_MEMO.inc(result="miss")
+        annotate(snippet_memo="miss")
+        # an empty result without an embedding may be a skipped search; try again next time
+        if snippets or qvec is not None:
+            memo.put(sid, ns, query, snippets, qvec)
+    return snippets, qvec
+
+async def message_embedding(cfg: ConfigSnapshot, user_text: str):
+    """
+    The semantic response cache matches first turns by the message embedding;
+    a first turn that skipped retrieval still embeds the message (no index query).
+    """
+    rcfg = cfg.llm_settings.get("response_cache") or {}
+    if not (rcfg.get("enabled", False) and (rcfg.get("semantic") or {}).get("enabled", False)):
+        return None
+    try:
+        return await aembed_query(user_text)
+    except (ProviderUnavailable, Overloaded) as e:
+        log.warning("message embedding skipped: %s", e)
+        return None
+
+async def prepare_turn(cfg: ConfigSnapshot, sid: str, user_text: str, rf: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    -> {"cfg", "fast": (user_view, state) | None, "snippets", "prev_state", "prompt", "predicted",
+        "cacheable", "first_turn", "qvec", "user_text", "lazy", "grounded"}
+    With the fast path on, history/state are read first so a confidently answered
+    slot question skips retrieval and the LLM; otherwise RAG search overlaps with
+    the history/state load (the turn is written once, at the end).
+    With lazy retrieval (search.lazy), only prompts whose reply is shown get
+    snippets (grounding.grounding), searched by the slot state and memoized per
+    session; "grounded" is False when this turn's prompt was built without them.
+    If the merged state predicts this turn completes the required slots, the
+    finalize prompt becomes the turn's only LLM call ("predicted" holds that state).
+    `rf` is the red-flag result; a turn where it fired never touches the response cache.
+    A turn that needs the LLM is refused (Overloaded) before retrieval when the chat
+    queue is full; fast-path turns and predicted finalize turns are never refused.
+    """
+    predicted = None
+    lazy = get_snippet_memo(cfg.rag_settings) is not None
+    turn = {"cfg": cfg, "fast": None, "snippets": [], "prompt": None, "predicted": None,
+            "cacheable": not rf["is_emergency"], "qvec": None, "user_text": user_text,
+            "lazy": lazy, "grounded": True}
+    if cfg.policy.fast_path or lazy:
+        history, prev_state = await asyncio.to_thread(load_turn, sid, user_text, 2)
+    if cfg.policy.fast_path:
+        fp = run_fast_path(cfg, prev_state, user_text)
+        if fp["state"] is not None:
+            turn.update(fast=(fp["user_view"], fp["state"]), prev_state=prev_state, first_turn=False)
+            return turn
+        if cfg.policy.predict_finalize:
+            predicted = fp["predicted"]
+    if predicted is None:
+        get_scheduler("chat").admit()
+    if lazy:
+        decision = grounding(cfg.policy, prev_state, predicted, user_text)
+        if decision is not None:
+            snippets, qvec = await grounded_snippets(cfg, sid, predicted or prev_state, user_text)
+        elif len(history) <= 1 and not prev_state:
+            snippets, qvec = [], await message_embedding(cfg, user_text)
+        else:
+            snippets, qvec = [], None
+        RETRIEVAL.inc(decision=decision or "skipped")
+        annotate(retrieval=decision or "skipped")
+        turn["grounded"] = decision is not None
+    elif cfg.policy.fast_path:
+        RETRIEVAL.inc(decision="eager")
+        snippets, qvec = await retrieve(cfg, user_text)
     else:
-        # fallback: whole thing to user, empty state
-        user_view = raw_text
-        state_json = {}
+        RETRIEVAL.inc(decision="eager")
+        (snippets, qvec), (history, prev_state) = await asyncio.gather(
+            retrieve(cfg, user_text),
+            asyncio.to_thread(load_turn, sid, user_text, 2),
+        )
+    # history already ends with this message
+    turn.update(snippets=snippets, qvec=qvec, prev_state=prev_state,
+                first_turn=len(history) <= 1 and not prev_state)
+
+    if predicted is not None:
+        turn.update(prompt=finalize_prompt(cfg, sid, snippets, predicted, user_text), predicted=predicted)
+        return turn
+
+    # Build prompt
+    prompt = build_prompt(
+        system_prompt=cfg.system_prompt,
+        safety_strings=cfg.safety,
+        slot_policy=cfg.slot_policy,
+        snippets=snippets,
+        history=history,
+        user_text=user_text,
+        prompt_cfg=cfg.llm_settings.get("prompt"),
+    )
+    report_prompt(sid, "turn", prompt)
+    turn["prompt"] = prompt
+    return turn
 
-    return user_view, state_json
+# ---------- Response cache ----------
+def cache_namespace(cfg: ConfigSnapshot) -> str:
+    # a config edit or a re-ingest invalidates every cached completion
+    return f"{cfg.version}:{searcher.corpus_version}"
+
+def semantic_bucket(turn: Dict[str, Any], prompt: Dict[str, Any]):
+    """
+    Near-duplicate reuse is limited to the first-pass prompt of a session's
+    first turn. The bucket holds the retrieved snippet ids and the facts the
+    answer's STATE_JSON is built from ("2 วัน" vs "3 วัน" must not share).
+    """
+    scfg = (turn["cfg"].llm_settings.get("response_cache") or {}).get("semantic") or {}
+    if (not scfg.get("enabled", False) or prompt is not turn["prompt"] or turn["predicted"] is not None
+            or not turn["first_turn"] or turn["qvec"] is None):
+        return None
+    ids = tuple(f"{sn['doc_id']}:{sn['snippet_id']}" for sn in turn["snippets"])
+    return ids, analyze(turn["user_text"]).facts()
+
+def cached_completion(turn: Dict[str, Any], prompt: Dict[str, Any]) -> Optional[str]:
+    """A cached completion for `prompt`, or None (the LLM must be called)."""
+    cfg = turn["cfg"]
+    rc = get_response_cache(cfg.llm_settings)
+    if rc is None or not turn["cacheable"]:
+        return None
+    ns = cache_namespace(cfg)
+    prompt["cache_key"] = prompt_key(hosted.model, hosted.temperature, prompt["system"], prompt["user"])
+    hit = rc.get(ns, prompt["cache_key"])
+    if hit is not None:
+        RESPONSE_CACHE.inc(result="exact_hit")
+        annotate(cache="exact_hit")
+        return hit
+    bucket = semantic_bucket(turn, prompt)
+    if bucket is not None:
+        min_sim = float(cfg.llm_settings["response_cache"]["semantic"].get("min_similarity", 0.97))
+        hit = rc.get_similar(ns, turn["qvec"], bucket, min_sim)
+        if hit is not None:
+            RESPONSE_CACHE.inc(result="semantic_hit")
+            annotate(cache="semantic_hit")
+            return hit
+    rc.miss()
+    RESPONSE_CACHE.inc(result="miss")
+    annotate(cache="miss")
+    return None
+
+def cache_completion(turn: Dict[str, Any], prompt: Dict[str, Any], completion: str) -> None:
+    # called only for completions that parsed; cached_completion() set the key
+    rc = get_response_cache(turn["cfg"].llm_settings)
+    if rc is None or not turn["cacheable"] or "cache_key" not in prompt:
+        return
+    bucket = semantic_bucket(turn, prompt)
+    rc.put(cache_namespace(turn["cfg"]), prompt["cache_key"], completion,
+           vec=turn["qvec"] if bucket is not None else None, bucket=bucket)
+
+def call_priority(turn: Dict[str, Any], prompt: Dict[str, Any]) -> str:
+    # a finalize prompt (predicted or second pass) jumps the scheduler queue
+    return "finalize" if prompt is not turn["prompt"] or turn["predicted"] is not None else "turn"
+
+async def complete(turn: Dict[str, Any], prompt: Dict[str, Any]) -> str:
+    priority = call_priority(turn, prompt)
+    with span("llm." + priority, prompt_tokens_est=prompt["tokens"]):
+        cached = cached_completion(turn, prompt)
+        if cached is not None:
+            return cached
+        return await hosted.achat(system=prompt["system"], user=prompt["user"], priority=priority)
+
+async def stream_completion(turn: Dict[str, Any], prompt: Dict[str, Any]):
+    # the span ends with the stream, so it includes the time the client takes to read it
+    priority = call_priority(turn, prompt)
+    with span("llm." + priority, prompt_tokens_est=prompt["tokens"], stream=True) as sp:
+        cached = cached_completion(turn, prompt)
+        if cached is not None:
+            yield cached
+            return
+        first = True
+        async for delta in hosted.astream(system=prompt["system"], user=prompt["user"], priority=priority):
+            if first:
+                sp.set(first_token_ms=round((time.perf_counter() - sp.t0) * 1000, 1))
+                first = False
+            yield delta
+
+async def degraded_turn(cfg: ConfigSnapshot, sid: str, turn: Dict[str, Any], user_text: str,
+                        err: ProviderUnavailable):
+    """
+    The model is unreachable: ask the next missing slot question (slots still
+    get the deterministic extraction), or, with nothing left to ask, send the
+    llm_timeout safety string. The turn is persisted like any other.
+    """
+    DEGRADED.inc(reason=err.reason)
+    log.warning("degraded reply session=%s: %s", sid, err)
+    user_view, state = enforce_state(turn["prev_state"], {}, cfg.policy, cfg.slot_questions,
+                                     cfg.safety["llm_timeout"], user_text)
+    await asyncio.to_thread(persist_turn, sid, user_text, user_view, state)
+    return user_view, state
+
+def needs_finalize(state_json: Dict[str, Any]) -> bool:
+    # required slots are complete but LLM didn't finalize
+    return bool(state_json.get("required_slots_filled") and not state_json.get("soap_ready"))
+
+def finalize_prompt(cfg: ConfigSnapshot, sid: str, snippets, state_json: Dict[str, Any], last_user_text: str = ""):
+    prompt = build_finalize_prompt(
+        system_prompt=cfg.system_prompt,
+        safety_strings=cfg.safety,
+        slot_policy=cfg.slot_policy,
+        snippets=snippets,
+        slots=state_json.get("slots", {}),
+        last_user_text=last_user_text,
+        prompt_cfg=cfg.llm_settings.get("prompt"),
+    )
+    return report_prompt(sid, "finalize", prompt)
+
+def merge_finalized(cfg: ConfigSnapshot, state_json: Dict[str, Any], state2: Dict[str, Any]) -> Dict[str, Any]:
+    # Safety net: if the second pass still didn't provide soap_json, we still stop asking
+    if not state2:
+        state2 = state_json
+    state2["soap_ready"] = True if state2.get("soap_json") else True
+    state2["required_slots_filled"] = True
+    # mark everything as asked so we never ask again
+    all_required = cfg.policy.intent(state2.get("intent", "")).required_set
+    state2["asked_slots"] = list(set(state2.get("asked_slots", [])) | all_required)
+    return state2
+
+async def finalize_snippets(turn: Dict[str, Any], sid: str, state_json: Dict[str, Any]):
+    """Snippets for the second (finalize) pass: the turn's own, or with lazy retrieval the slot state's."""
+    if not turn["lazy"]:
+        return turn["snippets"]
+    RETRIEVAL.inc(decision="second_pass")
+    snippets, _ = await grounded_snippets(turn["cfg"], sid, state_json, turn["user_text"])
+    return snippets
+
+def resolve_first_pass(turn: Dict[str, Any], user_view: str, state_json: Dict[str, Any], user_text: str):
+    """
+    Turn the first (possibly only) completion into (user_view, state, second_pass_needed).
+    A predicted finalize is accepted unless the model switched intent. A first
+    pass built without snippets that completes the slots always gets the
+    (grounded) finalize pass, even if the model finalized on its own.
+    """
+    cfg, predicted = turn["cfg"], turn["predicted"]
+    if predicted is not None:
+        new_intent = (state_json or {}).get("intent")
+        if not new_intent or new_intent in ("uncertain", predicted.get("intent")):
+            FINALIZE_PREDICTION.inc(outcome="hit")
+            merged = merge_states(predicted, state_json or {}, cfg.policy)
+            for k, v in (state_json or {}).items():
+                if k not in ("intent", "slots", "asked_slots"):
+                    merged[k] = v
+            return user_view, merge_finalized(cfg, merged, merged), False
+        FINALIZE_PREDICTION.inc(outcome="false_positive")
+
+    # Enforce + merge with previous state
+    user_view, state_json = enforce_state(
+        turn["prev_state"], state_json or {}, cfg.policy, cfg.slot_questions, user_view, user_text
+    )
+    second = needs_finalize(state_json) or bool(not turn["grounded"] and state_json.get("required_slots_filled"))
+    if second and predicted is None:
+        FINALIZE_PREDICTION.inc(outcome="false_negative")
+    return user_view, state_json, second
 
 # ---------- Routes ----------
+@app.on_event("shutdown")
+async def close_clients():
+    await aclose_async_openai()
+    await searcher.aclose()
+
+@app.exception_handler(Overloaded)
+async def overloaded(request: Request, exc: Overloaded):
+    return JSONResponse({"detail": "overloaded", "reason": exc.reason}, status_code=429,
+                        headers={"Retry-After": str(exc.retry_after_s)})
+
 @app.post("/chat/turn", response_model=ChatTurnResp)
-def chat_turn(req: ChatTurnReq):
+async def chat_turn(req: ChatTurnReq):
     user_text = (req.user_text or "").strip()
     if not user_text:
         raise HTTPException(400, "user_text required")
 
-    with SessionLocal() as db:
-        # ensure session
-        sid = req.session_id or f"temp_{datetime.utcnow().timestamp()}"
-        if not (db.query(SessionRec).filter(SessionRec.id == sid).first()):
-            db.add(SessionRec(id=sid, created_at=now_iso(), age_bucket="unknown", consent_flags="{}"))
-            db.commit()
-
-        # log user message
-        msg_user = Message(session_id=sid, role="user", text=user_text, state_json="{}", created_at=now_iso())
-        db.add(msg_user)
-        db.commit()
+    sid = req.session_id or f"temp_{datetime.utcnow().timestamp()}"
 
-        # Tier 0: deterministic red flags (no LLM if emergency)
-        rf = checker.detect(user_text)
-        if rf["is_emergency"]:
-            assistant_text = SAFETY["emergency_main"]
-            state = {
-                "intent": "emergency",
-                "required_slots_filled": False,
-                "missing_slots": [],
-                "slots": {},
-                "red_flag_detected": True,
-                "red_flag_label": rf["label"],
-                "citations": [],
-                "soap_ready": False,
-            }
-            # persist assistant + end
-            msg_ai = Message(
-                session_id=sid,
-                role="assistant",
-                text=assistant_text,
-                state_json=json.dumps(state),
-                created_at=now_iso(),
-            )
-            db.add(msg_ai)
-            db.commit()
-            return ChatTurnResp(assistant_text=assistant_text, state=state)
-
-        # RAG: search snippets
-        snippets = searcher.search(
-            user_text,
-            top_k=RAGCFG["search"]["k"],
-            min_score=RAGCFG["search"]["min_score"],
-            mmr=RAGCFG["search"]["mmr"],
-        )
+    # Tier 0: deterministic red flags (no LLM if emergency)
+    rf = red_flags(user_text)
+    if rf["is_emergency"]:
+        # in order with the session's other turns, but never refused
+        async with get_session_queue().hold(sid, urgent=True):
+            assistant_text, state = await emergency_turn(sid, user_text, rf)
+        return ChatTurnResp(assistant_text=assistant_text, state=state)
 
-        # Build prompt
-        history = get_recent_history(db, sid, max_turns=2)
-        prompt = build_prompt(
-            system_prompt=SYSTEM_PROMPT,
-            safety_strings=SAFETY,
-            slot_policy=SLOTS,
-            snippets=snippets,
-            history=history,
-            user_text=user_text,
-        )
+    # one turn at a time per session; a full queue answers 429 + Retry-After
+    async with get_session_queue().hold(sid):
+        cfg = begin_turn(sid)
+        turn = await prepare_turn(cfg, sid, user_text, rf)
+        try:
+            return await answer_turn(cfg, sid, turn, user_text)
+        except Overloaded:
+            raise   # refused, not failed: the client sends the message again
+        except Exception:
+            await keep_user_message(sid, user_text)
+            raise
+
+async def answer_turn(cfg: ConfigSnapshot, sid: str, turn: Dict[str, Any], user_text: str) -> ChatTurnResp:
+    """/chat/turn after prepare_turn; an exception here leaves the user message saved."""
+    if turn["fast"]:
+        user_view, state_json = turn["fast"]
+        await asyncio.to_thread(persist_turn, sid, user_text, user_view, state_json)
+        return ChatTurnResp(assistant_text=user_view, state=state_json)
+    prompt = turn["prompt"]
 
-        # LLM call
-        completion = hosted.chat(system=prompt["system"], user=prompt["user"])
-        user_view, state_json = parse_llm_output(completion)
+    # LLM call
+    try:
+        completion = await complete(turn, prompt)
+    except ProviderUnavailable as e:
+        user_view, state_json = await degraded_turn(cfg, sid, turn, user_text, e)
+        return ChatTurnResp(assistant_text=user_view, state=state_json)
+    user_view, state_json = parse_llm_output(completion)
+    if user_view:
+        cache_completion(turn, prompt, completion)
+    user_view, state_json, second_pass = resolve_first_pass(turn, user_view, state_json, user_text)
+
+    if not user_view:
+        raise HTTPException(500, "LLM output parse error")
+
+    # If required slots are complete but LLM didn't finalize (and it wasn't predicted), finalize now
+    if second_pass:
+        snippets = await finalize_snippets(turn, sid, state_json)
+        fin = finalize_prompt(cfg, sid, snippets, state_json, user_text)
+        try:
+            completion2 = await complete(turn, fin)
+        except (ProviderUnavailable, Overloaded) as e:
+            # keep the first answer; the next turn finalizes again (soap_ready is still false)
+            log.warning("finalize skipped session=%s: %s", sid, e)
+            completion2 = None
+        if completion2 is not None:
+            user_view2, state2 = parse_llm_output(completion2)
+            if user_view2:
+                cache_completion(turn, fin, completion2)
 
-        # Enforce + merge with previous state
-        prev_state = get_last_state(db, sid)
-        user_view, state_json = enforce_state(
-            prev_state, state_json or {}, SLOTS, QUESTIONS, user_view, user_text
-        )
+            # replace response with finalized one
+            user_view = user_view2 or user_view
+            state_json = merge_finalized(cfg, state_json, state2)
 
-        if not user_view:
-            raise HTTPException(500, "LLM output parse error")
-
-        # If required slots are complete but LLM didn't finalize, force a finalize pass
-        if state_json.get("required_slots_filled") and not state_json.get("soap_ready"):
-            fin = build_finalize_prompt(
-                system_prompt=SYSTEM_PROMPT,
-                safety_strings=SAFETY,
-                slot_policy=SLOTS,
-                snippets=snippets,
-                slots=state_json.get("slots", {}),
-            )
-            completion2 = hosted.chat(system=fin["system"], user=fin["user"])
-            user_view2, state2 = parse_llm_output(completion2)
+    # persist the whole turn (+ SOAP / citations)
+    await asyncio.to_thread(persist_turn, sid, user_text, user_view, state_json)
 
-            # Safety net: if the second pass still didn't provide soap_json, we still stop asking
-            if not state2:
-                state2 = state_json
-            state2["soap_ready"] = True if state2.get("soap_json") else True
-            state2["required_slots_filled"] = True
-            # mark everything as asked so we never ask again
-            intents_cfg = SLOTS.get("intents", {}).get(state2.get("intent", ""), {})
-            all_required = intents_cfg.get("required_slots", [])
-            state2["asked_slots"] = list(set(state2.get("asked_slots", []) + all_required))
+    return ChatTurnResp(assistant_text=user_view, state=state_json)
 
-            # replace response with finalized one
+def sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def turn_events(sid: str, user_text: str, rf: Dict[str, Any]):
+    """The SSE events of one non-emergency turn (the caller holds the session's turn)."""
+    cfg = begin_turn(sid)
+    turn = await prepare_turn(cfg, sid, user_text, rf)
+    try:
+        async for event in answer_events(cfg, sid, turn, user_text):
+            yield event
+    except Overloaded:
+        raise   # refused, not failed: the client sends the message again
+    except Exception:
+        await keep_user_message(sid, user_text)
+        raise
+
+async def answer_events(cfg: ConfigSnapshot, sid: str, turn: Dict[str, Any], user_text: str):
+    """turn_events after prepare_turn; an exception here leaves the user message saved."""
+    if turn["fast"]:
+        user_view, state_json = turn["fast"]
+        await asyncio.to_thread(persist_turn, sid, user_text, user_view, state_json)
+        yield sse("final", {"assistant_text": user_view, "state": state_json})
+        return
+    prompt = turn["prompt"]
+
+    parser, raw = StreamingOutputParser(), []
+    try:
+        async for delta in stream_completion(turn, prompt):
+            raw.append(delta)
+            text = parser.feed(delta)
+            if text:
+                yield sse("token", {"text": text})
+    except ProviderUnavailable as e:
+        user_view, state_json = await degraded_turn(cfg, sid, turn, user_text, e)
+        yield sse("replace", {"text": user_view, "reason": "degraded"})
+        yield sse("final", {"assistant_text": user_view, "state": state_json})
+        return
+    user_view, state_json = parser.close()
+    if user_view:
+        cache_completion(turn, prompt, "".join(raw))
+
+    llm_view = user_view
+    user_view, state_json, second_pass = resolve_first_pass(turn, user_view, state_json, user_text)
+    if not user_view:
+        await keep_user_message(sid, user_text)
+        yield sse("error", {"detail": "LLM output parse error"})
+        return
+    if user_view != llm_view:
+        yield sse("replace", {"text": user_view, "reason": "slot_question"})
+
+    if second_pass:
+        yield sse("replace", {"text": "", "reason": "finalize"})
+        snippets = await finalize_snippets(turn, sid, state_json)
+        fin = finalize_prompt(cfg, sid, snippets, state_json, user_text)
+        parser2, raw2 = StreamingOutputParser(), []
+        try:
+            async for delta in stream_completion(turn, fin):
+                raw2.append(delta)
+                text = parser2.feed(delta)
+                if text:
+                    yield sse("token", {"text": text})
+        except (ProviderUnavailable, Overloaded) as e:
+            # as in /chat/turn: keep the first answer, finalize again next turn
+            log.warning("finalize skipped session=%s: %s", sid, e)
+            yield sse("replace", {"text": user_view, "reason": "degraded"})
+        else:
+            user_view2, state2 = parser2.close()
+            if user_view2:
+                cache_completion(turn, fin, "".join(raw2))
             user_view = user_view2 or user_view
-            state_json = state2
-
-        # persist assistant
-        msg_ai = Message(
-            session_id=sid,
-            role="assistant",
-            text=user_view,
-            state_json=json.dumps(state_json, ensure_ascii=False),
-            created_at=now_iso(),
-        )
-        db.add(msg_ai)
-        db.commit()
+            state_json = merge_finalized(cfg, state_json, state2)
 
-        # persist SOAP + citations if present
-        if state_json.get("soap_ready") and state_json.get("soap_json"):
-            db.add(
-                SoapSummary(
-                    session_id=sid,
-                    soap_json=json.dumps(state_json["soap_json"], ensure_ascii=False),
-                    created_at=now_iso(),
-                )
-            )
-            db.commit()
-        if state_json.get("citations"):
-            for cit in state_json["citations"]:
-                db.add(
-                    Citation(
-                        session_id=sid,
-                        turn_id=msg_ai.id,
-                        doc_id=cit.get("doc_id", ""),
-                        snippet_ids=",".join(cit.get("snippet_ids", [])),
-                    )
-                )
-            db.commit()
+    await asyncio.to_thread(persist_turn, sid, user_text, user_view, state_json)
+    yield sse("final", {"assistant_text": user_view, "state": state_json})
 
-        return ChatTurnResp(assistant_text=user_view, state=state_json)
+@app.post("/chat/turn/stream")
+async def chat_turn_stream(req: ChatTurnReq):
+    """
+    Same pipeline as /chat/turn, streamed as server-sent events:
+      token   {"text"}            [USER_VIEW] text as the model produces it
+      replace {"text","reason"}   drop what was shown so far; reason = slot_question
+                                  (text is the question) | finalize (tokens follow) |
+                                  degraded (model unavailable; text is the fallback reply)
+      final   {"assistant_text","state"}  same shape as the /chat/turn response
+      error   {"detail"}            detail "overloaded" also carries "retry_after" (seconds)
+    A busy session is refused with 429 + Retry-After before the stream starts; a full
+    chat queue (checked once the turn is known to need the LLM) ends it with "overloaded".
+    """
+    user_text = (req.user_text or "").strip()
+    if not user_text:
+        raise HTTPException(400, "user_text required")
+
+    sid = req.session_id or f"temp_{datetime.utcnow().timestamp()}"
+    rf = red_flags(user_text)
+    if not rf["is_emergency"]:
+        get_session_queue().admit(sid)
+
+    async def events():
+        if rf["is_emergency"]:
+            async with get_session_queue().hold(sid, urgent=True):
+                assistant_text, state = await emergency_turn(sid, user_text, rf)
+            yield sse("final", {"assistant_text": assistant_text, "state": state})
+            return
+
+        try:
+            async with get_session_queue().hold(sid):
+                async for event in turn_events(sid, user_text, rf):
+                    yield event
+        except Overloaded as e:
+            yield sse("error", {"detail": "overloaded", "reason": e.reason, "retry_after": e.retry_after_s})
+        except Exception as e:
+            yield sse("error", {"detail": str(e) or e.__class__.__name__})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
 
 class ReindexReq(BaseModel):
-    force: bool = True
+    force: bool = False  # True = re-embed every chunk, not just changed ones
 
 @app.post("/rag/reindex")
-def reindex(_: ReindexReq):
-    ok = searcher.ingest_all()
-    return {"indexed_docs": ok["docs"], "chunks": ok["chunks"]}
+def reindex(req: ReindexReq):
+    ok = searcher.ingest_all(force=req.force)
+    return {
+        "indexed_docs": ok["docs"], "chunks": ok["chunks"],
+        "added": ok["added"], "updated": ok["updated"],
+        "deleted": ok["deleted"], "skipped": ok["skipped"],
+        "throughput": ok["throughput"],
+    }
+
+def last_message_id(db, session_id: str) -> int:
+    row = db.get(SessionState, session_id)
+    if row is not None and row.last_message_id:
+        return row.last_message_id
+    return db.query(func.max(Message.id)).filter(Message.session_id == session_id).scalar() or 0
 
 @app.get("/session/{session_id}/transcript")
-def transcript(session_id: str):
+def transcript(
+    session_id: str,
+    request: Request,
+    after_id: int = Query(0, ge=0),
+    limit: int = Query(200, ge=1, le=1000),
+    include_state: bool = True,
+):
+    """
+    Messages with id > after_id, oldest first, at most `limit` of them; SOAP
+    summaries and citations are those of the returned turns. Poll with
+    after_id=next_after_id. The ETag names the session's last message (not the
+    page), so a client that has read up to it gets 304 for whatever cursor it
+    polls with, without loading anything.
+    """
     with SessionLocal() as db:
+        last_id = last_message_id(db, session_id)
+        etag = f'W/"{session_id}:{last_id}:{int(include_state)}"'
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+
         msgs = (
             db.query(Message)
-            .filter(Message.session_id == session_id)
-            .order_by(Message.created_at.asc())
+            .filter(Message.session_id == session_id, Message.id > after_id)
+            .order_by(Message.id.asc())
+            .limit(limit + 1)
             .all()
         )
+        has_more = len(msgs) > limit
+        msgs = msgs[:limit]
         out = []
         for m in msgs:
-            try:
-                st = json.loads(m.state_json) if m.state_json else {}
-            except Exception:
-                st = {}
-            out.append({
+            item = {
+                "id": m.id,
                 "role": m.role,
                 "text": m.text,                 # ของเดิม (คงไว้)
                 "content_th": m.text,           # alias สำหรับ FE
                 "ts": m.created_at,             # alias สำหรับ FE
-                "state": st,                    # ของเดิม (คงไว้)
-            })
-
-        soaps = (
-            db.query(SoapSummary)
-            .filter(SoapSummary.session_id == session_id)
-            .order_by(SoapSummary.created_at.asc())
-            .all()
-        )
-        cites = (
-            db.query(Citation)
-            .filter(Citation.session_id == session_id)
-            .order_by(Citation.turn_id.asc())
-            .all()
-        )
-        return {
+            }
+            if include_state:
+                try:
+                    item["state"] = json.loads(m.state_json) if m.state_json else {}   # ของเดิม (คงไว้)
+                except Exception:
+                    item["state"] = {}
+            out.append(item)
+        next_after_id = msgs[-1].id if msgs else after_id
+
+        soaps = db.query(SoapSummary).filter(SoapSummary.session_id == session_id)
+        cites = db.query(Citation).filter(Citation.session_id == session_id, Citation.turn_id > after_id)
+        if after_id:
+            prev = db.get(Message, after_id)
+            if prev is not None:
+                soaps = soaps.filter(SoapSummary.created_at > prev.created_at)
+        if has_more:
+            soaps = soaps.filter(SoapSummary.created_at <= msgs[-1].created_at)
+            cites = cites.filter(Citation.turn_id <= next_after_id)
+        soaps = soaps.order_by(SoapSummary.created_at.asc()).all()
+        cites = cites.order_by(Citation.turn_id.asc()).all()
+
+        body = {
             "session_id": session_id,
             "messages": out,
             "soap_summaries": [json.loads(s.soap_json) for s in soaps],
@@ -322,42 +743,12 @@ def transcript(session_id: str):
                 }
                 for c in cites
             ],
+            "next_after_id": next_after_id,
+            "has_more": has_more,
+            "last_message_id": last_id,
         }
+        return JSONResponse(body, headers={"ETag": etag})
 
-    with SessionLocal() as db:
-        msgs = (
-            db.query(Message)
-            .filter(Message.session_id == session_id)
-            .order_by(Message.created_at.asc())
-            .all()
-        )
-        out = [{"role": m.role, "text": m.text, "state": json.loads(m.state_json)} for m in msgs]
-        soaps = (
-            db.query(SoapSummary)
-            .filter(SoapSummary.session_id == session_id)
-            .order_by(SoapSummary.created_at.asc())
-            .all()
-        )
-        cites = (
-            db.query(Citation)
-            .filter(Citation.session_id == session_id)
-            .order_by(Citation.turn_id.asc())
-            .all()
-        )
-        return {
-            "session_id": session_id,
-            "messages": out,
-            "soap_summaries": [json.loads(s.soap_json) for s in soaps],
-            "citations": [
-                {
-                    "turn_id": c.turn_id,
-                    "doc_id": c.doc_id,
-                    "snippet_ids": c.snippet_ids.split(",") if c.snippet_ids else [],
-                }
-                for c in cites
-            ],
-        }
-    
 @app.post("/session", response_model=CreateSessionResp)
 def create_session(req: CreateSessionReq):
     sid = f"sess_{uuid.uuid4().hex[:12]}"
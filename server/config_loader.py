@@ -1,28 +1,248 @@
+import contextlib
 import os
+import hashlib
+import threading
+import time
+import logging
+from typing import Any, Callable, Dict, Tuple
 import yaml
 
 ROOT = os.path.dirname(__file__)
-CFG_DIR = os.path.join(ROOT, "config")
+CFG_DIR = os.environ.get("CONFIG_DIR") or os.path.join(ROOT, "config")
+CHECK_INTERVAL_S = float(os.environ.get("CONFIG_CHECK_INTERVAL_S", "1.0"))
 
-def _read(path: str) -> str:
-    with open(path, "r", encoding="utf-8") as f:
-        return f.read()
+log = logging.getLogger(__name__)
+
+class ConfigError(ValueError):
+    pass
+
+# ---------- immutable containers ----------
+# dict/list subclasses so json.dumps, isinstance checks and `list + cfg_list` keep working
+
+def _readonly(*_a, **_kw):
+    raise TypeError("config objects are read-only")
+
+class FrozenDict(dict):
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+    __ior__ = _readonly
+
+class FrozenList(list):
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _readonly
+    append = extend = insert = pop = remove = clear = sort = reverse = _readonly
+
+def freeze(obj: Any) -> Any:
+    if isinstance(obj, dict):
+        return FrozenDict((k, freeze(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return FrozenList(freeze(v) for v in obj)
+    return obj
+
+# ---------- validation ----------
+def _need(cfg: Any, path: str, typ=None, name: str = "") -> Any:
+    cur = cfg
+    for part in path.split("."):
+        if not isinstance(cur, dict) or part not in cur:
+            raise ConfigError(f"{name}: missing '{path}'")
+        cur = cur[part]
+    if typ is not None and not isinstance(cur, typ):
+        raise ConfigError(f"{name}: '{path}' must be {getattr(typ, '__name__', typ)}")
+    return cur
+
+def _check_system_prompt(text: str) -> None:
+    if not text.strip():
+        raise ConfigError("system_prompt_th.txt: empty")
+
+def _check_slot_policy(cfg: Dict[str, Any]) -> None:
+    name = "slot_policy.yaml"
+    intents = _need(cfg, "intents", dict, name)
+    for key, it in intents.items():
+        _need(it, "required_slots", list, f"{name}: intents.{key}")
+        if not isinstance(it.get("ask_order", []), list):
+            raise ConfigError(f"{name}: intents.{key}: 'ask_order' must be list")
+
+def _check_safety(cfg: Dict[str, Any]) -> None:
+    _need(cfg, "emergency_main", str, "safety_strings.yaml")
+
+def _check_rag_settings(cfg: Dict[str, Any]) -> None:
+    name = "rag_settings.yaml"
+    _need(cfg, "embeddings.model", str, name)
+    _need(cfg, "embeddings.dimension", int, name)
+    _need(cfg, "search.k", int, name)
+    _need(cfg, "search.min_score", (int, float), name)
+    mode = cfg["search"].get("mode", "vector")
+    if mode not in ("vector", "hybrid", "lexical"):
+        raise ConfigError(f"{name}: search.mode must be vector, hybrid or lexical, got {mode!r}")
+
+def _check_slot_questions(cfg: Dict[str, Any]) -> None:
+    if not isinstance(cfg, dict):
+        raise ConfigError("slot_questions_th.yaml: must be a mapping of intent -> slot -> question")
+
+def _check_llm_settings(cfg: Dict[str, Any]) -> None:
+    _need(cfg, "chat.model", str, "llm_settings.yaml")
+
+def _check_thai_lexicon(cfg: Dict[str, Any]) -> None:
+    name = "thai_lexicon.yaml"
+    _need(cfg, "symptoms", dict, name)
+    _need(cfg, "numbers.digits", dict, name)
+    _need(cfg, "duration_units", dict, name)
+
+def _parse_text(raw: bytes) -> str:
+    return raw.decode("utf-8")
+
+def _parse_yaml(raw: bytes) -> Any:
+    return yaml.safe_load(raw.decode("utf-8"))
+
+# name -> (file, parser, validator)
+FILES: Dict[str, Tuple[str, Callable[[bytes], Any], Callable[[Any], None]]] = {
+    "system_prompt": ("system_prompt_th.txt", _parse_text, _check_system_prompt),
+    "slot_policy": ("slot_policy.yaml", _parse_yaml, _check_slot_policy),
+    "safety": ("safety_strings.yaml", _parse_yaml, _check_safety),
+    "rag_settings": ("rag_settings.yaml", _parse_yaml, _check_rag_settings),
+    "slot_questions": ("slot_questions_th.yaml", _parse_yaml, _check_slot_questions),
+    "llm_settings": ("llm_settings.yaml", _parse_yaml, _check_llm_settings),
+    "thai_lexicon": ("thai_lexicon.yaml", _parse_yaml, _check_thai_lexicon),
+}
+
+def _compile_slot_policy(values: Dict[str, Any]) -> Any:
+    from server.orchestrator.slot_policy import compile_slot_policy
+    return compile_slot_policy(values["slot_policy"])
+
+def _compile_analyzer(values: Dict[str, Any]) -> Any:
+    from server.text.thai_analyzer import ThaiAnalyzer
+    return ThaiAnalyzer(values["thai_lexicon"])
+
+# snapshot name -> builder over the parsed files; runs at load so errors surface there
+DERIVED: Dict[str, Callable[[Dict[str, Any]], Any]] = {
+    "policy": _compile_slot_policy,
+    "analyzer": _compile_analyzer,
+}
+
+@contextlib.contextmanager
+def _as_config_error(what: str):
+    # checks and builders index into hand-edited YAML; a wrong shape (a list
+    # where a mapping belongs, a string for a number) fails as TypeError etc.
+    try:
+        yield
+    except (ConfigError, yaml.YAMLError):
+        raise
+    except Exception as e:
+        raise ConfigError(f"{what}: {e.__class__.__name__}: {e}") from e
+
+# ---------- registry ----------
+class ConfigSnapshot:
+    """One consistent, read-only view of every config file; `version` hashes their contents."""
+    __slots__ = ("version", "_values")
+
+    def __init__(self, version: str, values: Dict[str, Any]):
+        object.__setattr__(self, "version", version)
+        object.__setattr__(self, "_values", values)
+
+    def __getattr__(self, name: str) -> Any:
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __setattr__(self, name, value):
+        _readonly()
+
+class ConfigRegistry:
+    """
+    Parses each config file once, validates it and hands out frozen objects.
+    At most every `check_interval` seconds a read stats the files; if any mtime
+    or size changed, all files are re-read and validated and the snapshot is
+    swapped in one assignment. A file that fails validation keeps the previous
+    snapshot serving (and logs a warning) until it is fixed.
+    """
+    def __init__(self, cfg_dir: str = CFG_DIR, check_interval: float = CHECK_INTERVAL_S):
+        self.cfg_dir = cfg_dir
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._stamps = None
+        self._next_check = 0.0
+        self._snap = None
+        self.reload(strict=True)
+
+    def _stat(self) -> Tuple[Tuple[str, int, int], ...]:
+        out = []
+        for name, (fname, _, _) in FILES.items():
+            st = os.stat(os.path.join(self.cfg_dir, fname))
+            out.append((name, st.st_mtime_ns, st.st_size))
+        return tuple(out)
+
+    def _build(self) -> ConfigSnapshot:
+        h = hashlib.sha256()
+        values = {}
+        for name, (fname, parse, check) in FILES.items():
+            with open(os.path.join(self.cfg_dir, fname), "rb") as f:
+                raw = f.read()
+            h.update(fname.encode() + b"\0" + raw + b"\0")
+            with _as_config_error(fname):
+                value = parse(raw)
+                check(value)
+            values[name] = freeze(value)
+        for name, build in DERIVED.items():
+            with _as_config_error(name):
+                values[name] = build(values)
+        return ConfigSnapshot(h.hexdigest()[:12], values)
+
+    def reload(self, strict: bool = False) -> bool:
+        """Re-read all files if they changed on disk. -> True when a new snapshot was installed."""
+        with self._lock:
+            self._next_check = time.monotonic() + self.check_interval
+            try:
+                stamps = self._stat()
+                if stamps == self._stamps:
+                    return False
+                snap = self._build()
+            except (OSError, yaml.YAMLError, ConfigError) as e:
+                if strict or self._snap is None:
+                    raise
+                log.warning("config reload failed, keeping version %s: %s", self._snap.version, e)
+                return False
+            self._stamps = stamps
+            self._snap = snap
+            log.info("config version %s loaded", snap.version)
+            return True
+
+    def snapshot(self) -> ConfigSnapshot:
+        if time.monotonic() >= self._next_check:
+            self.reload()
+        return self._snap
+
+    @property
+    def version(self) -> str:
+        return self.snapshot().version
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_registry() -> ConfigRegistry:
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = ConfigRegistry()
+    return _registry
+
+def config_snapshot() -> ConfigSnapshot:
+    return get_registry().snapshot()
 
 def load_system_prompt() -> str:
-    return _read(os.path.join(CFG_DIR, "system_prompt_th.txt"))
+    return config_snapshot().system_prompt
 
 def load_slot_policy() -> dict:
-    with open(os.path.join(CFG_DIR, "slot_policy.yaml"), "r", encoding="utf-8") as f:
-        return yaml.safe_load(f)
+    return config_snapshot().slot_policy
 
 def load_safety() -> dict:
-    with open(os.path.join(CFG_DIR, "safety_strings.yaml"), "r", encoding="utf-8") as f:
-        return yaml.safe_load(f)
+    return config_snapshot().safety
 
 def load_rag_settings() -> dict:
-    with open(os.path.join(CFG_DIR, "rag_settings.yaml"), "r", encoding="utf-8") as f:
-        return yaml.safe_load(f)
+    return config_snapshot().rag_settings
 
 def load_slot_questions() -> dict:
-    with open(os.path.join(CFG_DIR, "slot_questions_th.yaml"), "r", encoding="utf-8") as f:
-        return yaml.safe_load(f)
+    return config_snapshot().slot_questions
+
+def load_llm_settings() -> dict:
+    return config_snapshot().llm_settings
@@ -1,21 +1,142 @@
 import os
-from typing import List, Dict, Any
-from openai import OpenAI
+import asyncio
+from typing import List, Dict, Any, AsyncIterator
+import httpx
+from openai import OpenAI, AsyncOpenAI
 from dotenv import load_dotenv
 load_dotenv()
 
+from server.config_loader import load_llm_settings
+from server.metrics import counter, histogram
+from server.llm.resilience import get_caller, remaining, ProviderUnavailable, TRANSIENT
+from server.llm.scheduler import get_scheduler
+from server.tracing import annotate
+
+LLM_PROMPT_TOKENS = counter("aidgent_llm_prompt_tokens_total", "Prompt tokens reported by the provider")
+LLM_CACHED_TOKENS = counter("aidgent_llm_cached_prompt_tokens_total", "Prompt tokens the provider served from its prompt cache")
+LLM_COMPLETION_TOKENS = counter("aidgent_llm_completion_tokens_total", "Completion tokens reported by the provider")
+LLM_CALL_TOKENS = histogram("aidgent_llm_call_tokens", "Tokens per LLM call (prompt | completion)", ["type"],
+                            buckets=(64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384))
+
+def record_usage(usage) -> None:
+    if usage is None:
+        return
+    prompt = getattr(usage, "prompt_tokens", 0) or 0
+    completion = getattr(usage, "completion_tokens", 0) or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", 0) or 0
+    LLM_PROMPT_TOKENS.inc(prompt)
+    LLM_COMPLETION_TOKENS.inc(completion)
+    LLM_CACHED_TOKENS.inc(cached)
+    LLM_CALL_TOKENS.observe(prompt, type="prompt")
+    LLM_CALL_TOKENS.observe(completion, type="completion")
+    annotate(prompt_tokens=prompt, completion_tokens=completion, cached_tokens=cached)
+
+_aclient = None
+
+def get_async_openai() -> AsyncOpenAI:
+    # one pooled HTTP/1.1 keep-alive client shared by chat + embeddings on the event loop
+    global _aclient
+    if _aclient is None:
+        http = load_llm_settings().get("http", {})
+        limits = httpx.Limits(
+            max_connections=http.get("max_connections", 100),
+            max_keepalive_connections=http.get("max_keepalive_connections", 20),
+            keepalive_expiry=http.get("keepalive_expiry_s", 30),
+        )
+        _aclient = AsyncOpenAI(
+            api_key=os.environ.get("OPENAI_API_KEY"),
+            http_client=httpx.AsyncClient(limits=limits),
+            max_retries=0,   # retries, timeouts and hedging live in server/llm/resilience.py
+        )
+    return _aclient
+
+async def aclose_async_openai() -> None:
+    global _aclient
+    if _aclient is not None:
+        await _aclient.close()
+        _aclient = None
+
 class HostedModel:
-    def __init__(self):
-        self.client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-        self.model = "gpt-4o-mini"
+    def __init__(self, cfg: Dict[str, Any] = None):
+        # without an explicit cfg, model/temperature follow llm_settings.yaml edits
+        self.cfg = cfg
+        self.client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"), max_retries=0)
+
+    @property
+    def model(self) -> str:
+        return (self.cfg or load_llm_settings())["chat"]["model"]
 
+    @property
+    def temperature(self) -> float:
+        return (self.cfg or load_llm_settings())["chat"].get("temperature", 0.2)
+
+    def _messages(self, system: str, user: str) -> List[Dict[str, str]]:
+        return [
+            {"role": "system", "content": system},
+            {"role": "user", "content": user}
+        ]
+
+    # All three raise ProviderUnavailable when the provider cannot answer in time.
     def chat(self, system: str, user: str) -> str:
-        resp = self.client.chat.completions.create(
+        resp = get_caller("chat").call_sync(lambda timeout: self.client.chat.completions.create(
             model=self.model,
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": user}
-            ],
-            temperature=0.2
-        )
+            messages=self._messages(system, user),
+            temperature=self.temperature,
+            timeout=timeout,
+        ))
+        record_usage(getattr(resp, "usage", None))
+        return resp.choices[0].message.content
+
+    async def achat(self, system: str, user: str, priority: str = "turn") -> str:
+        async with get_scheduler("chat").slot(priority):
+            resp = await get_caller("chat").call(lambda timeout: get_async_openai().chat.completions.create(
+                model=self.model,
+                messages=self._messages(system, user),
+                temperature=self.temperature,
+                timeout=timeout,
+            ))
+        record_usage(getattr(resp, "usage", None))
         return resp.choices[0].message.content
+
+    async def astream(self, system: str, user: str, priority: str = "turn") -> AsyncIterator[str]:
+        # the scheduler slot is held until the stream ends or its consumer stops
+        async with get_scheduler("chat").slot(priority):
+            async for delta in self._astream(system, user):
+                yield delta
+
+    async def _astream(self, system: str, user: str) -> AsyncIterator[str]:
+        caller = get_caller("chat")
+
+        async def open_stream(timeout: float):
+            # an attempt lasts until the first chunk, so a stalled stream is retried too
+            stream = await get_async_openai().chat.completions.create(
+                model=self.model,
+                messages=self._messages(system, user),
+                temperature=self.temperature,
+                stream=True,
+                stream_options={"include_usage": True},   # usage arrives on a final chunk with no choices
+                timeout=timeout,
+            )
+            it = stream.__aiter__()
+            try:
+                return it, await it.__anext__()
+            except StopAsyncIteration:
+                return it, None
+
+        # no hedging: the losing stream could not be closed cleanly
+        it, chunk = await caller.call(open_stream, hedge=False)
+        while chunk is not None:
+            record_usage(getattr(chunk, "usage", None))
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            # after the first token there is no retry; a stall past the budget ends the turn
+            left = remaining()
+            try:
+                chunk = await asyncio.wait_for(it.__anext__(), min(caller.attempt_timeout_s, left)
+                                               if left is not None else caller.attempt_timeout_s)
+            except StopAsyncIteration:
+                break
+            except TRANSIENT as e:
+                caller.breaker.failure()
+                raise ProviderUnavailable("chat", "stream_interrupted", repr(e)) from e
@@ -0,0 +1,283 @@
+import asyncio, contextvars, random, threading, time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+
+import httpx
+import openai
+
+from server.config_loader import load_llm_settings
+from server.metrics import counter
+
+T = TypeVar("T")
+
+PROVIDER_CALLS = counter("aidgent_provider_calls_total",
+                         "Provider calls by api and outcome (ok | retry | hedge | failed | rejected)",
+                         ["api", "outcome"])
+
+class RetryableStatus(RuntimeError):
+    """A provider reached over plain HTTP (no SDK error types) answered 429 or 5xx."""
+    def __init__(self, status: int):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+
+# errors worth another attempt; anything else (bad request, auth) is raised as is
+TRANSIENT = (
+    openai.APIConnectionError,      # includes APITimeoutError
+    openai.RateLimitError,
+    openai.InternalServerError,
+    httpx.TransportError,
+    RetryableStatus,
+    asyncio.TimeoutError,
+)
+
+class ProviderUnavailable(RuntimeError):
+    """A provider call gave up: circuit open, request budget spent or retries exhausted."""
+    def __init__(self, api: str, reason: str, detail: str = ""):
+        super().__init__(f"{api}: {reason}" + (f" ({detail})" if detail else ""))
+        self.api = api
+        self.reason = reason    # circuit_open | deadline | exhausted | stream_interrupted
+
+# ---------- request budget ----------
+# One deadline per request, carried in a context variable so every provider
+# call made while serving it (including from asyncio.to_thread) shares it.
+_deadline: "contextvars.ContextVar[Optional[float]]" = contextvars.ContextVar("provider_deadline", default=None)
+
+def start_budget(seconds: float) -> None:
+    _deadline.set(time.monotonic() + seconds if seconds and seconds > 0 else None)
+
+def remaining() -> Optional[float]:
+    d = _deadline.get()
+    return None if d is None else d - time.monotonic()
+
+# ---------- circuit breaker ----------
+class CircuitBreaker:
+    """
+    closed -> open after `failure_threshold` consecutive failed calls. After
+    `open_s` one probe call is let through (half-open); its outcome closes the
+    circuit or opens it for another `open_s`.
+    """
+    def __init__(self, failure_threshold: int = 5, open_s: float = 20.0):
+        self.failure_threshold = failure_threshold
+        self.open_s = open_s
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        return "half_open" if self._probing or time.monotonic() - self._opened_at >= self.open_s else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if not self._probing and time.monotonic() - self._opened_at >= self.open_s:
+                self._probing = True
+                return True
+            return False
+
+    def success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def abandon(self) -> None:
+        # a call cancelled by its client says nothing about the provider
+        with self._lock:
+            self._probing = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+class LatencyWindow:
+    """Recent successful call latencies, for the hedging delay."""
+    def __init__(self, size: int = 200):
+        self._values = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self._values.append(seconds)
+
+    def quantile(self, q: float, min_samples: int) -> Optional[float]:
+        with self._lock:
+            values = sorted(self._values)
+        if len(values) < max(1, min_samples):
+            return None
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+# ---------- caller ----------
+class ResilientCaller:
+    """
+    Wraps provider calls of one api ("chat" | "embeddings"). `fn(timeout)`
+    makes one attempt; the caller bounds each attempt by attempt_timeout_s and
+    the request budget, retries transient errors with full-jitter backoff and,
+    when hedging is on, starts a second identical request once the first has
+    run longer than the recent p95 -- whichever answers first wins.
+    Settings come from `resilience:` in llm_settings.yaml.
+    """
+    def __init__(self, api: str):
+        self.api = api
+        self.breaker = CircuitBreaker()
+        self.latency = LatencyWindow()
+        self._settings = None
+        self.configure({})
+
+    def configure(self, settings: Dict[str, Any]) -> None:
+        if settings is self._settings:
+            return
+        own = settings.get(self.api) or {}
+        retry = settings.get("retry") or {}
+        hedge = settings.get("hedge") or {}
+        breaker = settings.get("breaker") or {}
+        self.attempt_timeout_s = float(own.get("attempt_timeout_s", 30))
+        self.max_attempts = max(1, int(own.get("max_attempts", 2)))
+        self.hedge = bool(own.get("hedge", False))
+        self.backoff_base_s = float(retry.get("base_s", 0.2))
+        self.backoff_cap_s = float(retry.get("cap_s", 2.0))
+        self.hedge_quantile = float(hedge.get("quantile", 0.95))
+        self.hedge_min_delay_s = float(hedge.get("min_delay_s", 0.3))
+        self.hedge_min_samples = int(hedge.get("min_samples", 20))
+        self.breaker.failure_threshold = int(breaker.get("failure_threshold", 5))
+        self.breaker.open_s = float(breaker.get("open_s", 20))
+        self._settings = settings
+
+    def _timeout(self) -> float:
+        left = remaining()
+        return self.attempt_timeout_s if left is None else min(self.attempt_timeout_s, left)
+
+    def _backoff(self, attempt: int) -> Optional[float]:
+        delay = random.uniform(0, min(self.backoff_cap_s, self.backoff_base_s * 2 ** (attempt - 1)))
+        left = remaining()
+        return None if left is not None and delay >= left else delay
+
+    def _hedge_delay(self) -> Optional[float]:
+        if not self.hedge:
+            return None
+        p = self.latency.quantile(self.hedge_quantile, self.hedge_min_samples)
+        return None if p is None else max(self.hedge_min_delay_s, p)
+
+    async def call(self, fn: Callable[[float], Awaitable[T]], hedge: bool = True) -> T:
+        if not self.breaker.allow():
+            PROVIDER_CALLS.inc(api=self.api, outcome="rejected")
+            raise ProviderUnavailable(self.api, "circuit_open")
+        attempt, last, reason = 0, None, "exhausted"
+        while True:
+            timeout = self._timeout()
+            if timeout <= 0:
+                reason = "deadline"
+                break
+            try:
+                result = await self._attempt(fn, timeout, hedge)
+            except TRANSIENT as e:
+                last = e
+            except asyncio.CancelledError:
+                self.breaker.abandon()
+                raise
+            except Exception:
+                self.breaker.success()      # the provider answered, just not with a result
+                raise
+            else:
+                self.breaker.success()
+                PROVIDER_CALLS.inc(api=self.api, outcome="ok")
+                return result
+            attempt += 1
+            if attempt >= self.max_attempts:
+                break
+            delay = self._backoff(attempt)
+            if delay is None:
+                reason = "deadline"
+                break
+            PROVIDER_CALLS.inc(api=self.api, outcome="retry")
+            await asyncio.sleep(delay)
+        self.breaker.failure()
+        PROVIDER_CALLS.inc(api=self.api, outcome="failed")
+        raise ProviderUnavailable(self.api, reason, repr(last) if last else "") from last
+
+    async def _attempt(self, fn: Callable[[float], Awaitable[T]], timeout: float, hedge: bool) -> T:
+        t0 = time.monotonic()
+        hedge_after = self._hedge_delay() if hedge else None
+        if hedge_after is None or hedge_after >= timeout:
+            result = await asyncio.wait_for(fn(timeout), timeout)
+            self.latency.add(time.monotonic() - t0)
+            return result
+
+        tasks = {asyncio.ensure_future(fn(timeout))}
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+        if not done:
+            PROVIDER_CALLS.inc(api=self.api, outcome="hedge")
+            tasks.add(asyncio.ensure_future(fn(timeout - hedge_after)))
+        err: BaseException = asyncio.TimeoutError()
+        try:
+            while tasks:
+                done, _ = await asyncio.wait(tasks, timeout=max(0.0, t0 + timeout - time.monotonic()),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise asyncio.TimeoutError()
+                for task in done:
+                    tasks.discard(task)
+                    if task.exception() is None:
+                        self.latency.add(time.monotonic() - t0)
+                        return task.result()
+                    err = task.exception()
+            raise err
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def call_sync(self, fn: Callable[[float], T]) -> T:
+        """Blocking variant (ingest, sync clients): timeouts, retries and the breaker, no hedging."""
+        if not self.breaker.allow():
+            PROVIDER_CALLS.inc(api=self.api, outcome="rejected")
+            raise ProviderUnavailable(self.api, "circuit_open")
+        attempt, last, reason = 0, None, "exhausted"
+        while True:
+            timeout = self._timeout()
+            if timeout <= 0:
+                reason = "deadline"
+                break
+            t0 = time.monotonic()
+            try:
+                result = fn(timeout)
+            except TRANSIENT as e:
+                last = e
+            except Exception:
+                self.breaker.success()
+                raise
+            else:
+                self.latency.add(time.monotonic() - t0)
+                self.breaker.success()
+                PROVIDER_CALLS.inc(api=self.api, outcome="ok")
+                return result
+            attempt += 1
+            if attempt >= self.max_attempts:
+                break
+            delay = self._backoff(attempt)
+            if delay is None:
+                reason = "deadline"
+                break
+            PROVIDER_CALLS.inc(api=self.api, outcome="retry")
+            time.sleep(delay)
+        self.breaker.failure()
+        PROVIDER_CALLS.inc(api=self.api, outcome="failed")
+        raise ProviderUnavailable(self.api, reason, repr(last) if last else "") from last
+
+_callers: Dict[str, ResilientCaller] = {}
+_callers_lock = threading.Lock()
+
+def get_caller(api: str) -> ResilientCaller:
+    """Process-wide caller per api; follows edits to llm_settings.yaml."""
+    c = _callers.get(api)
+    if c is None:
+        with _callers_lock:
+            c = _callers.setdefault(api, ResilientCaller(api))
+    c.configure(load_llm_settings().get("resilience") or {})
+    return c
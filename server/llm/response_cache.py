@@ -0,0 +1,148 @@
+import hashlib, threading, time
+import numpy as np
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Sequence
+
+def prompt_key(model: str, temperature: float, system: str, user: str) -> str:
+    h = hashlib.sha256()
+    for part in (model, repr(float(temperature)), system, user):
+        h.update(part.encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+class ResponseCache:
+    """
+    In-process cache of LLM completions, two tiers:
+      exact     prompt hash -> completion
+      semantic  first turns only: a completion is reused for a query whose
+                embedding is within `min_similarity` (cosine) of a cached one,
+                but only inside the same bucket, i.e. same retrieved snippet
+                ids and same caller-supplied facts (numbers, symptoms, ...)
+    Entries expire after `ttl_s`. Both tiers are LRU-bounded. Everything is
+    scoped to a namespace (config version + corpus version); a new namespace
+    empties the cache.
+    """
+    def __init__(self, max_items: int = 2048, ttl_s: float = 3600.0, semantic_max_items: int = 512):
+        self.max_items = max_items
+        self.ttl_s = ttl_s
+        self.semantic_max_items = semantic_max_items
+        self._exact: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+        # key -> (expires, bucket, unit vector, completion); buckets index the keys
+        self._sem: "OrderedDict[str, tuple[float, Hashable, np.ndarray, str]]" = OrderedDict()
+        self._buckets: Dict[Hashable, Dict[str, None]] = {}
+        self._ns: Optional[str] = None
+        self._lock = threading.Lock()
+        self.stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "stores": 0,
+                      "evictions": 0, "expired": 0, "invalidations": 0}
+
+    def _namespace(self, ns: str) -> None:
+        if ns != self._ns:
+            if self._ns is not None:
+                self.stats["invalidations"] += 1
+            self._exact.clear()
+            self._sem.clear()
+            self._buckets.clear()
+            self._ns = ns
+
+    def _sem_drop(self, key: str) -> None:
+        _, bucket, _, _ = self._sem.pop(key)
+        keys = self._buckets.get(bucket)
+        if keys is not None:
+            keys.pop(key, None)
+            if not keys:
+                del self._buckets[bucket]
+
+    def get(self, ns: str, key: str) -> Optional[str]:
+        now = time.monotonic()
+        with self._lock:
+            self._namespace(ns)
+            hit = self._exact.get(key)
+            if hit is not None:
+                if hit[0] > now:
+                    self._exact.move_to_end(key)
+                    self.stats["exact_hits"] += 1
+                    return hit[1]
+                del self._exact[key]
+                self.stats["expired"] += 1
+            return None
+
+    def get_similar(self, ns: str, vec: Sequence[float], bucket: Hashable,
+                    min_similarity: float) -> Optional[str]:
+        q = _unit(vec)
+        now = time.monotonic()
+        with self._lock:
+            self._namespace(ns)
+            best, best_key = min_similarity, None
+            for key in list(self._buckets.get(bucket, ())):
+                expires, _, v, _ = self._sem[key]
+                if expires <= now:
+                    self._sem_drop(key)
+                    self.stats["expired"] += 1
+                    continue
+                sim = float(v @ q)
+                if sim >= best:
+                    best, best_key = sim, key
+            if best_key is None:
+                return None
+            self._sem.move_to_end(best_key)
+            self.stats["semantic_hits"] += 1
+            return self._sem[best_key][3]
+
+    def miss(self) -> None:
+        with self._lock:
+            self.stats["misses"] += 1
+
+    def put(self, ns: str, key: str, completion: str, vec: Sequence[float] = None,
+            bucket: Hashable = None) -> None:
+        """`vec` + `bucket` also file the completion in the semantic tier."""
+        expires = time.monotonic() + self.ttl_s
+        with self._lock:
+            self._namespace(ns)
+            self._exact[key] = (expires, completion)
+            self._exact.move_to_end(key)
+            self.stats["stores"] += 1
+            while len(self._exact) > self.max_items:
+                self._exact.popitem(last=False)
+                self.stats["evictions"] += 1
+            if vec is None or self.semantic_max_items <= 0:
+                return
+            if key in self._sem:
+                self._sem_drop(key)
+            self._sem[key] = (expires, bucket, _unit(vec), completion)
+            self._buckets.setdefault(bucket, {})[key] = None
+            while len(self._sem) > self.semantic_max_items:
+                self._sem_drop(next(iter(self._sem)))
+                self.stats["evictions"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            s = dict(self.stats)
+            s["exact_items"] = len(self._exact)
+            s["semantic_items"] = len(self._sem)
+        lookups = s["exact_hits"] + s["semantic_hits"] + s["misses"]
+        s["hit_rate"] = (s["exact_hits"] + s["semantic_hits"]) / lookups if lookups else 0.0
+        return s
+
+def _unit(vec: Sequence[float]) -> np.ndarray:
+    v = np.asarray(vec, dtype=np.float32)
+    return v / (np.linalg.norm(v) + 1e-9)
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_response_cache(cfg: Dict[str, Any]) -> Optional[ResponseCache]:
+    """cfg = llm_settings; sizes are read when the cache is first built, `enabled` on every call."""
+    global _cache
+    rcfg = cfg.get("response_cache") or {}
+    if not rcfg.get("enabled", False):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                scfg = rcfg.get("semantic") or {}
+                _cache = ResponseCache(
+                    max_items=int(rcfg.get("max_items", 2048)),
+                    ttl_s=float(rcfg.get("ttl_s", 3600)),
+                    semantic_max_items=int(scfg.get("max_items", 512)) if scfg.get("enabled", False) else 0,
+                )
+    return _cache
@@ -0,0 +1,239 @@
+import asyncio, heapq, itertools, math, threading, time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Deque, Dict, List, Optional
+
+from server.config_loader import load_llm_settings
+from server.llm.resilience import remaining
+from server.metrics import counter, gauge, histogram
+from server.tracing import span
+
+QUEUE_DEPTH = gauge("aidgent_scheduler_queue_depth", "Provider calls waiting for a slot", ["api"])
+IN_FLIGHT = gauge("aidgent_scheduler_in_flight", "Provider calls holding a slot", ["api"])
+ADMITTED = counter("aidgent_scheduler_admitted_total", "Provider calls given a slot", ["api", "priority"])
+WAIT_SECONDS = histogram("aidgent_scheduler_wait_seconds", "Time queued calls waited for a slot", ["api", "priority"])
+SHED = counter("aidgent_scheduler_shed_total",
+               "Requests refused with 429 (queue_full | queue_timeout | session_busy)", ["api", "reason"])
+
+# lower runs first; a finalize turn already holds the user's answers, so it is never left behind
+PRIORITIES = {"finalize": 0, "turn": 1}
+
+class Overloaded(RuntimeError):
+    """No capacity for this request now; the client should retry after `retry_after_s`."""
+    def __init__(self, api: str, reason: str, retry_after_s: int):
+        super().__init__(f"{api}: {reason} (retry after {retry_after_s}s)")
+        self.api = api
+        self.reason = reason    # queue_full | queue_timeout | session_busy
+        self.retry_after_s = retry_after_s
+
+class LLMScheduler:
+    """
+    Admission for one api ("chat" | "embeddings") in this worker: at most
+    `max_in_flight` calls run at once, up to `max_queue` more wait in priority
+    order (finalize before turn, FIFO within a priority) for at most
+    `queue_timeout_s` or what is left of the request budget. Anything beyond
+    that is refused with Overloaded instead of piling up on the provider.
+    Finalize calls are never refused for a full queue, only for waiting too long.
+    Settings come from `scheduler:` in llm_settings.yaml.
+    """
+    def __init__(self, api: str):
+        self.api = api
+        self.in_flight = 0
+        self._waiters: List[list] = []      # heap of [priority, seq, future]
+        self._queued = 0
+        self._seq = itertools.count()
+        self._service_s = 1.0               # moving average of slot hold time, for Retry-After
+        self._settings = None
+        self.configure({})
+
+    def configure(self, settings: Dict[str, Any]) -> None:
+        if settings is self._settings:
+            return
+        own = settings.get(self.api) or {}
+        self.max_in_flight = max(1, int(own.get("max_in_flight", 16)))
+        self.max_queue = max(0, int(own.get("max_queue", 64)))
+        self.queue_timeout_s = float(settings.get("queue_timeout_s", 10))
+        self._settings = settings
+        self._drain()
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    def saturated(self) -> bool:
+        """A new turn-priority call would be refused right away."""
+        return self.in_flight >= self.max_in_flight and self._queued >= self.max_queue
+
+    def admit(self) -> None:
+        """Refuse a turn before any work is done for it when its call would be refused anyway."""
+        if self.saturated():
+            SHED.inc(api=self.api, reason="queue_full")
+            raise Overloaded(self.api, "queue_full", self.retry_after())
+
+    def retry_after(self) -> int:
+        waves = (self._queued + 1) / self.max_in_flight
+        return max(1, min(60, math.ceil(waves * self._service_s)))
+
+    def _gauges(self) -> None:
+        QUEUE_DEPTH.set(self._queued, api=self.api)
+        IN_FLIGHT.set(self.in_flight, api=self.api)
+
+    def _drain(self) -> None:
+        # hand free slots to the best waiters; timed-out waiters are skipped lazily
+        while self.in_flight < self.max_in_flight and self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if fut.done():
+                continue
+            self._queued -= 1
+            self.in_flight += 1
+            fut.set_result(None)
+        self._gauges()
+
+    def _release(self, held_s: Optional[float]) -> None:
+        if held_s is not None:
+            self._service_s = 0.8 * self._service_s + 0.2 * held_s
+        self.in_flight -= 1
+        self._drain()
+
+    async def _acquire(self, priority: str) -> None:
+        rank = PRIORITIES[priority]
+        if self.in_flight < self.max_in_flight and not self._queued:
+            self.in_flight += 1
+            self._gauges()
+            ADMITTED.inc(api=self.api, priority=priority)
+            return
+        if rank > 0 and self._queued >= self.max_queue:
+            SHED.inc(api=self.api, reason="queue_full")
+            raise Overloaded(self.api, "queue_full", self.retry_after())
+
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, [rank, next(self._seq), fut])
+        self._queued += 1
+        self._gauges()
+        timeout = self.queue_timeout_s
+        left = remaining()
+        if left is not None:
+            timeout = min(timeout, left)
+        t0 = time.monotonic()
+        try:
+            with span("queue_wait", api=self.api, priority=priority):
+                await asyncio.wait({fut}, timeout=max(0.0, timeout))
+        except BaseException:
+            self._leave(fut)
+            raise
+        if not fut.done():
+            self._leave(fut)
+            SHED.inc(api=self.api, reason="queue_timeout")
+            raise Overloaded(self.api, "queue_timeout", self.retry_after())
+        ADMITTED.inc(api=self.api, priority=priority)
+        WAIT_SECONDS.observe(time.monotonic() - t0, api=self.api, priority=priority)
+
+    def _leave(self, fut: asyncio.Future) -> None:
+        # stopped waiting (timeout or cancel); a slot granted meanwhile is passed on
+        if fut.done():
+            self._release(None)
+        else:
+            fut.cancel()
+            self._queued -= 1
+            self._gauges()
+
+    @asynccontextmanager
+    async def slot(self, priority: str = "turn"):
+        """Hold one of the api's slots for the body (a whole call: retries, stream)."""
+        await self._acquire(priority)
+        t0 = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(time.monotonic() - t0)
+
+class SessionQueue:
+    """
+    Turns of one session run one at a time, in arrival order, so the second of
+    two quick messages reads the state the first one wrote. Other sessions
+    never wait. At most `max_pending` turns may wait behind the running one,
+    each for at most `wait_s`. An `urgent` turn (red flag) is never refused:
+    it waits its turn like any other, but past `wait_s` it runs anyway.
+    Ordering is per worker process; the storage layer tolerates two workers
+    writing one session (see storage.db.insert_missing).
+    """
+    def __init__(self):
+        self._sessions: Dict[str, Deque[asyncio.Future]] = {}
+        self._settings = None
+        self.configure({})
+
+    def configure(self, settings: Dict[str, Any]) -> None:
+        if settings is self._settings:
+            return
+        own = settings.get("session") or {}
+        self.max_pending = max(0, int(own.get("max_pending", 2)))
+        self.wait_s = float(own.get("wait_s", 30))
+        self.retry_after_s = max(1, int(own.get("retry_after_s", 2)))
+        self._settings = settings
+
+    def busy(self, sid: str) -> bool:
+        return len(self._sessions.get(sid, ())) > self.max_pending
+
+    def admit(self, sid: str) -> None:
+        if self.busy(sid):
+            SHED.inc(api="session", reason="session_busy")
+            raise Overloaded("session", "session_busy", self.retry_after_s)
+
+    @asynccontextmanager
+    async def hold(self, sid: str, urgent: bool = False):
+        if not urgent:
+            self.admit(sid)
+        fut = asyncio.get_running_loop().create_future()
+        turns = self._sessions.setdefault(sid, deque())
+        turns.append(fut)
+        if len(turns) == 1:
+            fut.set_result(None)
+        try:
+            if not fut.done():
+                with span("session_wait", waiting=len(turns) - 1):
+                    await asyncio.wait({fut}, timeout=self.wait_s)
+        except BaseException:
+            self._leave(sid, fut)
+            raise
+        if not fut.done() and not urgent:
+            self._leave(sid, fut)
+            SHED.inc(api="session", reason="session_busy")
+            raise Overloaded("session", "session_busy", self.retry_after_s)
+        try:
+            yield
+        finally:
+            self._leave(sid, fut)
+
+    def _leave(self, sid: str, fut: asyncio.Future) -> None:
+        turns = self._sessions[sid]
+        head = turns[0] is fut
+        turns.remove(fut)
+        if not turns:
+            del self._sessions[sid]
+        elif head:
+            turns[0].set_result(None)
+
+_schedulers: Dict[str, LLMScheduler] = {}
+_sessions: Optional[SessionQueue] = None
+_lock = threading.Lock()
+
+def _settings() -> Dict[str, Any]:
+    return load_llm_settings().get("scheduler") or {}
+
+def get_scheduler(api: str) -> LLMScheduler:
+    """Process-wide scheduler per api; follows edits to llm_settings.yaml."""
+    s = _schedulers.get(api)
+    if s is None:
+        with _lock:
+            s = _schedulers.setdefault(api, LLMScheduler(api))
+    s.configure(_settings())
+    return s
+
+def get_session_queue() -> SessionQueue:
+    global _sessions
+    if _sessions is None:
+        with _lock:
+            if _sessions is None:
+                _sessions = SessionQueue()
+    _sessions.configure(_settings())
+    return _sessions
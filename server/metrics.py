@@ -0,0 +1,125 @@
+import bisect, threading
+from typing import Dict, Tuple, List, Sequence
+
+# Minimal in-process metrics with Prometheus text exposition (no client library needed).
+
+def _fmt_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    inner = ",".join(
+        '%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for n, v in zip(names, values)
+    )
+    return "{" + inner + "}"
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        return self._values.get(key, 0.0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_fmt_labels(self.labelnames, k)} {v:g}" for k, v in items]
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.inc(-amount, **labels)
+
+# seconds; spans from an in-memory lookup up to a slow LLM call
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (+Inf last), sum, count]
+        self._values: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            v = self._values.get(key)
+            if v is None:
+                v = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            v[0][i] += 1
+            v[1] += value
+            v[2] += 1
+
+    def snapshot(self, **labels) -> Tuple[float, int]:
+        """-> (sum, count)"""
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            v = self._values.get(key)
+            return (v[1], v[2]) if v else (0.0, 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._values.items())
+        out = []
+        for k, (counts, total, n) in items:
+            cum = 0
+            for le, c in zip(self.buckets + (float("inf"),), counts):
+                cum += c
+                labels = _fmt_labels(self.labelnames + ("le",), k + ("+Inf" if le == float("inf") else f"{le:g}",))
+                out.append(f"{self.name}_bucket{labels} {cum}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labelnames, k)} {total:g}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labelnames, k)} {n}")
+        return out
+
+REGISTRY: Dict[str, object] = {}
+_reg_lock = threading.Lock()
+
+def _register(cls, name: str, help: str, labelnames=(), **kw):
+    with _reg_lock:
+        m = REGISTRY.get(name)
+        if m is None:
+            m = cls(name, help, tuple(labelnames), **kw)
+            REGISTRY[name] = m
+        return m
+
+def counter(name: str, help: str, labelnames=()) -> Counter:
+    return _register(Counter, name, help, labelnames)
+
+def gauge(name: str, help: str, labelnames=()) -> Gauge:
+    return _register(Gauge, name, help, labelnames)
+
+def histogram(name: str, help: str, labelnames=(), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+    return _register(Histogram, name, help, labelnames, buckets=buckets)
+
+def render_prometheus() -> str:
+    lines = []
+    for name in sorted(REGISTRY):
+        m = REGISTRY[name]
+        lines.append(f"# HELP {name} {m.help}")
+        lines.append(f"# TYPE {name} {m.kind}")
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,54 @@
+from typing import Any, Dict, List, Optional
+
+from server.orchestrator.slot_policy import SlotPolicy
+from server.orchestrator.slot_enforcer import INTENT_SYMPTOMS
+from server.text.thai_analyzer import analyze
+
+# Lazy retrieval (rag_settings.yaml search.lazy): while a slot flow is collecting,
+# enforce_state replaces the model's reply with the next slot question, so
+# snippets retrieved for it are never shown. Only prompts whose reply is shown
+# get them, and their query comes from the slot state rather than the message.
+
+_FLOW_SYMPTOMS = frozenset().union(*INTENT_SYMPTOMS.values())
+
+def grounding(policy: SlotPolicy, prev_state: Dict[str, Any], predicted: Optional[Dict[str, Any]],
+              user_text: str) -> Optional[str]:
+    """
+    -> why this turn's first prompt needs snippets, or None to build it without:
+      finalize   the merged state completes the slots; the finalize prompt is sent
+      follow_up  the slot flow was already complete, the reply is shown as is
+      open       no slot flow yet and the message names none of the flows' symptoms
+    A first pass built without snippets that still completes the slots is
+    followed by a grounded finalize pass (see app.resolve_first_pass).
+    """
+    if predicted is not None:
+        return "finalize"
+    prev_state = prev_state or {}
+    if policy.intent(prev_state.get("intent")).required:
+        if prev_state.get("required_slots_filled") or prev_state.get("soap_ready"):
+            return "follow_up"
+        return None
+    if any(s in _FLOW_SYMPTOMS for s in analyze(user_text or "").symptoms()):
+        return None
+    return "open"
+
+def slot_query(policy: SlotPolicy, state: Dict[str, Any], fallback: str = "") -> str:
+    """
+    The retrieval query for a slot state: the intent's name_th followed by the
+    values of its search_slots, e.g. "ทางเดินหายใจทั่วไป (ไข้/ไอ/เจ็บคอ) ไอ เจ็บคอ น้ำมูก".
+    It stays the same while the topic does, so the session memo can answer
+    later turns. `fallback` (the message) when none of those slots is filled.
+    """
+    state = state or {}
+    ip = policy.intent(state.get("intent"))
+    slots = state.get("slots") or {}
+    parts: List[str] = []
+    for name in ip.search_slots:
+        v = slots.get(name)
+        for x in v if isinstance(v, (list, tuple)) else [v]:
+            x = x.strip() if isinstance(x, str) else ""
+            if x and x != "null" and x not in parts:
+                parts.append(x)
+    if not parts:
+        return fallback
+    return " ".join([ip.label] + parts if ip.label else parts)
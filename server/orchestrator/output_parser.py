@@ -0,0 +1,96 @@
+from typing import Dict, Any, Tuple
+import json
+
+UV_MARK = "[USER_VIEW]"
+SJ_MARK = "[STATE_JSON]"
+
+def parse_llm_output(raw_text: str) -> Tuple[str, Dict[str, Any]]:
+    """
+    Split the model output into [USER_VIEW] and [STATE_JSON]
+    """
+    user_view = ""
+    state_json: Dict[str, Any] = {}
+    text = raw_text
+
+    # Find markers
+    uv_start = text.find(UV_MARK)
+    sj_start = text.find(SJ_MARK)
+
+    if uv_start != -1 and sj_start != -1:
+        user_view = text[uv_start + len(UV_MARK):sj_start].strip()
+        state_str = text[sj_start + len(SJ_MARK):].strip()
+        # trim code fences if any
+        if state_str.startswith("```"):
+            state_str = state_str.split("```", 2)[1] if "```" in state_str[3:] else state_str[3:]
+        # attempt json parse
+        try:
+            state_json = json.loads(state_str)
+        except Exception:
+            # try to extract first {...}
+            first_brace = state_str.find("{")
+            last_brace = state_str.rfind("}")
+            if first_brace != -1 and last_brace != -1 and last_brace > first_brace:
+                try:
+                    state_json = json.loads(state_str[first_brace:last_brace + 1])
+                except Exception:
+                    state_json = {}
+    else:
+        # fallback: whole thing to user, empty state
+        user_view = raw_text
+        state_json = {}
+
+    return user_view, state_json
+
+class StreamingOutputParser:
+    """
+    Incremental counterpart of parse_llm_output for streamed completions.
+    feed() returns the newly visible [USER_VIEW] text; trailing whitespace and
+    anything that could be the start of a [STATE_JSON] marker are held back until
+    the next delta decides it, so the concatenated output equals the parsed view.
+    close() parses the whole buffer with parse_llm_output (authoritative result).
+    """
+    def __init__(self):
+        self.buf = ""
+        self.phase = "pre"      # pre -> view -> state
+        self.pos = 0            # index in buf up to which view text was emitted
+        self.emitted = ""
+
+    def feed(self, delta: str) -> str:
+        if not delta:
+            return ""
+        self.buf += delta
+        if self.phase == "pre":
+            i = self.buf.find(UV_MARK)
+            if i == -1:
+                return ""
+            self.phase = "view"
+            self.pos = i + len(UV_MARK)
+        if self.phase != "view":
+            return ""
+
+        j = self.buf.find(SJ_MARK, self.pos)
+        if j != -1:
+            end = j
+            self.phase = "state"
+        else:
+            end = len(self.buf)
+            # hold back a tail that is a prefix of the marker
+            for k in range(min(len(SJ_MARK) - 1, end - self.pos), 0, -1):
+                if SJ_MARK.startswith(self.buf[end - k:end]):
+                    end -= k
+                    break
+        # parse_llm_output strips the view: skip leading and hold back trailing whitespace
+        while end > self.pos and self.buf[end - 1].isspace():
+            end -= 1
+        start = self.pos
+        if not self.emitted:
+            while start < end and self.buf[start].isspace():
+                start += 1
+        chunk = self.buf[start:end]
+        if chunk:
+            self.pos = end
+        self.emitted += chunk
+        return chunk
+
+    def close(self) -> Tuple[str, Dict[str, Any]]:
+        return parse_llm_output(self.buf)
@@ -1,56 +1,139 @@
-from typing import List, Dict, Any
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Tuple
 import json
 
-def build_finalize_prompt(system_prompt: str, safety_strings: dict, slot_policy: dict,
-                          snippets: List[Dict[str, Any]], slots: Dict[str, Any]):
-    cited = []
-    for sn in snippets:
-        header = f"- {sn['doc_id']}:{sn.get('title','')} (v{sn.get('version','1.0')})"
-        body = f"  [id: {sn['snippet_id']}] {sn['text']}"
-        cited.append(header + "\n" + body)
-    cited_block = "[CITED_SNIPPETS]\n" + "\n".join(cited) + "\n[END_CITED_SNIPPETS]" if cited else ""
-
-    # STRONG instructions to finalize
-    system = system_prompt + """
-[STRICT MODE FINALIZE]
+from server.text.tokens import approx_tokens
+
+# Both prompt kinds send the same system message (system prompt + slot rules),
+# byte for byte, so the provider's prompt cache can reuse it as a prefix across
+# turns and sessions; everything that varies goes into the user message.
+SLOT_RULES = "\n".join([
+    "นโยบาย Slot-complete (ย้ำสั้น ๆ):",
+    "- ถ้าผู้ใช้ให้ข้อมูลบางช่องแล้ว ให้ยืนยันและข้าม",
+    "- เก็บ Required slots ให้ครบก่อนให้คำแนะนำ",
+    "- ครบแล้วให้คำแนะนำทั่วไปที่สอดคล้องกับ CITED_SNIPPETS และแนบ [STATE_JSON]",
+])
+
+# STRONG instructions to finalize
+FINALIZE_RULES = """[STRICT MODE FINALIZE]
 - ขณะนี้ข้อมูลครบทุกช่องแล้ว ห้ามถามคำถามเพิ่ม
 - ให้สรุปผู้ใช้แบบสั้น/ชัดเจนเป็นภาษาไทย และให้คำแนะนำทั่วไปอิง CITED_SNIPPETS เท่านั้น
 - ต้องส่ง [STATE_JSON] โดยตั้ง soap_ready=true และกรอก soap_json ให้ครบ (S/O/A/P)
 - ห้ามสร้างข้อเท็จจริงเกินเอกสารอ้างอิง
 """
 
-    user_block = (
-        "[SLOTS_JSON]\n" + json.dumps(slots, ensure_ascii=False) + "\n[END_SLOTS_JSON]\n\n" +
-        cited_block +
-        "\nโปรดสรุปและให้คำแนะนำทั่วไปที่ปลอดภัย (แนบ footer ความปลอดภัย) พร้อม SOAP"
-    )
-    return {"system": system, "user": user_block}
+FINALIZE_ASK = "\nโปรดสรุปและให้คำแนะนำทั่วไปที่ปลอดภัย (แนบ footer ความปลอดภัย) พร้อม SOAP"
+
+DEFAULT_PROMPT_CFG = {"budget_tokens": 0, "min_snippets": 1, "min_trim_tokens": 200}
+
+def format_snippet(sn: Dict[str, Any]) -> str:
+    """One snippet as it appears inside [CITED_SNIPPETS]."""
+    header = f"- {sn['doc_id']}:{sn.get('title','')} (v{sn.get('version','1.0')})"
+    return header + "\n" + f"  [id: {sn['snippet_id']}] {sn['text']}"
+
+@lru_cache(maxsize=8)
+def system_message(system_prompt: str) -> Tuple[str, int]:
+    # one entry per config version of the system prompt
+    system = system_prompt + "\n\n" + SLOT_RULES + "\n"
+    return system, approx_tokens(system)
+
+@lru_cache(maxsize=4096)
+def _block(doc_id: str, title: str, version: str, snippet_id: str, text: str) -> Tuple[str, int]:
+    # the same chunks come back turn after turn; format and count each one once per process
+    block = format_snippet({"doc_id": doc_id, "title": title, "version": version,
+                            "snippet_id": snippet_id, "text": text})
+    return block, approx_tokens(block)
+
+def _snippet_block(sn: Dict[str, Any]) -> Tuple[str, int]:
+    return _block(sn["doc_id"], sn.get("title", ""), sn.get("version", "1.0"), sn["snippet_id"], sn["text"])
+
+def _cut_snippet(sn: Dict[str, Any], room: int) -> Optional[Tuple[str, int]]:
+    # approx_tokens never counts a char as more than one token, so `keep` chars fit in `keep` tokens
+    keep = room - approx_tokens(format_snippet({**sn, "text": ""})) - 1
+    if keep <= 0:
+        return None
+    block = format_snippet({**sn, "text": sn["text"][:keep].rstrip() + "…"})
+    return block, approx_tokens(block)
+
+def _fit(budget: int, fixed: int, snippets, blocks, history, min_snippets: int, min_trim: int):
+    """
+    Drop or cut what does not fit `budget`: lowest-ranked snippets first (down
+    to min_snippets), then the oldest history lines, then the remaining
+    snippets. The lowest-ranked snippet is cut instead of dropped when at
+    least `min_trim` tokens of it still fit. Counts are per line/block plus one
+    for its separator. Mutates the lists -> (dropped_snippets, dropped_history).
+    """
+    total = fixed + sum(t + 1 for _, t in blocks) + sum(t + 1 for _, t in history)
+    dropped_s = dropped_h = 0
+    while budget and total > budget:
+        if blocks and (len(blocks) > min_snippets or not history):
+            tok = blocks[-1][1] + 1
+            room = budget - (total - tok) - 1
+            cut = _cut_snippet(snippets[len(blocks) - 1], room) if room >= min_trim else None
+            if cut is not None:
+                blocks[-1] = cut
+                total += cut[1] + 1 - tok
+                break
+            blocks.pop()
+            total -= tok
+            dropped_s += 1
+        elif history:
+            total -= history.pop(0)[1] + 1
+            dropped_h += 1
+        else:
+            break   # the fixed part alone is over budget; send it anyway
+    return dropped_s, dropped_h
+
+def _cited_block(blocks) -> str:
+    if not blocks:
+        return ""
+    return "[CITED_SNIPPETS]\n" + "\n".join(b for b, _ in blocks) + "\n[END_CITED_SNIPPETS]\n\n"
+
+# the [CITED_SNIPPETS] wrapper, charged up front whether or not any snippet survives
+_WRAP_TOKENS = approx_tokens("[CITED_SNIPPETS]\n\n[END_CITED_SNIPPETS]\n\n") + 1
+
+def _result(system: str, sys_tokens: int, user: str, kept: int, dropped_s: int, dropped_h: int) -> Dict[str, Any]:
+    return {"system": system, "user": user, "tokens": sys_tokens + approx_tokens(user),
+            "snippets_kept": kept, "dropped_snippets": dropped_s, "dropped_history": dropped_h}
+
+def build_finalize_prompt(system_prompt: str, safety_strings: dict, slot_policy: dict,
+                          snippets: List[Dict[str, Any]], slots: Dict[str, Any],
+                          last_user_text: str = "", prompt_cfg: Dict[str, Any] = None):
+    pc = {**DEFAULT_PROMPT_CFG, **(prompt_cfg or {})}
+    system, sys_tokens = system_message(system_prompt)
+
+    # when finalize is the only call of the turn, the latest answer may not be in slots yet
+    last_block = f"[LAST_USER] {last_user_text}\n\n" if last_user_text else ""
+    head = FINALIZE_RULES + "\n[SLOTS_JSON]\n" + json.dumps(slots, ensure_ascii=False) + "\n[END_SLOTS_JSON]\n\n" + last_block
+
+    blocks = [_snippet_block(sn) for sn in snippets]
+    fixed = sys_tokens + approx_tokens(head) + approx_tokens(FINALIZE_ASK) + _WRAP_TOKENS
+    dropped_s, _ = _fit(int(pc["budget_tokens"]), fixed, snippets, blocks, [],
+                        int(pc["min_snippets"]), int(pc["min_trim_tokens"]))
+
+    user_block = head + _cited_block(blocks) + FINALIZE_ASK
+    return _result(system, sys_tokens, user_block, len(blocks), dropped_s, 0)
 
 def build_prompt(system_prompt: str, safety_strings: dict, slot_policy: dict,
-                 snippets: List[Dict[str, Any]], history: List[Dict[str, str]], user_text: str):
-    # format snippets
-    cited = []
-    for sn in snippets:
-        header = f"- {sn['doc_id']}:{sn.get('title','')} (v{sn.get('version','1.0')})"
-        body = f"  [id: {sn['snippet_id']}] {sn['text']}"
-        cited.append(header + "\n" + body)
-    cited_block = "[CITED_SNIPPETS]\n" + "\n".join(cited) + "\n[END_CITED_SNIPPETS]" if cited else ""
-
-    # include minimal slot instructions inline to reduce drift
-    slot_lines = [
-        "นโยบาย Slot-complete (ย้ำสั้น ๆ):",
-        "- ถ้าผู้ใช้ให้ข้อมูลบางช่องแล้ว ให้ยืนยันและข้าม",
-        "- เก็บ Required slots ให้ครบก่อนให้คำแนะนำ",
-        "- ครบแล้วให้คำแนะนำทั่วไปที่สอดคล้องกับ CITED_SNIPPETS และแนบ [STATE_JSON]"
-    ]
-    system = system_prompt + "\n\n" + "\n".join(slot_lines) + "\n"
-
-    # minimal history (last 1-2 turns)
-    history_lines = []
-    for h in history[-4:]:
-        role = "USER" if h["role"] == "user" else "ASSISTANT"
-        history_lines.append(f"[{role}] {h['text']}")
-
-    user_block = "\n".join(history_lines) + (("\n" if history_lines else "") + f"[USER] {user_text}\n\n") + cited_block
-
-    return {"system": system, "user": user_block}
+                 snippets: List[Dict[str, Any]], history: List[Dict[str, str]], user_text: str,
+                 prompt_cfg: Dict[str, Any] = None):
+    pc = {**DEFAULT_PROMPT_CFG, **(prompt_cfg or {})}
+    system, sys_tokens = system_message(system_prompt)
+
+    # minimal history (last 1-2 turns); the current message is appended below, not repeated
+    recent = history[-4:]
+    if recent and recent[-1]["role"] == "user" and recent[-1]["text"] == user_text:
+        recent = recent[:-1]
+    lines = []
+    for h in recent:
+        line = f"[{'USER' if h['role'] == 'user' else 'ASSISTANT'}] {h['text']}"
+        lines.append((line, approx_tokens(line)))
+    current = f"[USER] {user_text}\n"
+
+    blocks = [_snippet_block(sn) for sn in snippets]
+    fixed = sys_tokens + approx_tokens(current) + _WRAP_TOKENS
+    dropped_s, dropped_h = _fit(int(pc["budget_tokens"]), fixed, snippets, blocks, lines,
+                                int(pc["min_snippets"]), int(pc["min_trim_tokens"]))
+
+    user_block = _cited_block(blocks) + "".join(line + "\n" for line, _ in lines) + current
+    return _result(system, sys_tokens, user_block, len(blocks), dropped_s, dropped_h)
@@ -1,30 +1,16 @@
 from typing import Dict, Any, List
 import re
 
-# --- tiny Thai keyword maps for auto-extract ---
-SYM_KEYWORDS = {
-    "ไข้": ["ไข้"],
-    "ไอ": ["ไอ"],
-    "เจ็บคอ": ["เจ็บคอ"],
-    "น้ำมูก": ["น้ำมูก", "น้ำมูกไหล", "คัดจมูก"],
-    "ผื่น": ["ผื่น", "ลมพิษ", "ตุ่ม", "ตุ่มน้ำ", "ปื้นแดง"],
-    "คัน": ["คัน"],
-}
+from server.orchestrator.slot_policy import SlotPolicy, compile_slot_policy
+from server.text.thai_analyzer import analyze, get_analyzer, UNKNOWN, NEG, POS
 
-THAI_NUM_WORDS = {
-    "ศูนย์": 0, "หนึ่ง": 1, "สอง": 2, "สาม": 3, "สี่": 4, "ห้า": 5,
-    "หก": 6, "เจ็ด": 7, "แปด": 8, "เก้า": 9, "สิบ": 10, "สิบเอ็ด": 11, "สิบสอง": 12,
-}
-DUR_UNITS = r"(วัน|ชั่วโมง|ชม\.|ช\.ม\.|สัปดาห์|อาทิตย์|เดือน)"
+# Keyword vocabularies (symptoms, number words, duration units, unknown /
+# negation markers, fast-path label tables) live in config/thai_lexicon.yaml;
+# every helper below reads one memoized single-pass analysis of the text.
 
 def _thai_words_to_number(text: str) -> str:
-    # very small normalizer
-    rep = [("สิบเอ็ด","11"), ("สิบสอง","12")]
-    for w, n in rep:
-        text = text.replace(w, n)
-    for w, n in THAI_NUM_WORDS.items():
-        text = text.replace(w, str(n))
-    return text
+    # lowercased, Thai digits + number words as ASCII numbers
+    return analyze(text).norm
 
 def _is_filled(v: Any) -> bool:
     if v is None:
@@ -41,20 +27,12 @@ def _meaningful(v: Any) -> bool:
         return True
     return _is_filled(v)
 
-def _get_ask_order(intent_cfg: Dict[str, Any]) -> List[str]:
-    return intent_cfg.get("ask_order", intent_cfg.get("required_slots", []))
-
 def auto_fill_main_symptoms_from_text(user_text: str, slots: Dict[str, Any]) -> None:
     if slots.get("main_symptoms"):
         return
-    found = []
-    t = (user_text or "").strip()
-    for label, kws in SYM_KEYWORDS.items():
-        for kw in kws:
-            if kw in t:
-                found.append(label); break
+    found = analyze((user_text or "").strip()).symptoms()
     if found:
-        slots["main_symptoms"] = list(dict.fromkeys(found))
+        slots["main_symptoms"] = found
 
 def fold_boolean_symptoms_into_main(slots: Dict[str, Any]) -> None:
     # If model output had booleans like fever/cough/sore_throat, fold into main_symptoms
@@ -97,48 +75,156 @@ def auto_fill_duration_from_text(user_text: str, slots: Dict[str, Any]) -> None:
     t = (user_text or "").strip()
     if not t:
         return
-    t_norm = _thai_words_to_number(t)
-    m = re.search(r"(\d+(?:\.\d+)?)\s*" + DUR_UNITS, t_norm)
-    if m:
-        num = m.group(1); unit = m.group(2)
-        slots["duration"] = f"{num} {unit}"
+    duration = analyze(t).duration
+    if duration:
+        slots["duration"] = duration
 
 def normalize_unknowns(user_text: str, slots: Dict[str, Any]) -> None:
-    t = (user_text or "").lower()
-    unknown_markers = ["ไม่ทราบ", "ไม่ได้วัด", "ไม่มีเทอร์โมมิเตอร์", "ไม่มีที่วัดไข้"]
-    if any(x in t for x in unknown_markers):
+    if analyze(user_text).has(UNKNOWN):
         slots["fever_measured"] = False
         slots["fever_max_c"] = None
         slots["fever_method"] = None
 
-def compute_missing(intent: str, slots: Dict[str, Any], slot_policy: Dict[str, Any]) -> List[str]:
-    intents = slot_policy.get("intents", {})
-    cfg = intents.get(intent, {})
-    required = cfg.get("required_slots", [])
-    conds = cfg.get("conditional_required", [])
-
-    missing = [name for name in required if not _is_filled(slots.get(name))]
-
-    # conditional requirements
-    for rule in conds:
-        cond = (rule.get("if") or "").replace("true", "True").replace("false", "False")
-        then = rule.get("then", [])
-        try:
-            local = {"__builtins__": {}}
-            local.update(slots)
-            ok = bool(eval(cond, {}, local))
-        except Exception:
-            ok = False
-        if ok:
+# --- deterministic extractors for the slot that was just asked (fast path) ---
+# each returns a dict of slot updates when the answer is unambiguous, else None
+TEMP_RE = re.compile(r"(\d{2}(?:\.\d{1,2})?)")
+
+def _one_label(text: str, table: str) -> Any:
+    # exactly one label of the lexicon table must match, otherwise the answer is ambiguous
+    labels = analyze(text).labels(table)
+    return labels[0] if len(labels) == 1 else None
+
+def _yes_no(text: str) -> Any:
+    # only a reply that opens with the marker counts ("มีค่ะ"); "เจ็บคอ มีไข้" goes to the LLM
+    a = analyze(text)
+    if not a.compact or len(a.compact) > 24:
+        return None   # long answers go to the LLM
+    return a.yes_no()
+
+def extract_fever_measured(text: str):
+    if analyze(text).has(UNKNOWN):
+        return {"fever_measured": False}
+    temp = extract_fever_max_c(text)
+    if temp and temp.get("fever_max_c"):
+        return {"fever_measured": True, **temp}
+    v = _yes_no(text)
+    return None if v is None else {"fever_measured": v}
+
+def extract_fever_max_c(text: str):
+    a = analyze(text)
+    if a.has(UNKNOWN):
+        return {}   # normalize_unknowns clears the fever slots
+    vals = [float(x) for x in TEMP_RE.findall(a.norm) if 34.0 <= float(x) <= 43.0]
+    return {"fever_max_c": vals[0]} if len(vals) == 1 else None
+
+def extract_fever_method(text: str):
+    if analyze(text).has(UNKNOWN):
+        return {}
+    v = _one_label(text, "fever_method")
+    return None if v is None else {"fever_method": v}
+
+def extract_severity(text: str):
+    # "ไม่มาก" is its own (mild) keyword, so it never reads as "มาก"
+    v = _one_label(text, "severity")
+    return None if v is None else {"severity_overall": v}
+
+def extract_rash_extent(text: str):
+    v = _one_label(text, "rash_extent")
+    return None if v is None else {"rash_extent": v}
+
+def extract_rash_location(text: str):
+    v = _one_label(text, "rash_location")
+    return None if v is None else {"rash_location_primary": v}
+
+def extract_duration(text: str):
+    slots: Dict[str, Any] = {}
+    auto_fill_duration_from_text(text, slots)
+    return slots or None
+
+def extract_main_symptoms(text: str):
+    slots: Dict[str, Any] = {}
+    auto_fill_main_symptoms_from_text(text, slots)
+    return slots or None
+
+def _none_answer(slot: str, value: Any):
+    def extract(text: str):
+        return {slot: value} if analyze(text).compact in get_analyzer().none_answers else None
+    return extract
+
+SLOT_EXTRACTORS = {
+    "main_symptoms": extract_main_symptoms,
+    "duration": extract_duration,
+    "fever_measured": extract_fever_measured,
+    "fever_max_c": extract_fever_max_c,
+    "fever_method": extract_fever_method,
+    "severity_overall": extract_severity,
+    "co_symptoms": _none_answer("co_symptoms", ["ไม่มี"]),
+    "risk_factors": _none_answer("risk_factors", ["ไม่มี"]),
+    "meds_allergies": _none_answer("meds_allergies", "ไม่มี"),
+    "rash_extent": extract_rash_extent,
+    "rash_location_primary": extract_rash_location,
+    "suspected_triggers": _none_answer("suspected_triggers", ["ไม่ทราบ"]),
+}
+
+INTENT_SYMPTOMS = {"resp_upper": RESP_SYM, "derm_rash": DERM_SYM}
+
+def _mentions_other_intent(intent: str, user_text: str) -> bool:
+    found: Dict[str, Any] = {}
+    auto_fill_main_symptoms_from_text(user_text, found)
+    own = INTENT_SYMPTOMS.get(intent)
+    return bool(own is not None and any(s not in own for s in found.get("main_symptoms", [])))
+
+def fast_path_turn(prev_state: Dict[str, Any], user_text: str,
+                   slot_policy: SlotPolicy, slot_questions: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Deterministic tier before the LLM: if the answer confidently fills the slot
+    asked last turn and more slots remain, reply with the next canned question.
+    Returns {"slot", "hit", "user_view", "state", "predicted"}; state is None when
+    the LLM is needed. predicted is the merged state when this turn is expected to
+    complete the required slots (so the caller can go straight to finalize).
+    """
+    prev_state = prev_state or {}
+    slot = prev_state.get("pending_slot")
+    intent = prev_state.get("intent")
+    out = {"slot": slot, "hit": False, "user_view": None, "state": None, "predicted": None}
+    slot_policy = _policy(slot_policy)
+    if not slot or intent not in slot_policy.intents or intent == "emergency":
+        return out
+    extractor = SLOT_EXTRACTORS.get(slot)
+    updates = extractor(user_text) if extractor else None
+    out["hit"] = updates is not None
+
+    user_view, state = enforce_state(prev_state, {"intent": intent, "slots": updates or {}},
+                                     slot_policy, slot_questions, "", user_text)
+    if state.get("required_slots_filled"):
+        # advice/SOAP turn still needs the model; predict it unless the user
+        # seems to be switching topic (the LLM may change intent then)
+        if not _mentions_other_intent(intent, user_text):
+            out["predicted"] = state
+        return out
+    if out["hit"]:
+        out["user_view"], out["state"] = user_view, state
+    return out
+
+def _policy(slot_policy) -> SlotPolicy:
+    # callers normally pass the snapshot's compiled policy; a raw dict is compiled here
+    return slot_policy if isinstance(slot_policy, SlotPolicy) else compile_slot_policy(slot_policy)
+
+def compute_missing(intent: str, slots: Dict[str, Any], slot_policy: SlotPolicy) -> List[str]:
+    ip = _policy(slot_policy).intent(intent)
+    missing = [name for name in ip.required if not _is_filled(slots.get(name))]
+
+    # conditional requirements (predicates compiled at config load)
+    for pred, then in ip.conditionals:
+        if pred(slots):
             for name in then:
                 if not _is_filled(slots.get(name)) and name not in missing:
                     missing.append(name)
 
-    order = _get_ask_order(cfg)
-    missing.sort(key=lambda x: order.index(x) if x in order else 999)
+    missing.sort(key=ip.rank_of)
     return missing
 
-def merge_states(prev: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
+def merge_states(prev: Dict[str, Any], new: Dict[str, Any], slot_policy: SlotPolicy) -> Dict[str, Any]:
     out = dict(prev or {})
     prev_intent = out.get("intent")
     new_intent = (new or {}).get("intent")
@@ -159,30 +245,15 @@ def merge_states(prev: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
             ps[k] = v
 
     if intent_changed:
-        # ช่องที่คงไว้ได้ทุก intent
-        keep_general = {"risk_factors", "meds_allergies"}
-
-        derm_only = {
-            "rash", "rash_morphology", "rash_location_primary",
-            "rash_extent", "associated", "suspected_triggers", "vulnerable_groups"
-        }
-        resp_only = {
-            "fever", "cough", "sore_throat", "runny_nose",
-            "fever_measured", "fever_max_c", "fever_method"
-        }
-
-        # ลบช่องที่ไม่เข้ากับ intent ใหม่
-        drop = resp_only if intent == "derm_rash" else derm_only
+        # ลบช่องที่ไม่เข้ากับ intent ใหม่ (intent_change ใน slot_policy.yaml)
+        drop = _policy(slot_policy).drop_on_enter(intent)
         for k in list(ps.keys()):
-            if k in drop and k not in keep_general:
+            if k in drop:
                 ps.pop(k, None)
 
         # ล้าง main_symptoms เพื่อให้ re-extract ตาม intent ใหม่
         ps.pop("main_symptoms", None)
 
-        # reset asked slots
-        out["asked_slots"] = []
-
     out["slots"] = ps
 
     # asked_slots: union เว้นแต่ intent เปลี่ยน
@@ -192,38 +263,12 @@ def merge_states(prev: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
 
     return out
 
-    out = dict(prev or {})
-    # intent: prefer new if provided (and not 'uncertain')
-    new_intent = (new or {}).get("intent")
-    if new_intent and new_intent != "uncertain":
-        out["intent"] = new_intent
-    else:
-        out["intent"] = out.get("intent") or new_intent or "uncertain"
-
-    # slots merge (meaningful updates override, but don't drop prior values)
-    ps = dict(prev.get("slots") or {})
-    ns = dict(new.get("slots") or {})
-    for k, v in ns.items():
-        if _meaningful(v) or isinstance(v, bool):
-            ps[k] = v
-    out["slots"] = ps
-
-    # asked_slots: union
-    asked_prev = set(prev.get("asked_slots") or [])
-    asked_new = set(new.get("asked_slots") or [])
-    out["asked_slots"] = list(asked_prev | asked_new)
-
-    # after computing new_intent
-    if prev.get("intent") and new_intent and new_intent != prev["intent"]:
-        out["asked_slots"] = []  # reset asked list on intent change
-
-    return out
-
 def enforce_state(prev_state: Dict[str, Any], new_state: Dict[str, Any],
-                  slot_policy: Dict[str, Any], slot_questions: Dict[str, Any],
+                  slot_policy: SlotPolicy, slot_questions: Dict[str, Any],
                   user_view_from_llm: str, last_user_text: str):
+    slot_policy = _policy(slot_policy)
     # Merge previous + new
-    state = merge_states(prev_state or {}, new_state or {})
+    state = merge_states(prev_state or {}, new_state or {}, slot_policy)
     intent = state.get("intent") or "uncertain"
     slots = state.get("slots") or {}
 
@@ -258,6 +303,7 @@ def enforce_state(prev_state: Dict[str, Any], new_state: Dict[str, Any],
         next_slot = missing[0]                       # ONE slot per turn
         asked.add(next_slot)
         state["asked_slots"] = list(asked)
+        state["pending_slot"] = next_slot            # lets the next turn try the fast path
         state["soap_ready"] = False
         state["soap_json"] = {}
         # Question text
@@ -266,4 +312,5 @@ def enforce_state(prev_state: Dict[str, Any], new_state: Dict[str, Any],
         return question, state
 
     # All required slots present → allow LLM's Thai guidance/SOAP to pass through
+    state.pop("pending_slot", None)
     return user_view_from_llm, state
@@ -0,0 +1,216 @@
+import re
+from typing import Any, Callable, Dict, FrozenSet, List, Tuple
+
+from server.config_loader import ConfigError
+
+# ---------- predicate language for conditional_required ----------
+# expr    := and ("or" and)*
+# and     := not ("and" not)*
+# not     := "not" not | cmp
+# cmp     := atom [("==" | "!=" | "<" | "<=" | ">" | ">=" | "in") atom]
+# atom    := slot_name | true | false | null | number | "string" | "(" expr ")" | "[" atom, ... "]"
+# A missing slot reads as null; ordering between null / mismatched types is false.
+
+_TOKEN = re.compile(r"""
+    \s*(?:
+      (?P<num>-?\d+(?:\.\d+)?)
+    | (?P<str>"[^"]*"|'[^']*')
+    | (?P<op>==|!=|<=|>=|<|>|\(|\)|\[|\]|,)
+    | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    )""", re.VERBOSE)
+
+_LITERALS = {"true": True, "True": True, "false": False, "False": False, "null": None, "None": None}
+_KEYWORDS = {"and", "or", "not", "in"}
+
+def _ordered(fn):
+    def cmp(a, b):
+        if a is None or b is None:
+            return False
+        try:
+            return fn(a, b)
+        except TypeError:
+            return False
+    return cmp
+
+_CMP = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": _ordered(lambda a, b: a < b),
+    "<=": _ordered(lambda a, b: a <= b),
+    ">": _ordered(lambda a, b: a > b),
+    ">=": _ordered(lambda a, b: a >= b),
+    "in": lambda a, b: isinstance(b, (list, tuple, str)) and a in b,
+}
+
+def _tokenize(src: str) -> List[Tuple[str, Any]]:
+    out, pos = [], 0
+    src = src.rstrip()
+    while pos < len(src):
+        m = _TOKEN.match(src, pos)
+        if not m or m.end() == pos:
+            raise ConfigError(f"bad token at {pos} in {src!r}")
+        pos = m.end()
+        if m.group("num") is not None:
+            t = m.group("num")
+            out.append(("lit", float(t) if "." in t else int(t)))
+        elif m.group("str") is not None:
+            out.append(("lit", m.group("str")[1:-1]))
+        elif m.group("op") is not None:
+            out.append(("op", m.group("op")))
+        else:
+            w = m.group("name")
+            if w in _LITERALS:
+                out.append(("lit", _LITERALS[w]))
+            elif w in _KEYWORDS:
+                out.append(("op", w))
+            else:
+                out.append(("name", w))
+    return out
+
+class _Parser:
+    def __init__(self, src: str, names: FrozenSet[str]):
+        self.src, self.names = src, names
+        self.toks = _tokenize(src)
+        self.i = 0
+
+    def _peek(self):
+        return self.toks[self.i] if self.i < len(self.toks) else (None, None)
+
+    def _take(self, op: str = None):
+        kind, val = self._peek()
+        if kind is None or (op is not None and (kind, val) != ("op", op)):
+            raise ConfigError(f"expected {op or 'a value'} in {self.src!r}")
+        self.i += 1
+        return kind, val
+
+    def parse(self) -> Callable[[Dict[str, Any]], Any]:
+        fn = self._or()
+        if self.i != len(self.toks):
+            raise ConfigError(f"unexpected {self._peek()[1]!r} in {self.src!r}")
+        return fn
+
+    def _or(self):
+        parts = [self._and()]
+        while self._peek() == ("op", "or"):
+            self._take("or")
+            parts.append(self._and())
+        if len(parts) == 1:
+            return parts[0]
+        return lambda s: any(p(s) for p in parts)
+
+    def _and(self):
+        parts = [self._not()]
+        while self._peek() == ("op", "and"):
+            self._take("and")
+            parts.append(self._not())
+        if len(parts) == 1:
+            return parts[0]
+        return lambda s: all(p(s) for p in parts)
+
+    def _not(self):
+        if self._peek() == ("op", "not"):
+            self._take("not")
+            inner = self._not()
+            return lambda s: not inner(s)
+        return self._cmp()
+
+    def _cmp(self):
+        left = self._atom()
+        kind, val = self._peek()
+        if kind == "op" and val in _CMP:
+            self._take(val)
+            right, op = self._atom(), _CMP[val]
+            return lambda s: op(left(s), right(s))
+        return left
+
+    def _atom(self):
+        kind, val = self._take()
+        if kind == "lit":
+            return lambda s: val
+        if kind == "name":
+            if val not in self.names:
+                raise ConfigError(f"unknown slot {val!r} in {self.src!r}")
+            return lambda s: s.get(val)
+        if val == "(":
+            inner = self._or()
+            self._take(")")
+            return inner
+        if val == "[":
+            items = []
+            while self._peek() != ("op", "]"):
+                items.append(self._atom())
+                if self._peek() != ("op", "]"):
+                    self._take(",")
+            self._take("]")
+            return lambda s: [f(s) for f in items]
+        raise ConfigError(f"unexpected {val!r} in {self.src!r}")
+
+def compile_predicate(src: str, names: FrozenSet[str]) -> Callable[[Dict[str, Any]], bool]:
+    fn = _Parser(src, names).parse()
+    return lambda slots: bool(fn(slots))
+
+# ---------- compiled policy ----------
+class IntentPolicy:
+    """Per-intent lookups precomputed from slot_policy.yaml."""
+    __slots__ = ("name", "label", "required", "required_set", "rank", "conditionals", "known",
+                 "search_slots", "drop_on_enter")
+
+    def __init__(self, name: str, cfg: Dict[str, Any], drop_on_enter: FrozenSet[str]):
+        self.name = name
+        self.label: str = cfg.get("name_th") or ""
+        self.required: Tuple[str, ...] = tuple(cfg.get("required_slots") or ())
+        self.required_set = frozenset(self.required)
+        order = cfg.get("ask_order", cfg.get("required_slots")) or []
+        self.rank: Dict[str, int] = {s: i for i, s in reversed(list(enumerate(order)))}
+        conds = cfg.get("conditional_required") or []
+        self.known = frozenset(self.required) | frozenset(order) | frozenset(cfg.get("optional_slots") or ())
+        for rule in conds:
+            self.known |= frozenset(rule.get("then") or ())
+        compiled = []
+        for n, rule in enumerate(conds):
+            src = rule.get("if")
+            if not isinstance(src, str) or not src.strip():
+                raise ConfigError(f"intents.{name}.conditional_required[{n}]: missing 'if'")
+            try:
+                pred = compile_predicate(src, self.known)
+            except ConfigError as e:
+                raise ConfigError(f"intents.{name}.conditional_required[{n}]: {e}") from None
+            compiled.append((pred, tuple(rule.get("then") or ())))
+        self.conditionals: Tuple[Tuple[Callable, Tuple[str, ...]], ...] = tuple(compiled)
+        self.search_slots: Tuple[str, ...] = tuple(cfg.get("search_slots") or ())
+        unknown = [s for s in self.search_slots if s not in self.known]
+        if unknown:
+            raise ConfigError(f"intents.{name}.search_slots: unknown slot {unknown[0]!r}")
+        self.drop_on_enter = drop_on_enter
+
+    def rank_of(self, slot: str) -> int:
+        return self.rank.get(slot, 999)
+
+_NO_INTENT = IntentPolicy("", {}, frozenset())
+
+class SlotPolicy:
+    """slot_policy.yaml compiled once per config version; see compile_slot_policy()."""
+    def __init__(self, raw: Dict[str, Any]):
+        self.raw = raw
+        change = raw.get("intent_change") or {}
+        keep = frozenset(change.get("keep") or ())
+        drops = change.get("drop_slots") or {}
+        default_drop = frozenset(drops.get("*") or ()) - keep
+        self.intents: Dict[str, IntentPolicy] = {}
+        for name, cfg in (raw.get("intents") or {}).items():
+            drop = frozenset(drops[name]) - keep if name in drops else default_drop
+            self.intents[name] = IntentPolicy(name, cfg or {}, drop)
+        self.default_drop = default_drop
+        self.fast_path = bool((raw.get("fast_path") or {}).get("enabled", False))
+        self.predict_finalize = bool((raw.get("finalize") or {}).get("predict", False))
+
+    def intent(self, name: str) -> IntentPolicy:
+        return self.intents.get(name, _NO_INTENT)
+
+    def drop_on_enter(self, name: str) -> FrozenSet[str]:
+        ip = self.intents.get(name)
+        return ip.drop_on_enter if ip is not None else self.default_drop
+
+def compile_slot_policy(raw: Dict[str, Any]) -> SlotPolicy:
+    """Raises ConfigError for malformed predicates or unknown slot names."""
+    return SlotPolicy(raw)
@@ -0,0 +1,246 @@
+import os, glob, json, uuid, threading
+import asyncio
+import httpx
+import numpy as np
+from typing import List, Dict, Any
+
+from pinecone import Pinecone
+
+from server.llm.resilience import ProviderUnavailable, RetryableStatus, get_caller
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+_pc = None
+
+def get_pinecone(cfg=None) -> Pinecone:
+    global _pc
+    if _pc is None:
+        _pc = Pinecone(api_key=os.environ.get("PINECONE_API_KEY"))
+    return _pc
+
+def resolve_path(p: str) -> str:
+    # paths in rag_settings.yaml are relative to the repo root
+    return p if os.path.isabs(p) else os.path.join(ROOT, p)
+
+class PineconeBackend:
+    name = "pinecone"
+
+    def __init__(self, cfg: Dict[str, Any]):
+        self.cfg = cfg
+        self.host = cfg["pinecone"].get("host")   # resolved via describe_index if unset
+        # with a host the SDK skips the control-plane lookup as well
+        self.index = get_pinecone(cfg).Index(cfg["pinecone"]["index"], host=self.host or "")
+        self.namespace = cfg["pinecone"].get("namespace", "default")
+        self._http = None
+        self._generation = 0
+        self.version = "pinecone:0"   # bumped by reopen() after this process re-ingests
+
+    def query(self, vector: List[float], top_k: int, include_values: bool = False) -> List[Dict[str, Any]]:
+        res = self.index.query(
+            namespace=self.namespace,
+            vector=vector,
+            top_k=top_k,
+            include_metadata=True,
+            include_values=include_values,
+        )
+        return [
+            {"id": m["id"], "score": m.get("score", 0.0) or 0.0, "metadata": m["metadata"],
+             "values": m.get("values") if include_values else None}
+            for m in res["matches"]
+        ]
+
+    async def aquery(self, vector: List[float], top_k: int, include_values: bool = False) -> List[Dict[str, Any]]:
+        # pinecone-client v4 has no asyncio API; talk to the data plane REST endpoint
+        # over a pooled keep-alive client instead of blocking a worker thread
+        if self.host is None:
+            desc = await asyncio.to_thread(get_pinecone(self.cfg).describe_index, self.cfg["pinecone"]["index"])
+            self.host = desc.host
+        if self._http is None:
+            base = self.host if self.host.startswith("http") else f"https://{self.host}"
+            self._http = httpx.AsyncClient(
+                base_url=base,
+                headers={"Api-Key": os.environ.get("PINECONE_API_KEY", ""),
+                         "X-Pinecone-API-Version": "2024-07"},
+                limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+            )
+        body = {"namespace": self.namespace, "vector": vector, "topK": top_k,
+                "includeMetadata": True, "includeValues": include_values}
+
+        async def attempt(timeout: float):
+            r = await self._http.post("/query", json=body, timeout=timeout)
+            if r.status_code == 429 or r.status_code >= 500:
+                raise RetryableStatus(r.status_code)
+            r.raise_for_status()
+            return r.json()
+
+        # deadline, retries and breaker as for the OpenAI calls (resilience.pinecone);
+        # a refused request (4xx) is surfaced the same way, so the turn goes on without the index
+        try:
+            data = await get_caller("pinecone").call(attempt, hedge=False)
+        except httpx.HTTPStatusError as e:
+            raise ProviderUnavailable("pinecone", f"http_{e.response.status_code}") from e
+        return [
+            {"id": m["id"], "score": m.get("score", 0.0) or 0.0, "metadata": m.get("metadata") or {},
+             "values": m.get("values") if include_values else None}
+            for m in data.get("matches", [])
+        ]
+
+    async def aclose(self) -> None:
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    def upsert(self, vectors: List[Dict[str, Any]]) -> None:
+        # Pinecone v4 upsert
+        self.index.upsert(vectors=vectors, namespace=self.namespace)
+
+    def delete(self, ids: List[str]) -> None:
+        for i in range(0, len(ids), 1000):
+            self.index.delete(ids=ids[i:i + 1000], namespace=self.namespace)
+
+    def flush(self) -> None:
+        pass
+
+    def reopen(self) -> "PineconeBackend":
+        # the remote index is already live; only the version (and so the response cache) moves on
+        self._generation += 1
+        self.version = f"pinecone:{self._generation}"
+        return self
+
+class LocalBackend:
+    """
+    In-process store: L2-normalized float32 matrix (memory-mapped .npy) + meta.json.
+    meta.json points at the current vectors file so a reader never sees a
+    half-written matrix; writers replace meta.json atomically. What is loaded
+    is published as one (version, ids, metadatas, matrix) tuple that a query
+    reads once, so a reload never shows a query a mix of two stores.
+    """
+    name = "local"
+
+    def __init__(self, cfg: Dict[str, Any]):
+        self.cfg = cfg
+        self.dir = resolve_path(cfg.get("local", {}).get("path", "rag/index/local"))
+        self.dim = int(cfg["embeddings"]["dimension"])
+        self._lock = threading.Lock()   # ingest may upsert from several workers
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._deleted = set()
+        self.reload()
+
+    def _meta_path(self) -> str:
+        return os.path.join(self.dir, "meta.json")
+
+    def _load(self):
+        # version names the vectors file, which every write replaces
+        empty = ("local:empty", [], [], np.zeros((0, self.dim), dtype=np.float32))
+        meta_path = self._meta_path()
+        if not os.path.exists(meta_path):
+            return empty
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if not meta.get("ids"):
+            return empty
+        matrix = np.load(os.path.join(self.dir, meta["vectors_file"]), mmap_mode="r")
+        return "local:" + meta["vectors_file"], meta["ids"], meta["metadatas"], matrix
+
+    def reload(self) -> None:
+        self._store = self._load()
+
+    def reopen(self) -> "LocalBackend":
+        # a new instance, so queries already running keep the store they started with
+        return LocalBackend(self.cfg)
+
+    @property
+    def version(self) -> str:
+        return self._store[0]
+
+    def query(self, vector: List[float], top_k: int, include_values: bool = False) -> List[Dict[str, Any]]:
+        _, ids, metadatas, matrix = self._store
+        n = len(ids)
+        if n == 0 or top_k <= 0:
+            return []
+        q = np.asarray(vector, dtype=np.float32)
+        q = q / (np.linalg.norm(q) + 1e-9)
+        scores = matrix @ q
+        k = min(top_k, n)
+        top = np.argpartition(-scores, k - 1)[:k] if k < n else np.arange(n)
+        top = top[np.argsort(-scores[top])]
+        return [
+            {"id": ids[i], "score": float(scores[i]), "metadata": metadatas[i],
+             "values": matrix[i] if include_values else None}
+            for i in top
+        ]
+
+    async def aquery(self, vector: List[float], top_k: int, include_values: bool = False) -> List[Dict[str, Any]]:
+        # in-process matrix product; cheap enough to run on the event loop
+        return self.query(vector, top_k, include_values)
+
+    async def aclose(self) -> None:
+        pass
+
+    def upsert(self, vectors: List[Dict[str, Any]]) -> None:
+        # buffered until flush(); ingest writes the whole store in one go
+        with self._lock:
+            for v in vectors:
+                self._pending[v["id"]] = v
+                self._deleted.discard(v["id"])
+
+    def delete(self, ids: List[str]) -> None:
+        with self._lock:
+            for id_ in ids:
+                self._pending.pop(id_, None)
+                self._deleted.add(id_)
+
+    def flush(self) -> None:
+        if not self._pending and not self._deleted:
+            return
+        _, old_ids, old_metadatas, old_matrix = self._store
+        keep = [i for i, id_ in enumerate(old_ids) if id_ not in self._deleted]
+        ids = [old_ids[i] for i in keep]
+        metadatas = [old_metadatas[i] for i in keep]
+        mat = np.array(old_matrix[keep] if keep else np.zeros((0, self.dim)), dtype=np.float32)
+        pos = {id_: i for i, id_ in enumerate(ids)}
+        new_rows = []
+        for id_, v in self._pending.items():
+            vec = np.asarray(v["values"], dtype=np.float32)
+            if vec.shape != (self.dim,):
+                raise ValueError(f"embedding dim {vec.shape} != {self.dim} for {id_}")
+            vec = vec / (np.linalg.norm(vec) + 1e-9)
+            if id_ in pos:
+                mat[pos[id_]] = vec
+                metadatas[pos[id_]] = v["metadata"]
+            else:
+                pos[id_] = len(ids)
+                ids.append(id_)
+                metadatas.append(v["metadata"])
+                new_rows.append(vec)
+        if new_rows:
+            mat = np.vstack([mat] + new_rows)
+        self._write(ids, metadatas, mat)
+        self._pending, self._deleted = {}, set()
+        self.reload()
+
+    def _write(self, ids, metadatas, mat) -> None:
+        os.makedirs(self.dir, exist_ok=True)
+        vectors_file = f"vectors-{uuid.uuid4().hex[:8]}.npy"
+        np.save(os.path.join(self.dir, vectors_file), mat)
+
+        tmp = self._meta_path() + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"dim": self.dim, "vectors_file": vectors_file,
+                       "ids": ids, "metadatas": metadatas}, f, ensure_ascii=False)
+        os.replace(tmp, self._meta_path())
+
+        for path in glob.glob(os.path.join(self.dir, "vectors-*.npy")):
+            if os.path.basename(path) != vectors_file:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass  # still mapped by a reader (Windows); cleaned up next write
+
+BACKENDS = {"pinecone": PineconeBackend, "local": LocalBackend}
+
+def open_backend(cfg: Dict[str, Any]):
+    name = cfg.get("backend", "pinecone")
+    if name not in BACKENDS:
+        raise ValueError(f"unknown rag backend: {name}")
+    return BACKENDS[name](cfg)
@@ -0,0 +1,233 @@
+import json, logging, os, re
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from server.rag.backends import resolve_path
+
+# Local lexical index over the ingested chunks: BM25 on character n-grams of
+# Thai runs (Thai is written without spaces) plus whole Latin/number tokens.
+# ingest writes rag/index/bm25.npz next to the vector store; RagSearcher loads
+# it for hybrid (RRF with the vector results) and lexical-only retrieval.
+
+log = logging.getLogger(__name__)
+
+FORMAT = 1
+_THAI_DIGITS = str.maketrans("๐๑๒๓๔๕๖๗๘๙", "0123456789")
+_ZERO_WIDTH = dict.fromkeys(map(ord, "\u200b\u200c\u200d\ufeff"))
+# Thai letters, vowels and tone marks (digits are translated first); Latin words and numbers
+_RUNS = re.compile(r"[\u0e01-\u0e3a\u0e40-\u0e4e]+|[0-9a-z]+(?:\.[0-9]+)?")
+
+def _is_thai(run: str) -> bool:
+    return "\u0e01" <= run[0] <= "\u0e4e"
+
+class ThaiTokenizer:
+    """
+    "ไข้สูง 39.5" -> ["ไข", "ข้", "้ส", ..., "ไข้", "ข้ส", ..., "39.5"] for ngram=(2, 3).
+    Thai runs become overlapping character n-grams, so no word dictionary is
+    needed and spelling variants still share most grams; runs shorter than the
+    smallest n are kept whole.
+    """
+    def __init__(self, ngram: Sequence[int] = (2, 3)):
+        self.ngram = tuple(sorted({int(n) for n in ngram}))
+
+    def __call__(self, text: str) -> List[str]:
+        norm = (text or "").lower().translate(_THAI_DIGITS).translate(_ZERO_WIDTH)
+        out: List[str] = []
+        for run in _RUNS.findall(norm):
+            if not _is_thai(run) or len(run) < self.ngram[0]:
+                out.append(run)
+                continue
+            for n in self.ngram:
+                out.extend(run[i:i + n] for i in range(len(run) - n + 1))
+        return out
+
+def _index_text(md: Dict[str, Any]) -> str:
+    return f"{md.get('title', '')}\n{md.get('text', '')}"
+
+class BM25Index:
+    """
+    Read side. Postings are stored CSR-style (vocab -> docs[indptr[t]:indptr[t+1]]);
+    the BM25 weight of every posting is computed once at load, so a query is a
+    fixed handful of numpy calls however many grams it has.
+    """
+    def __init__(self, header: Dict[str, Any], vocab: np.ndarray, indptr: np.ndarray,
+                 docs: np.ndarray, tfs: np.ndarray, doc_len: np.ndarray):
+        self.header = header
+        self.ids: List[str] = header["ids"]
+        self.metadatas: List[Dict[str, Any]] = header["metadatas"]
+        self.tokenizer = ThaiTokenizer(header["ngram"])
+        self.version = "bm25:" + header.get("build", "0")
+        self._terms = {t: i for i, t in enumerate(vocab.tolist())}
+        self._indptr = indptr
+        self._docs = docs
+        n = len(self.ids)
+        k1, b = float(header["k1"]), float(header["b"])
+        df = np.diff(indptr).astype(np.float32)
+        self._idf = np.log1p((n - df + 0.5) / (df + 0.5)).astype(np.float32)
+        self._idf_unseen = float(np.log1p((n + 0.5) / 0.5))
+        avgdl = float(doc_len.mean()) if n else 1.0
+        norm = k1 * (1 - b + b * doc_len / max(avgdl, 1e-9))
+        term_of = np.repeat(np.arange(len(df)), np.diff(indptr))
+        self._weights = (self._idf[term_of] * tfs * (k1 + 1) / (tfs + norm[docs])).astype(np.float32)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def query(self, text: str, top_k: int, min_coverage: float = 0.0) -> List[Dict[str, Any]]:
+        """
+        -> [{"id", "score", "metadata", "values": None}] like a vector backend.
+        min_coverage drops chunks that match less than that share of the query's
+        idf mass (greetings and off-topic text would otherwise pull snippets).
+        """
+        n = len(self.ids)
+        if n == 0 or top_k <= 0:
+            return []
+        counts: Dict[int, int] = {}
+        total_idf = 0.0
+        for tok in self.tokenizer(text):
+            t = self._terms.get(tok)
+            if t is not None:
+                counts[t] = counts.get(t, 0) + 1
+            # grams the corpus never uses count against coverage at the rarest idf
+            total_idf += float(self._idf[t]) if t is not None else self._idf_unseen
+        if not counts:
+            return []
+        terms = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        qtf = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+        # every posting of every query term in one gather, then one bincount per sum
+        starts = self._indptr[terms]
+        lens = self._indptr[terms + 1] - starts
+        offsets = np.repeat(starts - (np.cumsum(lens) - lens), lens) + np.arange(lens.sum())
+        docs = self._docs[offsets]
+        scores = np.bincount(docs, weights=self._weights[offsets] * np.repeat(qtf, lens), minlength=n)
+        covered = np.bincount(docs, weights=np.repeat(qtf * self._idf[terms], lens), minlength=n)
+        cand = np.flatnonzero(covered >= min_coverage * total_idf) if min_coverage > 0 else np.flatnonzero(scores)
+        if cand.size == 0:
+            return []
+        k = min(top_k, cand.size)
+        top = cand[np.argpartition(-scores[cand], k - 1)[:k]] if k < cand.size else cand
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [{"id": self.ids[i], "score": float(scores[i]), "metadata": self.metadatas[i], "values": None}
+                for i in top]
+
+def build_arrays(items: Iterable[Tuple[str, Dict[str, Any]]], tokenizer: ThaiTokenizer):
+    """(id, metadata) pairs -> ids, metadatas, vocab, indptr, docs, tfs, doc_len."""
+    ids, metadatas, doc_len = [], [], []
+    postings: Dict[str, List[Tuple[int, int]]] = {}
+    for d, (id_, md) in enumerate(items):
+        ids.append(id_)
+        metadatas.append(md)
+        toks = tokenizer(_index_text(md))
+        doc_len.append(len(toks))
+        tf: Dict[str, int] = {}
+        for tok in toks:
+            tf[tok] = tf.get(tok, 0) + 1
+        for tok, c in tf.items():
+            postings.setdefault(tok, []).append((d, c))
+    vocab = sorted(postings)
+    indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+    docs, tfs = [], []
+    for i, tok in enumerate(vocab):
+        plist = postings[tok]
+        indptr[i + 1] = indptr[i] + len(plist)
+        docs.extend(p[0] for p in plist)
+        tfs.extend(p[1] for p in plist)
+    return (ids, metadatas, np.array(vocab, dtype=str), indptr,
+            np.asarray(docs, dtype=np.int32), np.asarray(tfs, dtype=np.float32),
+            np.asarray(doc_len, dtype=np.float32))
+
+def index_path(cfg: Dict[str, Any]) -> str:
+    return resolve_path((cfg.get("lexical") or {}).get("path", "rag/index/bm25.npz"))
+
+def _params(cfg: Dict[str, Any]) -> Dict[str, Any]:
+    lcfg = cfg.get("lexical") or {}
+    return {"ngram": sorted({int(n) for n in lcfg.get("ngram", [2, 3])}),
+            "k1": float(lcfg.get("k1", 1.2)), "b": float(lcfg.get("b", 0.75))}
+
+def _read(path: str):
+    with np.load(path, allow_pickle=False) as z:
+        header = json.loads(str(z["header"]))
+        return header, z["vocab"], z["indptr"], z["docs"], z["tfs"], z["doc_len"]
+
+def open_lexical(cfg: Dict[str, Any]) -> Optional[BM25Index]:
+    """The index written by the last ingest, or None (disabled, not built yet, unreadable)."""
+    if not (cfg.get("lexical") or {}).get("enabled", False):
+        return None
+    path = index_path(cfg)
+    if not os.path.exists(path):
+        return None
+    try:
+        header, *arrays = _read(path)
+    except (OSError, ValueError, KeyError) as e:
+        log.warning("lexical index %s unreadable (%s); re-run ingest", path, e)
+        return None
+    if header.get("format") != FORMAT:
+        return None
+    return BM25Index(header, *arrays)
+
+class LexicalWriter:
+    """
+    Ingest side: starts from the chunks already in the index, takes the
+    upserts/deletes of this run and rewrites the file in one go. `complete`
+    is False when the stored index cannot be reused (missing, other store,
+    other tokenizer settings); ingest then re-chunks unchanged documents too.
+    """
+    def __init__(self, cfg: Dict[str, Any], store: str):
+        self.path = index_path(cfg)
+        self.params = _params(cfg)
+        self.store = store
+        self.items: Dict[str, Dict[str, Any]] = {}
+        self.complete = False
+        self.dirty = False
+        if os.path.exists(self.path):
+            try:
+                header = _read(self.path)[0]
+            except (OSError, ValueError, KeyError):
+                header = {}
+            if (header.get("format") == FORMAT and header.get("store") == store
+                    and all(header.get(k) == v for k, v in self.params.items())):
+                self.items = dict(zip(header["ids"], header["metadatas"]))
+                self.complete = True
+
+    def put(self, id_: str, md: Dict[str, Any]) -> None:
+        if self.items.get(id_) != md:
+            self.items[id_] = md
+            self.dirty = True
+
+    def delete(self, ids: Iterable[str]) -> None:
+        for id_ in ids:
+            if self.items.pop(id_, None) is not None:
+                self.dirty = True
+
+    def save(self, build: str) -> bool:
+        """Rewrite the index if anything changed; -> whether it was written."""
+        if not self.dirty and self.complete:
+            return False
+        ids, metadatas, vocab, indptr, docs, tfs, doc_len = build_arrays(
+            sorted(self.items.items()), ThaiTokenizer(self.params["ngram"]))
+        header = {"format": FORMAT, "store": self.store, "build": build,
+                  "ids": ids, "metadatas": metadatas, **self.params}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, header=np.array(json.dumps(header, ensure_ascii=False)), vocab=vocab,
+                     indptr=indptr, docs=docs, tfs=tfs, doc_len=doc_len)
+        os.replace(tmp, self.path)
+        self.dirty, self.complete = False, True
+        return True
+
+def rrf(ranked_lists: Sequence[Sequence[Dict[str, Any]]], top_k: int, k: int = 60) -> List[Dict[str, Any]]:
+    """
+    Reciprocal rank fusion of result lists keyed by (doc_id, snippet_id):
+    score = sum of 1 / (k + rank) over the lists a snippet appears in. The
+    first list's entry is kept for snippets found by several lists.
+    """
+    fused: Dict[Tuple[str, str], Tuple[float, Dict[str, Any]]] = {}
+    for results in ranked_lists:
+        for rank, r in enumerate(results, start=1):
+            key = (r["doc_id"], r["snippet_id"])
+            score, first = fused.get(key, (0.0, r))
+            fused[key] = (score + 1.0 / (k + rank), first)
+    out = sorted(fused.values(), key=lambda sr: -sr[0])[:top_k]
+    return [{**r, "score": round(s, 6)} for s, r in out]
@@ -0,0 +1,196 @@
+import os, re, sqlite3, hashlib, threading, time, unicodedata
+import numpy as np
+from collections import OrderedDict
+from typing import Dict, List, Optional, Any
+
+from server.rag.backends import resolve_path
+
+_WS = re.compile(r"\s+")
+
+def normalize_text(text: str) -> str:
+    return _WS.sub(" ", unicodedata.normalize("NFC", text or "")).strip()
+
+def cache_key(model: str, dim: int, text: str) -> str:
+    # text must already be normalized
+    h = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return f"{model}:{dim}:{h}"
+
+class EmbeddingCache:
+    """
+    Two tiers: in-process LRU (bounded by item count and bytes) in front of a
+    SQLite file that survives restarts and is shared by ingest and search.
+    get_mem/put_mem never touch the file, so async callers can use them on
+    the event loop and send get_disk/put_disk to a worker thread.
+    Disk hits refresh `last_used` in batches (every TOUCH_BATCH keys or
+    TOUCH_INTERVAL_S); the row count is tracked from this process's writes
+    and only re-counted when it crosses disk_max_items, which then evicts
+    down to EVICT_TO of the limit so evictions stay rare.
+    """
+    TOUCH_BATCH = 256
+    TOUCH_INTERVAL_S = 30.0
+    EVICT_TO = 0.95
+
+    def __init__(self, path: Optional[str], mem_max_items=4096, mem_max_bytes=64 << 20,
+                 disk_max_items=200_000):
+        self.mem_max_items = mem_max_items
+        self.mem_max_bytes = mem_max_bytes
+        self.disk_max_items = disk_max_items
+        self._mem: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._mem_bytes = 0
+        self._lock = threading.Lock()      # memory tier + stats
+        self._db_lock = threading.Lock()   # the SQLite connection (used from worker threads)
+        self.stats = {"mem_hits": 0, "disk_hits": 0, "misses": 0,
+                      "mem_evictions": 0, "disk_evictions": 0}
+        self._db = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                " key TEXT PRIMARY KEY, vec BLOB NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS ix_embeddings_last_used ON embeddings(last_used)")
+            self._db.commit()
+        # rows on disk as far as this process knows (other writers are seen at the next re-count)
+        self._disk_rows = self._count() if self._db is not None else 0
+        self._touched: Dict[str, float] = {}
+        self._touched_at = time.monotonic()
+
+    def _count(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def _flush_touches(self) -> None:
+        # caller holds _db_lock and commits
+        if self._touched:
+            self._db.executemany("UPDATE embeddings SET last_used=? WHERE key=?",
+                                 [(t, k) for k, t in self._touched.items()])
+            self._touched.clear()
+        self._touched_at = time.monotonic()
+
+    # ---- memory tier ----
+    def _mem_put(self, key: str, vec: np.ndarray) -> None:
+        old = self._mem.pop(key, None)
+        if old is not None:
+            self._mem_bytes -= old.nbytes
+        self._mem[key] = vec
+        self._mem_bytes += vec.nbytes
+        while self._mem and (len(self._mem) > self.mem_max_items or self._mem_bytes > self.mem_max_bytes):
+            _, ev = self._mem.popitem(last=False)
+            self._mem_bytes -= ev.nbytes
+            self.stats["mem_evictions"] += 1
+
+    def get_mem(self, keys: List[str]):
+        """Memory tier only (never blocks on the file): -> (found, keys still to look up on disk)."""
+        out: Dict[str, np.ndarray] = {}
+        pending = []
+        with self._lock:
+            for k in keys:
+                v = self._mem.get(k)
+                if v is not None:
+                    self._mem.move_to_end(k)
+                    out[k] = v
+                    self.stats["mem_hits"] += 1
+                elif k not in out:
+                    pending.append(k)
+            if self._db is None:
+                self.stats["misses"] += len(set(pending))
+        return out, list(dict.fromkeys(pending)) if self._db is not None else []
+
+    def get_disk(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """Disk tier for keys get_mem() did not find; hits are promoted to memory."""
+        out: Dict[str, np.ndarray] = {}
+        if self._db is None or not keys:
+            return out
+        now = time.time()
+        with self._db_lock:
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                q = "SELECT key, vec FROM embeddings WHERE key IN (%s)" % ",".join("?" * len(part))
+                for k, blob in self._db.execute(q, part):
+                    out[k] = np.frombuffer(blob, dtype=np.float32)
+                    self._touched[k] = now
+            if (len(self._touched) >= self.TOUCH_BATCH
+                    or time.monotonic() - self._touched_at >= self.TOUCH_INTERVAL_S):
+                self._flush_touches()
+                self._db.commit()
+        with self._lock:
+            for k, v in out.items():
+                self._mem_put(k, v)
+            self.stats["disk_hits"] += len(out)
+            self.stats["misses"] += len(keys) - len(out)
+        return out
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        out, pending = self.get_mem(keys)
+        out.update(self.get_disk(pending))
+        return out
+
+    def put_mem(self, items: Dict[str, np.ndarray]) -> None:
+        with self._lock:
+            for k, v in items.items():
+                self._mem_put(k, v)
+
+    def put_disk(self, items: Dict[str, np.ndarray]) -> None:
+        if self._db is None or not items:
+            return
+        now = time.time()
+        with self._db_lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings(key, vec, last_used) VALUES (?,?,?)",
+                [(k, v.astype(np.float32).tobytes(), now) for k, v in items.items()],
+            )
+            self._flush_touches()
+            self._disk_rows += len(items)      # replaced keys over-count; the re-count corrects it
+            evicted = 0
+            if self._disk_rows > self.disk_max_items:
+                count = self._count()
+                if count > self.disk_max_items:
+                    evicted = count - int(self.disk_max_items * self.EVICT_TO)
+                    self._db.execute(
+                        "DELETE FROM embeddings WHERE key IN "
+                        "(SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)", (evicted,)
+                    )
+                self._disk_rows = count - evicted
+            self._db.commit()
+        if evicted:
+            with self._lock:
+                self.stats["disk_evictions"] += evicted
+
+    def put_many(self, items: Dict[str, np.ndarray]) -> None:
+        self.put_mem(items)
+        self.put_disk(items)
+
+    @property
+    def on_disk(self) -> bool:
+        return self._db is not None
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            s = dict(self.stats)
+            s["mem_items"] = len(self._mem)
+            s["mem_bytes"] = self._mem_bytes
+        lookups = s["mem_hits"] + s["disk_hits"] + s["misses"]
+        s["hit_rate"] = (s["mem_hits"] + s["disk_hits"]) / lookups if lookups else 0.0
+        return s
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_embed_cache(cfg: Dict[str, Any]) -> Optional[EmbeddingCache]:
+    global _cache
+    ccfg = cfg["embeddings"].get("cache") or {}
+    if not ccfg.get("enabled", False):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                path = ccfg.get("path")
+                _cache = EmbeddingCache(
+                    resolve_path(path) if path else None,
+                    mem_max_items=int(ccfg.get("mem_max_items", 4096)),
+                    mem_max_bytes=int(ccfg.get("mem_max_bytes", 64 << 20)),
+                    disk_max_items=int(ccfg.get("disk_max_items", 200_000)),
+                )
+    return _cache
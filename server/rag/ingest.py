@@ -1,9 +1,16 @@
-import os, glob, uuid, time
+import os, sys, glob, json, time, hashlib, contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
+from typing import Dict, Any, List
 import frontmatter
 from markdown_it import MarkdownIt
 
 from server.config_loader import load_rag_settings
-from server.rag.search import embed_texts, get_pinecone
+from server.rag.search import embed_texts
+from server.rag.backends import open_backend, resolve_path
+from server.rag.bm25 import LexicalWriter
+from server.rag.embed_cache import get_embed_cache
+from server.text.tokens import approx_tokens
+from server.tracing import span
 
 ROOT = os.path.dirname(os.path.dirname(__file__))
 RAG_DIR = os.path.join(os.path.dirname(ROOT), "rag")
@@ -45,51 +52,286 @@ def split_len(text: str, target: int, overlap: int):
         start = end - overlap if end - overlap > start else end
     return out
 
-def ingest_all():
+def _sha(*parts) -> str:
+    h = hashlib.sha256()
+    for p in parts:
+        h.update(p if isinstance(p, bytes) else str(p).encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+def _manifest_path(cfg) -> str:
+    return resolve_path(cfg.get("manifest_path", "rag/index/manifest.json"))
+
+def _store_id(cfg) -> str:
+    # which physical index the manifest describes
+    if cfg.get("backend", "pinecone") == "local":
+        return "local:" + cfg.get("local", {}).get("path", "rag/index/local")
+    pc = cfg["pinecone"]
+    return f"pinecone:{pc['index']}:{pc.get('namespace', 'default')}"
+
+def _settings_id(cfg) -> str:
+    # anything that changes chunk boundaries or vectors invalidates every chunk
+    emb, ch = cfg["embeddings"], cfg["chunking_guidelines"]
+    return _sha(emb["model"], emb["dimension"], ch["target_chars"], ch["overlap_chars"])
+
+def load_manifest(cfg) -> Dict[str, Any]:
+    path = _manifest_path(cfg)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        man = json.load(f)
+    return man if man.get("store") == _store_id(cfg) else {}
+
+def save_manifest(cfg, man: Dict[str, Any]) -> None:
+    path = _manifest_path(cfg)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(man, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, path)
+
+def _parse_doc(path: str, old_docs: Dict[str, Any], reuse: bool, target_chars: int, overlap: int,
+               chunk_all: bool = False):
+    # stage 1 (parse workers): read + hash + frontmatter + chunk
+    with span("ingest.parse") as sp:
+        with open(path, "rb") as f:
+            raw = f.read()
+        doc_hash = _sha(raw)
+        post = frontmatter.loads(raw.decode("utf-8"))
+        meta = post.metadata
+        doc_id = meta.get("doc_id") or os.path.splitext(os.path.basename(path))[0]
+        version = str(meta.get("version","1.0"))
+        prev = old_docs.get(doc_id) or {}
+        doc = {"doc_id": doc_id, "path": path, "doc_hash": doc_hash, "version": version,
+               "meta": meta, "prev": prev, "chunks": None}
+        sp.set(doc_id=doc_id)
+        if reuse and not chunk_all and prev.get("doc_hash") == doc_hash and prev.get("version") == version:
+            return doc  # unchanged: no need to chunk
+        doc["chunks"] = chunk_markdown(post.content, target_chars=target_chars, overlap=overlap)
+        sp.set(chunks=len(doc["chunks"]))
+        return doc
+
+def _in_context(fn):
+    # pool threads do not inherit context vars; carry the request id and open span over
+    ctx = contextvars.copy_context()
+    return lambda *args: ctx.copy().run(fn, *args)
+
+class _Bounded:
+    """Submit jobs to a pool with at most `limit` in flight; results are handed to
+    on_done on the caller's thread, so downstream batching needs no locks."""
+    def __init__(self, pool, limit: int, on_done):
+        self.pool = pool
+        self.limit = max(1, int(limit))
+        self.on_done = on_done
+        self.inflight = set()
+        self.items = 0
+        self.t_first = None
+        self.t_last = None
+
+    def submit(self, fn, items: int, *args):
+        while len(self.inflight) >= self.limit:
+            self._wait(FIRST_COMPLETED)
+        if self.t_first is None:
+            self.t_first = time.perf_counter()
+        fut = self.pool.submit(_in_context(fn), *args)
+        fut.n_items = items
+        self.inflight.add(fut)
+
+    def _wait(self, mode):
+        done, _ = wait(self.inflight, return_when=mode)
+        for fut in done:
+            self.inflight.discard(fut)
+            res = fut.result()  # re-raises worker errors
+            self.items += fut.n_items
+            self.t_last = time.perf_counter()
+            self.on_done(res)
+
+    def drain(self):
+        while self.inflight:
+            self._wait(ALL_COMPLETED)
+
+    def rate(self) -> float:
+        if not self.items or self.t_first is None:
+            return 0.0
+        return self.items / max(self.t_last - self.t_first, 1e-9)
+
+class _Batcher:
+    # packs items until the next one would exceed either budget
+    def __init__(self, max_items: int, max_cost: int, emit):
+        self.max_items = max(1, int(max_items))
+        self.max_cost = int(max_cost)
+        self.emit = emit
+        self.buf = []
+        self.cost = 0
+
+    def add(self, item, cost: int):
+        if self.buf and (len(self.buf) >= self.max_items or self.cost + cost > self.max_cost):
+            self.flush()
+        self.buf.append(item)
+        self.cost += cost
+
+    def flush(self):
+        if self.buf:
+            batch, self.buf, self.cost = self.buf, [], 0
+            self.emit(batch)
+
+def _embed_batch(batch):
+    with span("ingest.embed", items=len(batch)):
+        embeds = embed_texts([it["metadata"]["text"] for it in batch])
+    for it, e in zip(batch, embeds):
+        it["values"] = e
+    return batch
+
+def _upsert_batch(backend, batch):
+    with span("ingest.upsert", items=len(batch)):
+        backend.upsert(batch)
+
+def _upsert_size(item, dim: int) -> int:
+    # rough request bytes: JSON metadata + ~12 bytes per serialized float
+    return len(json.dumps(item["metadata"], ensure_ascii=False).encode("utf-8")) + 12 * dim + 64
+
+def ingest_all(force: bool = False):
+    """
+    Incremental ingest against rag/index/manifest.json: only new/changed chunks
+    are embedded and upserted, ids of chunks that disappeared are deleted.
+    force=True re-embeds everything (orphans are still deleted).
+
+    Pipelined: parse/chunk in a worker pool -> embedding requests packed to an
+    item/token budget across documents -> size-capped upserts with bounded
+    requests in flight (settings under `ingest:` in rag_settings.yaml).
+    """
+    with span("ingest", force=force) as sp:
+        ok = _ingest_all(force)
+        sp.set(docs=ok["docs"], chunks=ok["chunks"], added=ok["added"], updated=ok["updated"],
+               deleted=ok["deleted"], skipped=ok["skipped"])
+    return ok
+
+def _ingest_all(force: bool):
     cfg = load_rag_settings()
-    pine = get_pinecone(cfg)
-    index = pine.Index(cfg["pinecone"]["index"])
+    backend = open_backend(cfg)
+    icfg = cfg.get("ingest") or {}
+    dim = int(cfg["embeddings"]["dimension"])
 
     target_chars = cfg["chunking_guidelines"]["target_chars"]
     overlap = cfg["chunking_guidelines"]["overlap_chars"]
 
+    old = load_manifest(cfg)
+    old_docs = old.get("docs", {})
+    settings_id = _settings_id(cfg)
+    reuse = not force and old.get("settings") == settings_id
+    # the BM25 index needs every chunk's text; if it cannot be carried over,
+    # unchanged documents are chunked again (their vectors are still reused)
+    lexical = LexicalWriter(cfg, _store_id(cfg)) if (cfg.get("lexical") or {}).get("enabled", False) else None
+    chunk_all = lexical is not None and not lexical.complete
+
+    new_docs: Dict[str, Any] = {}
+    stats = {"added": 0, "updated": 0, "deleted": 0, "skipped": 0}
+    to_delete: List[str] = []
     total_chunks = 0
     docs = 0
+    t0 = time.perf_counter()
 
-    for path in iter_docs():
-        post = frontmatter.load(path)
-        meta = post.metadata
-        body = post.content
-        doc_id = meta.get("doc_id") or os.path.splitext(os.path.basename(path))[0]
-        title = meta.get("title","")
-        version = meta.get("version","1.0")
-        category = meta.get("category","")
-        tags = meta.get("tags",[])
-
-        chunks = chunk_markdown(body, target_chars=target_chars, overlap=overlap)
-        ids = []
-        vectors = []
-        metadatas = []
-        for i, ch in enumerate(chunks, start=1):
-            snip_id = f"s{i}"
-            ids.append(f"{doc_id}:{snip_id}")
-            metadatas.append({
-                "doc_id": doc_id, "title": title, "version": version,
-                "category": category, "tags": ";".join(tags),
-                "snippet_id": snip_id, "text": ch
-            })
-            vectors.append(ch)
-
-        # embed and upsert
-        embeds = embed_texts(vectors)
-        to_upsert = [{"id": ids[i], "values": embeds[i], "metadata": metadatas[i]} for i in range(len(ids))]
-        # Pinecone v4 upsert
-        index.upsert(vectors=to_upsert, namespace=cfg["pinecone"].get("namespace","default"))
-
-        total_chunks += len(chunks); docs += 1
-
-    return {"docs": docs, "chunks": total_chunks}
+    parse_pool = ThreadPoolExecutor(max_workers=int(icfg.get("parse_workers", 4)))
+    embed_pool = ThreadPoolExecutor(max_workers=int(icfg.get("embed_concurrency", 2)))
+    upsert_pool = ThreadPoolExecutor(max_workers=int(icfg.get("upsert_concurrency", 4)))
+    try:
+        upserts = _Bounded(upsert_pool, icfg.get("upsert_concurrency", 4), lambda _: None)
+        upsert_batcher = _Batcher(
+            icfg.get("upsert_batch_items", 100), icfg.get("upsert_batch_bytes", 2_000_000),
+            lambda batch: upserts.submit(_upsert_batch, len(batch), backend, batch),
+        )
+
+        def on_embedded(batch):
+            for it in batch:
+                upsert_batcher.add(it, _upsert_size(it, dim))
+
+        embeds = _Bounded(embed_pool, icfg.get("embed_concurrency", 2), on_embedded)
+        embed_batcher = _Batcher(
+            icfg.get("embed_batch_items", 256), icfg.get("embed_batch_tokens", 100_000),
+            lambda batch: embeds.submit(_embed_batch, len(batch), batch),
+        )
+
+        t_parse = time.perf_counter()
+        parse = _in_context(_parse_doc)
+        parsed = parse_pool.map(
+            lambda p: parse(p, old_docs, reuse, target_chars, overlap, chunk_all), list(iter_docs())
+        )
+        n_parsed_chunks = 0
+        for doc in parsed:
+            doc_id, prev, meta = doc["doc_id"], doc["prev"], doc["meta"]
+            prev_chunks = prev.get("chunks", {}) if reuse else {}
+            docs += 1
+            if doc["chunks"] is None:
+                new_docs[doc_id] = prev
+                stats["skipped"] += len(prev_chunks)
+                total_chunks += len(prev_chunks)
+                continue
+
+            chunks = doc["chunks"]
+            n_parsed_chunks += len(chunks)
+            chunk_hashes = {}
+            for i, ch in enumerate(chunks, start=1):
+                snip_id = f"s{i}"
+                md = {
+                    "doc_id": doc_id, "title": meta.get("title",""), "version": meta.get("version","1.0"),
+                    "category": meta.get("category",""), "tags": ";".join(meta.get("tags",[])),
+                    "snippet_id": snip_id, "text": ch
+                }
+                if lexical is not None:
+                    lexical.put(f"{doc_id}:{snip_id}", md)
+                h = _sha(json.dumps(md, ensure_ascii=False, sort_keys=True))
+                chunk_hashes[snip_id] = h
+                if prev_chunks.get(snip_id) == h:
+                    stats["skipped"] += 1
+                    continue
+                stats["updated" if snip_id in (prev.get("chunks") or {}) else "added"] += 1
+                embed_batcher.add({"id": f"{doc_id}:{snip_id}", "metadata": md}, approx_tokens(ch))
+
+            # shrunk document: drop the tail ids
+            for snip_id in (prev.get("chunks") or {}):
+                if snip_id not in chunk_hashes:
+                    to_delete.append(f"{doc_id}:{snip_id}")
+
+            new_docs[doc_id] = {"path": os.path.relpath(doc["path"], RAG_DIR), "doc_hash": doc["doc_hash"],
+                                "version": doc["version"], "chunks": chunk_hashes}
+            total_chunks += len(chunks)
+        parse_s = time.perf_counter() - t_parse
+
+        embed_batcher.flush()
+        embeds.drain()
+        upsert_batcher.flush()
+        upserts.drain()
+    finally:
+        for pool in (parse_pool, embed_pool, upsert_pool):
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    # documents removed from rag/docs
+    for doc_id, prev in old_docs.items():
+        if doc_id not in new_docs:
+            to_delete.extend(f"{doc_id}:{snip_id}" for snip_id in prev.get("chunks", {}))
+
+    with span("ingest.commit", deleted=len(to_delete)):
+        if to_delete:
+            backend.delete(to_delete)
+        stats["deleted"] = len(to_delete)
+        backend.flush()
+        if lexical is not None:
+            lexical.delete(to_delete)
+            # named after the content, so an ingest that changes nothing keeps the version
+            lexical.save(build=_sha(json.dumps(new_docs, sort_keys=True))[:12])
+        save_manifest(cfg, {"store": _store_id(cfg), "settings": settings_id, "docs": new_docs})
+
+    throughput = {
+        "parse_chunks_per_s": round(n_parsed_chunks / parse_s, 1) if n_parsed_chunks else 0.0,
+        "embeddings_per_s": round(embeds.rate(), 1),
+        "upserts_per_s": round(upserts.rate(), 1),
+        "seconds": round(time.perf_counter() - t0, 3),
+    }
+    return {"docs": docs, "chunks": total_chunks, **stats, "throughput": throughput}
 
 if __name__ == "__main__":
-    ok = ingest_all()
+    ok = ingest_all(force="--force" in sys.argv)
     print("Indexed:", ok)
+    cache = get_embed_cache(load_rag_settings())
+    if cache is not None:
+        print("Embedding cache:", cache.snapshot())
@@ -0,0 +1,63 @@
+import threading, time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+class SnippetMemo:
+    """
+    In-process, per-session memo of the last retrieval: session id ->
+    (namespace, query, snippets, query embedding). A turn whose query (built
+    from the slot state) and namespace (config + corpus version) match reuses
+    the snippets without searching. LRU-bounded over sessions; entries expire
+    after `ttl_s`. Each worker keeps its own; a miss only costs a search.
+    """
+    def __init__(self, max_sessions: int = 4096, ttl_s: float = 3600.0):
+        self.max_sessions = max_sessions
+        self.ttl_s = ttl_s
+        # sid -> (expires, namespace, query, snippets, qvec)
+        self._items: "OrderedDict[str, Tuple[float, str, str, List[Dict[str, Any]], Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0}
+
+    def get(self, sid: str, ns: str, query: str) -> Optional[Tuple[List[Dict[str, Any]], Any]]:
+        """-> (snippets, qvec) stored for this session under the same namespace and query, or None."""
+        with self._lock:
+            hit = self._items.get(sid)
+            if hit is not None and hit[0] < time.monotonic():
+                del self._items[sid]
+                self.stats["expired"] += 1
+                hit = None
+            if hit is None or hit[1] != ns or hit[2] != query:
+                self.stats["misses"] += 1
+                return None
+            self._items.move_to_end(sid)
+            self.stats["hits"] += 1
+            return hit[3], hit[4]
+
+    def put(self, sid: str, ns: str, query: str, snippets: List[Dict[str, Any]], qvec: Any) -> None:
+        with self._lock:
+            self._items[sid] = (time.monotonic() + self.ttl_s, ns, query, snippets, qvec)
+            self._items.move_to_end(sid)
+            self.stats["stores"] += 1
+            while len(self._items) > self.max_sessions:
+                self._items.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"sessions": len(self._items), **self.stats}
+
+_memo = None
+_memo_lock = threading.Lock()
+
+def get_snippet_memo(cfg: Dict[str, Any]) -> Optional[SnippetMemo]:
+    """cfg = rag_settings; sizes are read when the memo is first built, `enabled` on every call."""
+    global _memo
+    lcfg = (cfg.get("search") or {}).get("lazy") or {}
+    if not lcfg.get("enabled", False):
+        return None
+    if _memo is None:
+        with _memo_lock:
+            if _memo is None:
+                _memo = SnippetMemo(max_sessions=int(lcfg.get("max_sessions", 4096)),
+                                    ttl_s=float(lcfg.get("ttl_s", 3600)))
+    return _memo
@@ -1,4 +1,5 @@
 import os
+import asyncio
 import numpy as np
 from typing import List, Dict, Any
 
@@ -7,103 +8,306 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from openai import OpenAI
-from pinecone import Pinecone
+from server.rag.backends import open_backend
+from server.rag.bm25 import open_lexical, rrf
+from server.rag.embed_cache import get_embed_cache, cache_key, normalize_text
+from server.llm.openai_client import get_async_openai
+from server.llm.resilience import ProviderUnavailable, get_caller
+from server.llm.scheduler import Overloaded, get_scheduler
+from server.metrics import counter
+from server.tracing import annotate, span
+
+LEXICAL_FALLBACKS = counter("aidgent_rag_lexical_fallback_total",
+                            "Hybrid searches answered from BM25 alone", ["reason"])
+EMBED_CACHE = counter("aidgent_embed_cache_total", "Embedding cache lookups per text (hit | miss)", ["result"])
 
 _client = None
-_pc = None
 
 def get_openai() -> OpenAI:
     global _client
     if _client is None:
-        _client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+        _client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"), max_retries=0)
     return _client
 
-def get_pinecone(cfg=None) -> Pinecone:
-    global _pc
-    if _pc is None:
-        _pc = Pinecone(api_key=os.environ.get("PINECONE_API_KEY"))
-    return _pc
+def _cache_keys(cfg, texts: List[str]):
+    # -> (cache, keys, normalized texts); cache is None when disabled
+    cache = get_embed_cache(cfg)
+    if cache is None:
+        return None, None, None
+    model = cfg["embeddings"]["model"]
+    dim = int(cfg["embeddings"]["dimension"])
+    norm = [normalize_text(t) for t in texts]
+    return cache, [cache_key(model, dim, t) for t in norm], norm
+
+def _misses(keys, norm, found):
+    # only misses go to the API, deduplicated, in one batched call
+    return {k: t for k, t in zip(keys, norm) if k not in found}
+
+def _cache_lookup(cfg, texts: List[str]):
+    # -> (cache, keys, found, miss{key: normalized text}); cache is None when disabled
+    cache, keys, norm = _cache_keys(cfg, texts)
+    if cache is None:
+        return None, None, None, None
+    found = cache.get_many(keys)
+    return cache, keys, found, _misses(keys, norm, found)
+
+def _fresh(miss, data):
+    return {k: np.asarray(d.embedding, dtype=np.float32) for k, d in zip(miss.keys(), data)}
+
+def _cache_fill(cache, keys, found, miss, data) -> List[List[float]]:
+    fresh = _fresh(miss, data)
+    if fresh:
+        cache.put_many(fresh)
+        found.update(fresh)
+    return [found[k].tolist() for k in keys]
+
+async def _acache_lookup(cfg, texts: List[str]):
+    # as _cache_lookup; only the memory tier runs on the event loop, SQLite in a thread
+    cache, keys, norm = _cache_keys(cfg, texts)
+    if cache is None:
+        return None, None, None, None
+    found, pending = cache.get_mem(keys)
+    if pending:
+        found.update(await asyncio.to_thread(cache.get_disk, pending))
+    return cache, keys, found, _misses(keys, norm, found)
+
+async def _acache_fill(cache, keys, found, miss, data) -> List[List[float]]:
+    fresh = _fresh(miss, data)
+    if fresh:
+        cache.put_mem(fresh)
+        found.update(fresh)
+        if cache.on_disk:
+            await asyncio.to_thread(cache.put_disk, fresh)
+    return [found[k].tolist() for k in keys]
+
+def _count_cache(cache, sp, n_texts: int, n_misses: int) -> None:
+    if cache is None:
+        return
+    sp.set(cache_hits=n_texts - n_misses)
+    if n_texts > n_misses:
+        EMBED_CACHE.inc(n_texts - n_misses, result="hit")
+    if n_misses:
+        EMBED_CACHE.inc(n_misses, result="miss")
 
 def embed_texts(texts: List[str]) -> List[List[float]]:
     cfg = load_rag_settings()
-    client = get_openai()
     model = cfg["embeddings"]["model"]
-    resp = client.embeddings.create(model=model, input=texts)
-    return [d.embedding for d in resp.data]
+    with span("rag.embed", texts=len(texts)) as sp:
+        cache, keys, found, miss = _cache_lookup(cfg, texts)
+        inputs = texts if cache is None else list(miss.values())
+        _count_cache(cache, sp, len(texts), len(inputs))
+        data = []
+        if inputs:
+            data = get_caller("embeddings").call_sync(
+                lambda timeout: get_openai().embeddings.create(model=model, input=inputs, timeout=timeout)
+            ).data
+        if cache is None:
+            return [d.embedding for d in data]
+        return _cache_fill(cache, keys, found, miss, data)
 
 def embed_query(text: str) -> List[float]:
     return embed_texts([text])[0]
 
+async def aembed_texts(texts: List[str]) -> List[List[float]]:
+    cfg = load_rag_settings()
+    model = cfg["embeddings"]["model"]
+    with span("rag.embed", texts=len(texts)) as sp:
+        cache, keys, found, miss = await _acache_lookup(cfg, texts)
+        inputs = texts if cache is None else list(miss.values())
+        _count_cache(cache, sp, len(texts), len(inputs))
+        data = []
+        if inputs:
+            async with get_scheduler("embeddings").slot():
+                resp = await get_caller("embeddings").call(
+                    lambda timeout: get_async_openai().embeddings.create(model=model, input=inputs, timeout=timeout)
+                )
+            data = resp.data
+        if cache is None:
+            return [d.embedding for d in data]
+        return await _acache_fill(cache, keys, found, miss, data)
+
+async def aembed_query(text: str) -> List[float]:
+    return (await aembed_texts([text]))[0]
+
 class RagSearcher:
+    """
+    The vector backend ("local" mmap matrix | "pinecone") and the BM25 index
+    over the same chunks (None until ingest builds it) are published together
+    as one (backend, version, lexical) tuple; a search reads it once, so a
+    re-ingest never pairs new vector ids with the old BM25 index.
+    """
     def __init__(self, cfg: Dict[str, Any]):
         self.cfg = cfg
-        self.pc = get_pinecone(cfg)
-        self.index = self.pc.Index(cfg["pinecone"]["index"])
-        self.namespace = cfg["pinecone"].get("namespace","default")
+        backend = open_backend(cfg)
+        self._live = (backend, backend.version, open_lexical(cfg))
 
-    def ingest_all(self) -> Dict[str, int]:
+    def ingest_all(self, force: bool = False) -> Dict[str, int]:
         from server.rag.ingest import ingest_all
-        return ingest_all()
+        ok = ingest_all(force=force)
+        lexical = open_lexical(self.cfg)
+        backend = self._live[0].reopen()
+        self._live = (backend, backend.version, lexical)
+        return ok
+
+    async def aclose(self) -> None:
+        await self._live[0].aclose()
+
+    @property
+    def backend(self):
+        return self._live[0]
+
+    @property
+    def lexical(self):
+        return self._live[2]
+
+    @property
+    def corpus_version(self) -> str:
+        _, version, lexical = self._live
+        if lexical is None:
+            return version
+        return f"{version}+{lexical.version}"
+
+    def _mode(self, lexical) -> str:
+        # vector | hybrid | lexical; without a BM25 index every mode is vector
+        return self.cfg["search"].get("mode", "vector") if lexical is not None else "vector"
+
+    @property
+    def mode(self) -> str:
+        return self._mode(self._live[2])
 
     def search(self, query: str, top_k=5, min_score=0.3, mmr=True) -> List[Dict[str, Any]]:
-        qvec = embed_query(query)
-        res = self.index.query(
-            namespace=self.namespace,
-            vector=qvec,
-            top_k=top_k*3 if mmr else top_k,
-            include_metadata=True
-        )
+        backend, _, lexical = self._live
+        mode = self._mode(lexical)
+        if mode == "lexical":
+            return self.lexical_search(query, top_k, lexical)
+        hcfg = self.cfg["search"].get("hybrid") or {}
+        depth = max(top_k, int(hcfg.get("depth", 2 * top_k))) if mode == "hybrid" else top_k
+        try:
+            qvec = embed_query(query)
+        except ProviderUnavailable as e:
+            if mode != "hybrid":
+                raise
+            LEXICAL_FALLBACKS.inc(reason=e.reason)
+            return self.lexical_search(query, top_k, lexical)
+        with span("rag.query", backend=self.cfg.get("backend", "pinecone")):
+            res = backend.query(qvec, top_k=depth*3 if mmr else depth, include_values=mmr)
+        vec = self._rank(qvec, res, depth, min_score, mmr)
+        if mode == "vector":
+            return vec
+        return rrf([vec, self.lexical_search(query, depth, lexical)], top_k, int(hcfg.get("rrf_k", 60)))
+
+    async def asearch(self, query: str, top_k=5, min_score=0.3, mmr=True) -> List[Dict[str, Any]]:
+        return (await self.asearch_vec(query, top_k, min_score, mmr))[1]
+
+    async def asearch_vec(self, query: str, top_k=5, min_score=0.3, mmr=True):
+        """
+        -> (query embedding or None, results); the embedding is reused by the response cache.
+        hybrid: BM25 runs while the embedding request is in flight and the two
+        rankings are fused (RRF); if the vector side fails, is shed, or takes
+        longer than search.hybrid.vector_budget_s, the BM25 results are returned alone.
+        """
+        backend, _, lexical = self._live
+        mode = self._mode(lexical)
+        if mode == "lexical":
+            return None, self.lexical_search(query, top_k, lexical)
+        if mode == "vector":
+            return await self._avector(backend, query, top_k, min_score, mmr)
+        hcfg = self.cfg["search"].get("hybrid") or {}
+        depth = max(top_k, int(hcfg.get("depth", 2 * top_k)))
+        vector = asyncio.ensure_future(self._avector(backend, query, depth, min_score, mmr))
+        await asyncio.sleep(0)      # let the embedding request go out first
+        lex = self.lexical_search(query, depth, lexical)
+        try:
+            qvec, vec = await asyncio.wait_for(vector, float(hcfg.get("vector_budget_s", 1.5)))
+        except (asyncio.TimeoutError, ProviderUnavailable, Overloaded) as e:
+            reason = getattr(e, "reason", "timeout")
+            LEXICAL_FALLBACKS.inc(reason=reason)
+            annotate(fallback="lexical", fallback_reason=reason)
+            return None, lex[:top_k]
+        return qvec, rrf([vec, lex], top_k, int(hcfg.get("rrf_k", 60)))
+
+    async def _avector(self, backend, query: str, top_k: int, min_score: float, mmr: bool):
+        qvec = await aembed_query(query)
+        with span("rag.query", backend=self.cfg.get("backend", "pinecone")):
+            res = await backend.aquery(qvec, top_k=top_k*3 if mmr else top_k, include_values=mmr)
+        return qvec, self._rank(qvec, res, top_k, min_score, mmr)
+
+    def lexical_search(self, query: str, top_k: int, lexical=None) -> List[Dict[str, Any]]:
+        lcfg = self.cfg.get("lexical") or {}
+        if lexical is None:
+            lexical = self.lexical
+        with span("rag.lexical") as sp:
+            res = lexical.query(query, top_k, float(lcfg.get("min_coverage", 0.0)))
+            out = [_snippet(m["metadata"], m["score"]) for m in res]
+            sp.set(results=len(out))
+        return out
+
+    def _rank(self, qvec, res, top_k, min_score, mmr) -> List[Dict[str, Any]]:
+        with span("rag.rank", mmr=mmr) as sp:
+            out = self._rank_matches(qvec, res, top_k, min_score, mmr)
+            sp.set(results=len(out))
+        return out
+
+    def _rank_matches(self, qvec, res, top_k, min_score, mmr) -> List[Dict[str, Any]]:
         matches = []
-        for m in res["matches"]:
-            score = m.get("score", 0.0) or 0.0
+        vecs = []
+        for m in res:
+            score = m["score"]
             md = m["metadata"]
             if score >= min_score:
-                matches.append({
-                    "doc_id": md["doc_id"],
-                    "title": md.get("title",""),
-                    "version": md.get("version","1.0"),
-                    "snippet_id": md["snippet_id"],
-                    "text": md["text"],
-                    "score": score
-                })
+                matches.append(_snippet(md, score))
+                vecs.append(m.get("values"))
 
         if not matches:
             return []
 
         if mmr:
-            # simple MMR over the candidate texts
-            return self._mmr_rank(qvec, matches, top_k)
+            return self._mmr_rank(qvec, matches, vecs, top_k)
         else:
             return sorted(matches, key=lambda x: x["score"], reverse=True)[:top_k]
 
-    def _mmr_rank(self, qvec, matches, k):
-        # build matrix
-        vecs = np.array(embed_texts([m["text"] for m in matches]))
-        q = np.array(qvec)
-        # cosine sim
-        sim_to_query = (vecs @ q) / (np.linalg.norm(vecs, axis=1) * np.linalg.norm(q) + 1e-9)
-        selected = []
-        lamb = 0.7
-        candidates = list(range(len(matches)))
-        while len(selected) < min(k, len(matches)) and candidates:
-            if not selected:
-                idx = int(np.argmax(sim_to_query[candidates]))
-                best = candidates[idx]
-                selected.append(best)
-                candidates.remove(best)
-                continue
-            # diversity penalty
-            max_sim_to_selected = []
-            for ci in candidates:
-                sim_sel = []
-                for si in selected:
-                    denom = (np.linalg.norm(vecs[ci]) * np.linalg.norm(vecs[si]) + 1e-9)
-                    sim = (vecs[ci] @ vecs[si]) / denom
-                    sim_sel.append(sim)
-                max_sim_to_selected.append(max(sim_sel) if sim_sel else 0.0)
-            scores = lamb * sim_to_query[candidates] - (1 - lamb) * np.array(max_sim_to_selected)
-            pick_local = int(np.argmax(scores))
-            pick = candidates[pick_local]
-            selected.append(pick)
-            candidates.remove(pick)
-        return [matches[i] for i in selected]
+    def _mmr_rank(self, qvec, matches, vecs, k):
+        # candidate vectors come back from the index; only re-embed if a backend dropped them
+        missing = [i for i, v in enumerate(vecs) if v is None or len(v) == 0]
+        if missing:
+            for i, v in zip(missing, embed_texts([matches[i]["text"] for i in missing])):
+                vecs[i] = v
+        lamb = self.cfg["search"].get("mmr_lambda", 0.7)
+        order = mmr_select(np.asarray(qvec, dtype=np.float32),
+                           np.asarray(vecs, dtype=np.float32), k, lamb)
+        return [matches[i] for i in order]
+
+def _snippet(md: Dict[str, Any], score: float) -> Dict[str, Any]:
+    return {
+        "doc_id": md["doc_id"],
+        "title": md.get("title",""),
+        "version": md.get("version","1.0"),
+        "snippet_id": md["snippet_id"],
+        "text": md["text"],
+        "score": score
+    }
+
+def mmr_select(q: np.ndarray, vecs: np.ndarray, k: int, lamb: float = 0.7) -> List[int]:
+    """Maximal marginal relevance over row vectors; returns picked row indices in order."""
+    n = vecs.shape[0]
+    k = min(k, n)
+    if k <= 0:
+        return []
+    V = vecs / (np.linalg.norm(vecs, axis=1, keepdims=True) + 1e-9)
+    q = q / (np.linalg.norm(q) + 1e-9)
+    sim_to_query = V @ q
+    sim = V @ V.T                                    # pairwise cosine, computed once
+
+    first = int(np.argmax(sim_to_query))
+    selected = [first]
+    taken = np.zeros(n, dtype=bool)
+    taken[first] = True
+    max_sim_to_selected = sim[first].copy()
+    while len(selected) < k:
+        scores = lamb * sim_to_query - (1 - lamb) * max_sim_to_selected
+        scores[taken] = -np.inf
+        pick = int(np.argmax(scores))
+        selected.append(pick)
+        taken[pick] = True
+        np.maximum(max_sim_to_selected, sim[pick], out=max_sim_to_selected)
+    return selected
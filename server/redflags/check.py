@@ -1,29 +1,138 @@
 import os, re, yaml
+from typing import Any, Dict, List, Optional
+
+from server.text.ahocorasick import AhoCorasick
 
 ROOT = os.path.dirname(os.path.dirname(__file__))
 RULE_PATH = os.path.join(ROOT, "redflags", "rules_th.yaml")
 
+_META = set(".^$*+?{}[]\\|()")
+
+def top_level_branches(pattern: str) -> List[str]:
+    """
+    `pattern` split at its top-level "|" (not inside a group or a character
+    class, not escaped): "ไข้\\s*สูง|ชัก" -> ["ไข้\\s*สูง", "ชัก"].
+    """
+    out, depth, i, last = [], 0, 0, 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == "\\":
+            i += 2  # escaped char (\|, \(, \d ...) is never structure
+            continue
+        if ch == "[":
+            # a class is one char; "(" or "|" inside it is not structure
+            j = i + 1 + (pattern[i + 1:i + 2] == "^")
+            j += pattern[j:j + 1] == "]"
+            while j < len(pattern) and pattern[j] != "]":
+                j += 2 if pattern[j] == "\\" else 1
+            i = j + 1
+            continue
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == "|" and depth == 0:
+            out.append(pattern[last:i])
+            last = i + 1
+        i += 1
+    out.append(pattern[last:])
+    return out
+
+def literal_prefix(pattern: str) -> Optional[str]:
+    """
+    Longest literal every match of `pattern` must start with, or None.
+    Returns the pattern itself when it has no regex syntax at all.
+    """
+    if len(top_level_branches(pattern)) > 1:
+        return None  # top-level alternation: no common prefix
+    prefix = []
+    for ch in pattern:
+        if ch in _META:
+            # a quantifier makes the previous char optional
+            if ch in "?*{" and prefix:
+                prefix.pop()
+            break
+        prefix.append(ch)
+    return "".join(prefix) or None
+
 class RedFlagChecker:
-    def __init__(self):
-        with open(RULE_PATH, "r", encoding="utf-8") as f:
+    """
+    Rules from rules_th.yaml compiled into one Aho-Corasick automaton.
+    Literal patterns are matched directly; regex patterns are only tried at
+    positions where their literal prefix occurs (each top-level alternative
+    on its own). Patterns with an alternative that has no usable prefix fall
+    back to a plain regex search.
+    """
+    def __init__(self, rule_path: str = RULE_PATH):
+        with open(rule_path, "r", encoding="utf-8") as f:
             data = yaml.safe_load(f)
         self.rules = []
-        for key, rule in data["rules"].items():
+        keys: List[str] = []
+        self._payloads: List[List[tuple]] = []
+        self._fallback: List[tuple] = []
+        key_ids: Dict[str, int] = {}
+        for prio, (key, rule) in enumerate(data["rules"].items()):
             pats = [re.compile(pat, flags=re.IGNORECASE) for pat in rule["patterns"]]
             self.rules.append({"label": rule["label"], "patterns": pats})
+            for rx in pats:
+                # inline flags apply to the whole pattern: keep it in one piece
+                branches = [rx.pattern] if rx.pattern.startswith("(?") else top_level_branches(rx.pattern)
+                prefixes = [literal_prefix(b) for b in branches]
+                if None in prefixes:
+                    self._fallback.append((prio, rule["label"], rx))
+                    continue
+                for branch, prefix in zip(branches, prefixes):
+                    prefix = prefix.lower()
+                    # a pure literal needs no regex confirmation
+                    confirm = None if prefix == branch.lower() else re.compile(branch, flags=re.IGNORECASE)
+                    if prefix not in key_ids:
+                        key_ids[prefix] = len(keys)
+                        keys.append(prefix)
+                        self._payloads.append([])
+                    self._payloads[key_ids[prefix]].append((prio, rule["label"], rx, confirm))
+        self._ac = AhoCorasick(keys)
+
+    def scan(self, text: str) -> List[Dict[str, Any]]:
+        """Every (label, pattern) hit with its first offset, ordered by offset."""
+        low = text.lower()
+        if len(low) != len(text):
+            low = text  # rare case-mapping length change; keep offsets aligned
+        seen = set()
+        hits = []
+        for start, kid in self._ac.iter(low):
+            for prio, label, rx, confirm in self._payloads[kid]:
+                if (prio, rx.pattern) in seen:
+                    continue
+                if confirm is None:
+                    end = start + len(self._ac.patterns[kid])
+                else:
+                    m = confirm.match(text, start)
+                    if not m:
+                        continue
+                    end = m.end()
+                seen.add((prio, rx.pattern))
+                hits.append({"label": label, "pattern": rx.pattern, "start": start, "end": end, "_prio": prio})
+        for prio, label, rx in self._fallback:
+            m = rx.search(text)
+            if m:
+                hits.append({"label": label, "pattern": rx.pattern, "start": m.start(), "end": m.end(), "_prio": prio})
+        hits.sort(key=lambda h: (h["start"], h["_prio"]))
+        return hits
 
     def detect(self, text: str):
         t = (text or "").strip()
         if not t:
-            return {"is_emergency": False, "label": None, "triggers": []}
-        triggers = []
-        label = None
-        for rule in self.rules:
-            for pat in rule["patterns"]:
-                if pat.search(t):
-                    triggers.append(pat.pattern)
-                    label = rule["label"]
-                    break
-            if label:
-                break
-        return {"is_emergency": bool(label), "label": label, "triggers": triggers}
+            return {"is_emergency": False, "label": None, "labels": [], "triggers": [], "matches": []}
+        hits = self.scan(t)
+        if not hits:
+            return {"is_emergency": False, "label": None, "labels": [], "triggers": [], "matches": []}
+        by_prio = sorted(hits, key=lambda h: h["_prio"])
+        labels = list(dict.fromkeys(h["label"] for h in by_prio))
+        matches = [{k: h[k] for k in ("label", "pattern", "start", "end")} for h in hits]
+        return {
+            "is_emergency": True,
+            "label": labels[0],                      # highest-priority rule (file order), as before
+            "labels": labels,
+            "triggers": list(dict.fromkeys(h["pattern"] for h in hits)),
+            "matches": matches,
+        }
@@ -1,15 +1,64 @@
 import os
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker, DeclarativeBase
 
 DB_URL = os.environ.get("DB_URL", "sqlite:///./aidgent.db")
+BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", "5000"))
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "10"))
+MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "20"))
 
 class Base(DeclarativeBase):
     pass
 
-engine = create_engine(DB_URL, echo=False, future=True)
+def _make_engine(url: str):
+    if not url.startswith("sqlite"):
+        return create_engine(url, echo=False, future=True, pool_size=POOL_SIZE,
+                             max_overflow=MAX_OVERFLOW, pool_pre_ping=True)
+    # request handlers run in worker threads; each pooled connection is used by one thread at a time
+    eng = create_engine(
+        url, echo=False, future=True,
+        connect_args={"check_same_thread": False, "timeout": BUSY_TIMEOUT_MS / 1000},
+        pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW,
+    )
+
+    @event.listens_for(eng, "connect")
+    def _sqlite_pragmas(dbapi_conn, _record):
+        # WAL: readers don't block the writer; NORMAL only fsyncs at checkpoints
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        cur.close()
+
+    return eng
+
+engine = _make_engine(DB_URL)
 SessionLocal = sessionmaker(bind=engine, expire_on_commit=False)
 
+def insert_missing(db, model, **values) -> None:
+    """
+    Insert a row unless its primary key already exists. Two API workers may
+    create the same session at once; the loser keeps going with the winner's row.
+    """
+    dialect = db.get_bind().dialect.name
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        try:
+            with db.begin_nested():
+                db.add(model(**values))
+        except IntegrityError:
+            pass
+        return
+    db.execute(insert(model).values(**values).on_conflict_do_nothing())
+
 def init_db():
-    from server.storage.models import Message, SessionRec, SoapSummary, Citation
+    from server.storage.models import Message, SessionRec, SoapSummary, Citation, SessionState
     Base.metadata.create_all(engine)
+    # create_all skips tables that already exist, so add indexes introduced later
+    for table in Base.metadata.sorted_tables:
+        for idx in table.indexes:
+            idx.create(engine, checkfirst=True)
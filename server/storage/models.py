@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, Text
+from sqlalchemy import Column, String, Integer, Text, Index
 from server.storage.db import Base
 
 class SessionRec(Base):
@@ -17,6 +17,11 @@ class Message(Base):
     state_json = Column(Text)
     created_at = Column(String)
 
+    __table_args__ = (
+        Index("ix_messages_session_created", "session_id", "created_at"),
+        Index("ix_messages_session_role_created", "session_id", "role", "created_at"),
+    )
+
 class SoapSummary(Base):
     __tablename__ = "soap_summaries"
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -31,3 +36,12 @@ class Citation(Base):
     turn_id = Column(Integer)
     doc_id = Column(String)
     snippet_ids = Column(String)
+
+class SessionState(Base):
+    """Materialized per-session view: merged slot state + last turns, rewritten every turn."""
+    __tablename__ = "session_state"
+    session_id = Column(String, primary_key=True)
+    state_json = Column(Text)
+    history_json = Column(Text)
+    last_message_id = Column(Integer)
+    updated_at = Column(String)
@@ -0,0 +1,127 @@
+import os, json, threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from server.storage.db import insert_missing
+from server.storage.models import Message, SessionState
+
+HISTORY_KEEP = 10  # messages kept on the record; prompts use the tail of it
+CACHE_MAX = int(os.environ.get("SESSION_CACHE_MAX", "1024"))
+
+class SessionStateCache:
+    """
+    Bounded LRU of session_id -> (last_message_id, state_json text, history)
+    in front of the session_state table. Write-through: entries are only put
+    after the row has been committed. Process-local (one per API worker), so
+    an entry is only trusted while the row's last_message_id still matches:
+    another worker may have written the session since.
+    """
+    def __init__(self, max_items: int = CACHE_MAX):
+        self.max_items = max_items
+        self._items: "OrderedDict[str, Tuple[Optional[int], str, Tuple[Dict[str, str], ...]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sid: str):
+        with self._lock:
+            v = self._items.get(sid)
+            if v is not None:
+                self._items.move_to_end(sid)
+            return v
+
+    def put(self, sid: str, last_id: Optional[int], state_json: str, history: List[Dict[str, str]]) -> None:
+        with self._lock:
+            self._items[sid] = (last_id, state_json, tuple(history))
+            self._items.move_to_end(sid)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def drop(self, sid: str) -> None:
+        with self._lock:
+            self._items.pop(sid, None)
+
+cache = SessionStateCache()
+
+def _decode(state_json: Optional[str]) -> Dict[str, Any]:
+    if not state_json:
+        return {}
+    try:
+        return json.loads(state_json)
+    except Exception:
+        return {}
+
+def _rebuild(db, sid: str, before_id: Optional[int] = None) -> Tuple[str, List[Dict[str, str]]]:
+    """
+    Derive the record from messages, for sessions written before session_state
+    existed; `before_id` leaves out messages flushed by the current transaction.
+    """
+    older = [Message.session_id == sid]
+    if before_id is not None:
+        older.append(Message.id < before_id)
+    msgs = (
+        db.query(Message)
+        .filter(*older)
+        .order_by(Message.created_at.desc(), Message.id.desc())
+        .limit(HISTORY_KEEP)
+        .all()
+    )
+    history = [{"role": m.role, "text": m.text} for m in reversed(msgs)]
+    last_ai = (
+        db.query(Message)
+        .filter(*older, Message.role == "assistant")
+        .order_by(Message.created_at.desc(), Message.id.desc())
+        .first()
+    )
+    return (last_ai.state_json or "{}") if last_ai else "{}", history
+
+def _read(db, sid: str) -> Tuple[Optional[int], str, List[Dict[str, str]]]:
+    """The stored record: -> (last_message_id, state_json, history)."""
+    row = db.get(SessionState, sid)
+    if row is not None:
+        return row.last_message_id, row.state_json or "{}", json.loads(row.history_json or "[]")
+    return (None, *_rebuild(db, sid))
+
+def _load_raw(db, sid: str) -> Tuple[str, List[Dict[str, str]]]:
+    hit = cache.get(sid)
+    if hit is not None:
+        # one keyed lookup decides whether this worker's copy is still current
+        last_id = db.query(SessionState.last_message_id).filter(SessionState.session_id == sid).scalar()
+        if last_id == hit[0]:
+            return hit[1], list(hit[2])
+    last_id, state_json, history = _read(db, sid)
+    cache.put(sid, last_id, state_json, history)
+    return state_json, history
+
+def load_session_state(db, sid: str, max_turns: int = 2) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+    """-> (last max_turns*2 messages, merged state of the last assistant turn)"""
+    state_json, history = _load_raw(db, sid)
+    return history[-max_turns * 2:], _decode(state_json)
+
+def append_messages(db, sid: str, msgs: List[Message], now: str) -> Tuple[int, str, List[Dict[str, str]]]:
+    """
+    Fold just-flushed messages into the session's record (an assistant message
+    also replaces the state). Call inside the transaction that adds `msgs`;
+    pass the result to publish() once it has committed. The record is read
+    from the table, never from the cache, so a stale copy is not written back.
+    """
+    row = db.get(SessionState, sid)
+    if row is None:
+        # first turn or legacy session; another worker may be creating the row
+        # too, and then its record is the one the messages are folded into
+        state_json, history = _rebuild(db, sid, before_id=msgs[0].id)
+        insert_missing(db, SessionState, session_id=sid, state_json=state_json,
+                       history_json=json.dumps(history, ensure_ascii=False), updated_at=now)
+        row = db.get(SessionState, sid)
+    state_json, history = row.state_json or "{}", json.loads(row.history_json or "[]")
+    for msg in msgs:
+        history.append({"role": msg.role, "text": msg.text})
+        if msg.role == "assistant":
+            state_json = msg.state_json or "{}"
+    history = history[-HISTORY_KEEP:]
+    row.state_json = state_json
+    row.history_json = json.dumps(history, ensure_ascii=False)
+    row.last_message_id = msgs[-1].id
+    row.updated_at = now
+    return row.last_message_id, state_json, history
+
+def publish(sid: str, record: Tuple[int, str, List[Dict[str, str]]]) -> None:
+    cache.put(sid, *record)
@@ -0,0 +1,78 @@
+import json
+from datetime import datetime, timezone
+from typing import Any, Dict
+
+from sqlalchemy import insert
+
+from server.storage.db import SessionLocal, insert_missing
+from server.storage.models import Message, SessionRec, SoapSummary, Citation
+from server.storage.session_state import load_session_state, append_messages, publish
+from server.tracing import span
+
+# Per-turn DB work; the API runs these in worker threads.
+
+def now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+def load_turn(sid: str, user_text: str, max_turns: int = 2):
+    """History (ending with this user message) + previous state; no writes."""
+    with span("db.load_turn"), SessionLocal() as db:
+        history, prev_state = load_session_state(db, sid, max_turns=max_turns)
+    history = (history + [{"role": "user", "text": user_text}])[-max_turns * 2:]
+    return history, prev_state
+
+def _ensure_session(db, sid: str, now: str) -> None:
+    insert_missing(db, SessionRec, id=sid, created_at=now, age_bucket="unknown", consent_flags="{}")
+
+def persist_user_message(sid: str, user_text: str) -> None:
+    """A turn that failed before it had a reply still records what the patient wrote."""
+    with span("db.persist_turn", reply=False), SessionLocal() as db:
+        now = now_iso()
+        _ensure_session(db, sid, now)
+        msg_user = Message(session_id=sid, role="user", text=user_text, state_json="{}", created_at=now)
+        db.add(msg_user)
+        db.flush()
+        record = append_messages(db, sid, [msg_user], now)
+        db.commit()
+    publish(sid, record)
+
+def persist_turn(sid: str, user_text: str, user_view: str, state_json: Dict[str, Any]) -> None:
+    """One transaction per turn: session, both messages, SOAP, citations, session state."""
+    with span("db.persist_turn"), SessionLocal() as db:
+        now = now_iso()
+        _ensure_session(db, sid, now)
+
+        msg_user = Message(session_id=sid, role="user", text=user_text, state_json="{}", created_at=now)
+        msg_ai = Message(
+            session_id=sid,
+            role="assistant",
+            text=user_view,
+            state_json=json.dumps(state_json, ensure_ascii=False),
+            created_at=now_iso(),
+        )
+        db.add_all([msg_user, msg_ai])
+        db.flush()
+
+        # persist SOAP + citations if present
+        if state_json.get("soap_ready") and state_json.get("soap_json"):
+            db.add(
+                SoapSummary(
+                    session_id=sid,
+                    soap_json=json.dumps(state_json["soap_json"], ensure_ascii=False),
+                    created_at=msg_ai.created_at,   # transcript pages place SOAPs by this
+                )
+            )
+        if state_json.get("citations"):
+            db.execute(insert(Citation), [
+                {
+                    "session_id": sid,
+                    "turn_id": msg_ai.id,
+                    "doc_id": cit.get("doc_id", ""),
+                    "snippet_ids": ",".join(cit.get("snippet_ids", [])),
+                }
+                for cit in state_json["citations"]
+            ])
+
+        record = append_messages(db, sid, [msg_user, msg_ai], now)
+        db.commit()
+    publish(sid, record)
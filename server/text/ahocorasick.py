@@ -0,0 +1,85 @@
+from collections import deque
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+class AhoCorasick:
+    """
+    Multi-pattern literal matcher: one pass over the text finds every occurrence
+    of every pattern, independent of how many patterns were added.
+    Pattern ids are the positions in the input iterable.
+    """
+    def __init__(self, patterns: Iterable[str]):
+        self.patterns: List[str] = list(patterns)
+        self._lens = [len(p) for p in self.patterns]
+        goto: List[Dict[str, int]] = [{}]
+        out: List[List[int]] = [[]]
+        for pid, pat in enumerate(self.patterns):
+            if not pat:
+                continue
+            s = 0
+            for ch in pat:
+                nxt = goto[s].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[s][ch] = nxt
+                    goto.append({})
+                    out.append([])
+                s = nxt
+            out[s].append(pid)
+
+        # BFS for failure links; outputs are flattened along them so a scan
+        # never has to walk dictionary-suffix chains
+        fail = [0] * len(goto)
+        order: List[int] = []
+        q = deque(goto[0].values())
+        while q:
+            s = q.popleft()
+            order.append(s)
+            for ch, nxt in goto[s].items():
+                q.append(nxt)
+                f = fail[s]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                cand = goto[f].get(ch, 0)
+                fail[nxt] = cand if cand != nxt else 0
+                out[nxt].extend(out[fail[nxt]])
+
+        # transitions resolved through failure links ahead of time, except the
+        # root's (the common case), which scans fall back to; a step is then one
+        # or two dict lookups instead of a walk up the failure chain
+        delta: List[Dict[str, int]] = [{} for _ in goto]
+        for s in order:
+            f = fail[s]
+            delta[s] = {**delta[f], **goto[s]} if f else dict(goto[s])
+
+        self._root = goto[0]
+        self._delta = delta
+        self._out: List[Tuple[int, ...]] = [tuple(o) for o in out]
+
+    def iter(self, text: str) -> Iterator[Tuple[int, int]]:
+        """Yield (start, pattern_id) for every occurrence, in order of end offset."""
+        for start, _end, pid in self.iter_spans(text):
+            yield start, pid
+
+    def iter_spans(self, text: str) -> Iterator[Tuple[int, int, int]]:
+        """Yield (start, end, pattern_id) for every occurrence, in order of end offset."""
+        root, delta, out, lens = self._root, self._delta, self._out, self._lens
+        s = 0
+        for i, ch in enumerate(text):
+            nxt = delta[s].get(ch)
+            s = nxt if nxt is not None else root.get(ch, 0)
+            if out[s]:
+                for pid in out[s]:
+                    yield i + 1 - lens[pid], i + 1, pid
+
+    def find_all(self, text: str) -> List[Tuple[int, int]]:
+        return list(self.iter(text))
+
+def leftmost_longest(spans: Iterable[Tuple[int, int, Any]]) -> List[Tuple[int, int, Any]]:
+    """Non-overlapping subset of (start, end, x) spans: leftmost first, longest on ties."""
+    out: List[Tuple[int, int, Any]] = []
+    last_end = -1
+    for sp in sorted(spans, key=lambda sp: (sp[0], -sp[1])):
+        if sp[0] >= last_end:
+            out.append(sp)
+            last_end = sp[1]
+    return out
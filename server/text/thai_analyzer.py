@@ -0,0 +1,245 @@
+import re, threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from server.config_loader import config_snapshot
+from server.text.ahocorasick import AhoCorasick, leftmost_longest
+
+_WS = frozenset(" \t\r\n\u00a0\u200b")
+_THAI_DIGITS = str.maketrans("๐๑๒๓๔๕๖๗๘๙", "0123456789")
+_NUM_TAIL = re.compile(r"(\d+(?:\.\d+)?)\s*$")
+_NUMBERS = re.compile(r"\d+(?:\.\d+)?")
+
+# hit kinds
+SYMPTOM, NUMBER, UNIT, UNKNOWN, NEG, POS = "symptom", "num", "unit", "unknown", "neg", "pos"
+SYMPTOM_NEG = "symptom_neg"
+
+def _squash(s: str) -> str:
+    return "".join(ch for ch in s if ch not in _WS)
+
+def _continues(last: str, role: str) -> bool:
+    # which number word may follow which inside one run
+    if role == "after_ten":
+        return last == "mult10"
+    if role in ("mult10", "mult"):
+        return last in ("digit", "before_ten")
+    if role == "digit":
+        return last in ("mult10", "mult")
+    return False
+
+class Analysis:
+    """
+    Result of one pass over a user message. `norm` is the text lowercased with
+    Thai digits and number words rewritten as ASCII numbers; `hits` maps a kind
+    to its (start, end, label) spans in the lowercased text, all of them,
+    overlapping ones included.
+    """
+    __slots__ = ("text", "norm", "compact", "hits", "duration", "_an", "_labels")
+
+    def __init__(self, an: "ThaiAnalyzer", text: str):
+        self._an = an
+        self.text = text
+        low = text.lower().translate(_THAI_DIGITS)
+        if len(low) != len(text):
+            low = text.translate(_THAI_DIGITS)   # keep offsets aligned
+        self.compact = _squash(low)
+
+        hits: Dict[str, List[Tuple[int, int, Any]]] = {}
+        payloads = an._payloads
+        for start, end, kid in an._ac.iter_spans(low):
+            for kind, label in payloads[kid]:
+                hits.setdefault(kind, []).append((start, end, label))
+        self.hits = hits
+        self._labels: Dict[str, List[Any]] = {}
+        runs = self._number_runs(low)
+        self.norm = self._rewrite(low, runs)
+        self.duration = self._duration(low, runs)
+
+    # ---- numbers ----
+    def _number_runs(self, low: str) -> List[Tuple[int, int, int]]:
+        """Adjacent number words composed into values: (start, end, value)."""
+        runs: List[Tuple[int, int, int]] = []
+        cur: Optional[List[Any]] = None          # [start, end, total, pending, roles]
+        for start, end, (role, val) in leftmost_longest(self.hits.get(NUMBER, ())):
+            if cur is not None and not low[cur[1]:start].strip() and _continues(cur[4][-1], role):
+                cur[1] = end
+            else:
+                if cur is not None:
+                    runs.append(cur)
+                cur = [start, end, 0, 0, []]
+            if role in ("digit", "before_ten", "after_ten"):
+                cur[3] = val
+            else:   # multiplier: pending digit (default 1) times the multiplier
+                cur[2] += (cur[3] or 1) * val
+                cur[3] = 0
+            cur[4].append(role)
+        if cur is not None:
+            runs.append(cur)
+        # a lone เอ็ด / ยี่ is not a number
+        return [(r[0], r[1], r[2] + r[3]) for r in runs
+                if not (len(r[4]) == 1 and r[4][0] in ("after_ten", "before_ten"))]
+
+    def _rewrite(self, low: str, runs: List[Tuple[int, int, int]]) -> str:
+        if not runs:
+            return low
+        out, pos = [], 0
+        for start, end, value in runs:
+            out.append(low[pos:start])
+            prev = out[-1] or (out[-2] if len(out) > 1 else "")
+            # keep separate numbers apart ("สองสาม" -> "2 3", not "23")
+            out.append((" " if prev[-1:].isdigit() else "") + str(value))
+            pos = end
+        out.append(low[pos:])
+        return "".join(out)
+
+    # ---- duration ----
+    def _duration(self, low: str, runs: List[Tuple[int, int, int]]) -> Optional[str]:
+        units = sorted(self.hits.get(UNIT, ()))
+        if not units:
+            return None
+        word_ends = {end: value for _, end, value in runs}
+        for start, _end, unit in units:
+            head = low[:start].rstrip()
+            m = _NUM_TAIL.search(head[-32:])
+            if m:
+                return f"{m.group(1)} {unit}"
+            if len(head) in word_ends:
+                return f"{word_ends[len(head)]} {unit}"
+        return None
+
+    # ---- queries ----
+    def has(self, kind: str) -> bool:
+        return kind in self.hits
+
+    def labels(self, kind: str) -> List[Any]:
+        """Distinct labels of `kind`, in lexicon order; overlaps resolve leftmost-longest."""
+        got = self._labels.get(kind)
+        if got is None:
+            spans = self.hits.get(kind)
+            got = self._ranked(kind, leftmost_longest(spans)) if spans else []
+            self._labels[kind] = got
+        return list(got)
+
+    def symptoms(self) -> List[str]:
+        """Symptom labels not directly preceded by a negation marker ("ไม่มีไข้", "ไม่ไอ")."""
+        got = self._labels.get("_symptoms")
+        if got is None:
+            spans = self.hits.get(SYMPTOM)
+            got = []
+            if spans:
+                negs = {end for kind in (NEG, SYMPTOM_NEG) for _, end, _ in self.hits.get(kind, ())}
+                kept = []
+                for start, end, label in leftmost_longest(spans):
+                    if self._skip_ws_back(start) not in negs:
+                        kept.append((start, end, label))
+                got = self._ranked(SYMPTOM, kept)
+            self._labels["_symptoms"] = got
+        return list(got)
+
+    def yes_no(self) -> Optional[bool]:
+        """
+        The answer when a yes/no marker opens the reply ("มีค่ะ", "ไม่ได้ค่ะ"):
+        False for a negation, True for an affirmation. None when the reply
+        opens with anything else, when the marker introduces a symptom
+        ("มีไข้", "ไม่มีไอ") or when the reply also has the opposite marker.
+        """
+        spans = [(s, e, kind) for kind in (NEG, POS) for s, e, _ in self.hits.get(kind, ())]
+        if not spans:
+            return None
+        markers = leftmost_longest(spans)
+        start, end, kind = markers[0]
+        if start != self._skip_ws(0) or any(k != kind for _, _, k in markers[1:]):
+            return None
+        after = self._skip_ws(end)
+        if any(s == after for s, _, _ in self.hits.get(SYMPTOM, ())):
+            return None
+        return kind == POS
+
+    def _skip_ws(self, i: int) -> int:
+        while i < len(self.text) and self.text[i] in _WS:
+            i += 1
+        return i
+
+    def _skip_ws_back(self, i: int) -> int:
+        while i > 0 and self.text[i - 1] in _WS:
+            i -= 1
+        return i
+
+    def facts(self) -> Tuple[Any, ...]:
+        """What an answer to this text depends on beyond its wording: numbers, units, symptoms, negation."""
+        return (tuple(_NUMBERS.findall(self.norm)), tuple(self.labels(UNIT)),
+                tuple(self.symptoms()), NEG in self.hits)
+
+    def _ranked(self, kind: str, spans) -> List[Any]:
+        rank = self._an._rank
+        return sorted({label for _, _, label in spans}, key=lambda l: rank.get((kind, l), 0))
+
+class ThaiAnalyzer:
+    """
+    Compiles thai_lexicon.yaml into one Aho-Corasick automaton; analyze() makes
+    a single pass per message and memoizes recent results, since the fast
+    path and slot enforcement look at the same text several times per turn.
+    """
+    def __init__(self, lexicon: Dict[str, Any], memo_size: int = 256):
+        entries: Dict[str, List[Tuple[str, Any]]] = {}
+        self._rank: Dict[Tuple[str, Any], int] = {}
+
+        def add(kind: str, label: Any, kw: str) -> None:
+            key = str(kw).strip().lower().translate(_THAI_DIGITS)
+            if key and (kind, label) not in entries.setdefault(key, []):
+                entries[key].append((kind, label))
+            self._rank.setdefault((kind, label), len(self._rank))
+
+        for label, kws in (lexicon.get("symptoms") or {}).items():
+            for kw in kws:
+                add(SYMPTOM, label, kw)
+        nums = lexicon.get("numbers") or {}
+        for word, val in (nums.get("digits") or {}).items():
+            add(NUMBER, ("digit", int(val)), word)
+        for word, val in (nums.get("multipliers") or {}).items():
+            add(NUMBER, ("mult10" if int(val) == 10 else "mult", int(val)), word)
+        for word, val in (nums.get("after_ten") or {}).items():
+            add(NUMBER, ("after_ten", int(val)), word)
+        for word, val in (nums.get("before_ten") or {}).items():
+            add(NUMBER, ("before_ten", int(val)), word)
+        for written, unit in (lexicon.get("duration_units") or {}).items():
+            add(UNIT, unit, written)
+        for kw in lexicon.get("unknown_markers") or []:
+            add(UNKNOWN, kw, kw)
+        for kw in lexicon.get("negation_markers") or []:
+            add(NEG, kw, kw)
+        for kw in lexicon.get("affirmation_markers") or []:
+            add(POS, kw, kw)
+        for kw in lexicon.get("symptom_negators") or []:
+            add(SYMPTOM_NEG, kw, kw)
+        for table, labels in (lexicon.get("labels") or {}).items():
+            for label, kws in labels.items():
+                for kw in kws:
+                    add(table, label, kw)
+
+        keys = list(entries)
+        self._ac = AhoCorasick(keys)
+        self._payloads = [tuple(entries[k]) for k in keys]
+        self.none_answers = frozenset(_squash(str(a).lower()) for a in lexicon.get("none_answers") or [])
+        self._memo: "OrderedDict[str, Analysis]" = OrderedDict()
+        self._memo_size = memo_size
+        self._lock = threading.Lock()
+
+    def analyze(self, text: str) -> Analysis:
+        text = text or ""
+        a = self._memo.get(text)
+        if a is not None:
+            return a
+        a = Analysis(self, text)
+        with self._lock:
+            self._memo[text] = a
+            if len(self._memo) > self._memo_size:
+                self._memo.popitem(last=False)
+        return a
+
+def get_analyzer() -> ThaiAnalyzer:
+    # compiled with the rest of the config; a lexicon edit swaps it in on reload
+    return config_snapshot().analyzer
+
+def analyze(text: str) -> Analysis:
+    return get_analyzer().analyze(text)
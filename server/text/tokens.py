@@ -0,0 +1,9 @@
+import math
+
+def approx_tokens(text: str) -> int:
+    # cheap, conservative estimate without a tokenizer: ~4 ASCII chars per token,
+    # Thai/other non-ASCII chars count as one token each (upper bound for cl100k/o200k)
+    if not text:
+        return 0
+    n_ascii = len(text.encode("ascii", "ignore"))
+    return math.ceil(n_ascii / 4) + (len(text) - n_ascii)
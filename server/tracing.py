@@ -0,0 +1,114 @@
+import contextvars, json, logging, os, sys, time, uuid
+from typing import Any, Dict, Optional
+
+from server.metrics import histogram
+
+# Timed spans around the stages of a request, tagged with the request id.
+# Every span feeds aidgent_stage_seconds{stage}; with TRACE_JSON_LOGS=1 each
+# span is also written as one JSON line to the "aidgent.trace" logger (stderr).
+
+STAGE_SECONDS = histogram("aidgent_stage_seconds", "Time spent per pipeline stage", ["stage"])
+
+JSON_LOGS = os.environ.get("TRACE_JSON_LOGS", "0").lower() in ("1", "true", "yes")
+
+trace_log = logging.getLogger("aidgent.trace")
+if JSON_LOGS and not trace_log.handlers:
+    _h = logging.StreamHandler(sys.stderr)
+    _h.setFormatter(logging.Formatter("%(message)s"))
+    trace_log.addHandler(_h)
+    trace_log.setLevel(logging.INFO)
+    trace_log.propagate = False
+
+_request_id: "contextvars.ContextVar[str]" = contextvars.ContextVar("request_id", default="-")
+_current: "contextvars.ContextVar[Optional[Span]]" = contextvars.ContextVar("span", default=None)
+
+def new_request_id(incoming: Optional[str] = None) -> str:
+    """Use the caller's id (X-Request-ID) when it looks sane, else a fresh one; set for this context."""
+    rid = incoming if incoming and len(incoming) <= 64 and incoming.isprintable() else uuid.uuid4().hex[:16]
+    _request_id.set(rid)
+    return rid
+
+def request_id() -> str:
+    return _request_id.get()
+
+class Span:
+    """
+    with span("rag.query", k=5) as sp:
+        ...
+        sp.set(matches=3)
+
+    Works in sync code, in coroutines and across `yield` in async generators.
+    Worker threads see the span/request id only if started with the caller's
+    context (asyncio.to_thread does this; use contextvars.copy_context() for pools).
+    """
+    __slots__ = ("stage", "attrs", "t0", "parent")
+
+    def __init__(self, stage: str, attrs: Dict[str, Any]):
+        self.stage = stage
+        self.attrs = attrs
+        self.t0 = 0.0
+        self.parent = None
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+    def __enter__(self) -> "Span":
+        self.parent = _current.get()
+        _current.set(self)
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        seconds = time.perf_counter() - self.t0
+        # set, not reset: an async generator may be closed from another context
+        _current.set(self.parent)
+        STAGE_SECONDS.observe(seconds, stage=self.stage)
+        if exc_type is not None and exc_type is not GeneratorExit:
+            self.attrs["error"] = exc_type.__name__
+        if JSON_LOGS:
+            rec = {"ts": round(time.time(), 3), "request_id": _request_id.get(), "span": self.stage,
+                   "ms": round(seconds * 1000, 2)}
+            if self.parent is not None:
+                rec["parent"] = self.parent.stage
+            rec.update(self.attrs)
+            trace_log.info(json.dumps(rec, ensure_ascii=False, default=str))
+
+def span(stage: str, **attrs) -> Span:
+    return Span(stage, attrs)
+
+def annotate(**attrs) -> None:
+    """Attach attributes (token counts, cache results) to the innermost open span, if any."""
+    sp = _current.get()
+    if sp is not None:
+        sp.attrs.update(attrs)
+
+class RequestTracing:
+    """
+    ASGI middleware: a request id per HTTP request (X-Request-ID in, echoed
+    back out) and a "request" span over the whole exchange, streamed bodies
+    included.
+    """
+    def __init__(self, app, skip=("/metrics",)):
+        self.app = app
+        self.skip = set(skip)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.skip:
+            return await self.app(scope, receive, send)
+        incoming = None
+        for k, v in scope.get("headers") or ():
+            if k == b"x-request-id":
+                incoming = v.decode("latin-1")
+                break
+        rid = new_request_id(incoming)
+        status = {"code": 0}
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                message["headers"] = list(message.get("headers") or []) + [(b"x-request-id", rid.encode("latin-1"))]
+            await send(message)
+
+        with span("request", method=scope["method"], path=scope["path"]) as sp:
+            await self.app(scope, receive, send_with_id)
+            sp.set(status=status["code"])
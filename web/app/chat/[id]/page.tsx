@@ -1,7 +1,7 @@
 "use client";
 import { useEffect, useMemo, useState } from "react";
 import { useParams } from "next/navigation";
-import { getTranscript, postChatTurn, Transcript } from "@/lib/api";
+import { getTranscript, streamChatTurn, Transcript } from "@/lib/api";
 import { MessageList } from "@/components/MessageList";
 import { Composer } from "@/components/Composer";
 import { updateSession, touchSession } from "@/lib/sessionIndex";
@@ -56,13 +56,16 @@ export default function ChatPage() {
     touchSession(id);
 
     try {
-      const res = await postChatTurn({ session_id: id, user_text: text });
-      if (res?.assistant_text) {
-        setMessages((m) => [
-          ...m,
-          { role: "assistant", content_th: res.assistant_text, ts: new Date().toISOString() },
-        ]);
-      }
+      // one assistant bubble (keyed by its ts), filled in as tokens stream
+      const replyTs = new Date(Date.now() + 1).toISOString();
+      const show = (content: string) =>
+        setMessages((m) => {
+          const msg: Msg = { role: "assistant", content_th: content, ts: replyTs };
+          const i = m.findIndex((x) => x.role === "assistant" && x.ts === replyTs);
+          return i === -1 ? [...m, msg] : [...m.slice(0, i), msg, ...m.slice(i + 1)];
+        });
+      const res = await streamChatTurn({ session_id: id, user_text: text }, show);
+      if (res?.assistant_text) show(res.assistant_text);
       if (res?.state?.red_flag_detected && res?.state?.red_flag_label) {
         setRedFlag("พบสัญญาณอันตราย (" + String(res.state.red_flag_label) + ")");
       }
@@ -49,9 +49,106 @@ export async function postChatTurn(body: {
   return handle(res);
 }
 
+/**
+ * POST /chat/turn/stream (SSE). `onText` receives the full text shown so far
+ * whenever a token arrives or the server replaces the reply; resolves with the
+ * same payload as /chat/turn.
+ */
+export async function streamChatTurn(
+  body: { session_id?: string; user_text: string },
+  onText: (text: string) => void
+): Promise<ChatTurnResponse> {
+  const res = await fetch(`${API_BASE}/chat/turn/stream`, {
+    method: "POST",
+    headers: { "Content-Type": "application/json", Accept: "text/event-stream" },
+    body: JSON.stringify(body),
+  });
+  if (!res.ok || !res.body) return handle(res);
+
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buf = "";
+  let shown = "";
+  let final: ChatTurnResponse | null = null;
+
+  const dispatch = (block: string) => {
+    let event = "message";
+    let data = "";
+    for (const line of block.split("\n")) {
+      if (line.startsWith("event:")) event = line.slice(6).trim();
+      else if (line.startsWith("data:")) data += line.slice(5).trim();
+    }
+    if (!data) return;
+    const payload = JSON.parse(data);
+    if (event === "token") {
+      shown += payload.text;
+      onText(shown);
+    } else if (event === "replace") {
+      shown = payload.text ?? "";
+      onText(shown);
+    } else if (event === "final") {
+      final = payload as ChatTurnResponse;
+    } else if (event === "error") {
+      throw new Error(payload.detail ?? "stream error");
+    }
+  };
+
+  for (;;) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buf += decoder.decode(value, { stream: true });
+    let idx: number;
+    while ((idx = buf.indexOf("\n\n")) !== -1) {
+      dispatch(buf.slice(0, idx));
+      buf = buf.slice(idx + 2);
+    }
+  }
+  if (buf.trim()) dispatch(buf);
+  if (!final) throw new Error("stream ended without final event");
+  return final;
+}
+
+type TranscriptEntry = { etag?: string; lastId: number; data: any };
+const transcriptCache = new Map<string, TranscriptEntry>();
+
+/**
+ * Incremental GET /session/{id}/transcript: the first call pages through the
+ * whole session, later calls only ask for messages after the last seen id and
+ * revalidate with If-None-Match, so an unchanged session costs one 304. The
+ * ETag names the session's last message, not the cursor, so it is kept across
+ * cursor moves; it is only held once the client has caught up (no has_more).
+ */
+async function fetchTranscript(id: string, includeState: boolean): Promise<any> {
+  const key = `${id}:${includeState ? 1 : 0}`;
+  const entry: TranscriptEntry = transcriptCache.get(key) ?? {
+    lastId: 0,
+    data: { session_id: id, messages: [], soap_summaries: [], citations: [] },
+  };
+  for (;;) {
+    const url =
+      `${API_BASE}/session/${id}/transcript` +
+      `?after_id=${entry.lastId}&include_state=${includeState}`;
+    const headers: Record<string, string> = {};
+    if (entry.etag) headers["If-None-Match"] = entry.etag;
+    const res = await fetch(url, { cache: "no-store", headers });
+    if (res.status === 304) break;
+    const page = await handle(res);
+    entry.etag = page.has_more ? undefined : res.headers.get("ETag") ?? undefined;
+    entry.data = {
+      session_id: page.session_id,
+      messages: [...entry.data.messages, ...(page.messages ?? [])],
+      soap_summaries: [...entry.data.soap_summaries, ...(page.soap_summaries ?? [])],
+      citations: [...entry.data.citations, ...(page.citations ?? [])],
+    };
+    entry.lastId = page.next_after_id ?? entry.lastId;
+    if (!page.has_more) break;
+  }
+  transcriptCache.set(key, entry);
+  return entry.data;
+}
+
 export async function getTranscript(id: string): Promise<Transcript> {
-  const res = await fetch(`${API_BASE}/session/${id}/transcript`, { cache: "no-store" });
-  const data = await handle(res);
+  const data = await fetchTranscript(id, false);
   return {
     session_id: data.session_id,
     messages: (data.messages || []).map((m: any) => ({
@@ -74,8 +171,7 @@ export async function getSessionServerMeta(id: string): Promise<{
   ended: boolean;
   lastTs?: string;
 }> {
-  const res = await fetch(`${API_BASE}/session/${id}/transcript`, { cache: "no-store" });
-  const data = await handle(res);
+  const data = await fetchTranscript(id, true);
 
   const msgs: any[] = data.messages ?? [];
   let intent: string | undefined;